@@ -0,0 +1,92 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import CancelledError
+
+
+class AsyncWorker:
+    """Background thread owning a persistent asyncio event loop.
+
+    Coroutines are submitted from any thread (typically the Tk main thread)
+    and run on the worker loop. Progress events are pushed onto a thread-safe
+    queue that the caller polls, e.g. with ``root.after``.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.events = queue.Queue()
+        self._jobs = {}  # {job_id: concurrent.futures.Future}
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run_loop, name="async-worker", daemon=True)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        """Start the worker thread."""
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def emit(self, kind, **data):
+        """Push an event onto the queue. Safe to call from any thread."""
+        self.events.put((kind, data))
+
+    def submit(self, job_id, coro):
+        """Schedule a coroutine on the worker loop and track it under job_id."""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self._lock:
+            self._jobs[job_id] = future
+
+        def _done(fut):
+            with self._lock:
+                if self._jobs.get(job_id) is fut:
+                    del self._jobs[job_id]
+            try:
+                fut.result()
+                self.emit('job_done', job_id=job_id)
+            except CancelledError:
+                self.emit('job_cancelled', job_id=job_id)
+            except Exception as e:
+                self.emit('job_error', job_id=job_id, error=str(e))
+
+        future.add_done_callback(_done)
+        return future
+
+    def progress_callback(self, job_id):
+        """Return a callback that reports (done, total, message) for a job."""
+        def callback(done, total, message=""):
+            self.emit('progress', job_id=job_id, done=done, total=total, message=message)
+        return callback
+
+    def running_jobs(self):
+        """Return the ids of jobs that have not finished yet."""
+        with self._lock:
+            return list(self._jobs)
+
+    def cancel(self, job_id=None):
+        """Cancel one job, or every running job if job_id is None."""
+        with self._lock:
+            futures = list(self._jobs.values()) if job_id is None else [self._jobs.get(job_id)]
+        for future in futures:
+            if future is not None:
+                future.cancel()
+
+    async def _cancel_tasks(self):
+        """Cancel every task on the loop and wait for their cleanup handlers to run."""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stop(self, timeout=5):
+        """Cancel all jobs, let them unwind, and shut down the event loop."""
+        if self._thread.is_alive():
+            try:
+                asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result(timeout)
+            except Exception as e:
+                print(f"Jobs did not stop cleanly: {e!r}")
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=timeout)
+        else:
+            self.cancel()
@@ -0,0 +1,535 @@
+"""Offline end-to-end benchmark.
+
+Runs the real pipeline (extraction, theme analysis, card generation,
+parsing, caching and saving) against synthetic PDFs and a local stand-in
+for the LLM providers, so no API keys or network are needed.
+
+    python benchmark.py run --pages 50 500 5000
+    python benchmark.py history
+    python benchmark.py import-time
+    python benchmark.py queue --books 8 --workers 1 2 4
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import subprocess
+import tempfile
+import threading
+from datetime import datetime
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Vocabulary for synthetic textbook pages
+TOPICS = [
+    "Respiratory Physiology", "Gas Exchange", "Pulmonary Circulation", "Ventilation Mechanics",
+    "Cardiac Output", "Renal Clearance", "Acid Base Balance", "Neuromuscular Blockade",
+    "Pharmacokinetics", "Oxygen Transport", "Cerebral Blood Flow", "Fluid Compartments"
+]
+WORDS = (
+    "alveoli surfactant compliance resistance perfusion ventilation diffusion hemoglobin "
+    "oxygen carbon dioxide pressure volume flow cardiac output stroke preload afterload "
+    "contractility renal glomerular filtration clearance plasma receptor agonist antagonist "
+    "clearance distribution elimination half life metabolism hepatic neuromuscular junction "
+    "acetylcholine bicarbonate buffer acidosis alkalosis cerebral autoregulation"
+).split()
+
+
+# Synthetic PDFs -------------------------------------------------------------
+
+def _page_lines(rng, page_number, lines_per_page):
+    topic = TOPICS[(page_number // 20) % len(TOPICS)]
+    lines = [f"Chapter {page_number // 20 + 1}: {topic}"]
+    for _ in range(lines_per_page - 1):
+        lines.append(" ".join(rng.choice(WORDS) for _ in range(12)).capitalize() + ".")
+    return lines
+
+
+def write_synthetic_pdf(path, pages, lines_per_page=40, seed=0):
+    """Write a text-only PDF with the given number of pages, without any PDF library."""
+    rng = random.Random(seed)
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None,
+               b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    page_ids = []
+    for page_number in range(pages):
+        lines = _page_lines(rng, page_number, lines_per_page)
+        escaped = (line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)') for line in lines)
+        stream = ("BT /F1 9 Tf 40 800 Td 11 TL " + " ".join(f"({line}) '" for line in escaped) + " ET").encode('latin-1')
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                       b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects))
+        page_ids.append(len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, 'wb') as f:
+        f.write(out)
+
+
+# Fake provider --------------------------------------------------------------
+
+class FakeResponder:
+    """Produces plausible responses for the pipeline's three prompt types."""
+
+    def __init__(self, latency=0.05, jitter=0.02, rate_429=0.0, malformed_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    def respond(self, prompt):
+        """Return response text for a prompt, or raise a simulated quota error."""
+        from providers import ProviderError
+
+        self.calls += 1
+        if self.rng.random() < self.rate_429:
+            raise ProviderError("fake", 429, "Resource has been exhausted (simulated)")
+        if self.rng.random() < self.malformed_rate:
+            return '[{"question": "truncated'
+
+        if prompt.startswith("Given this filename"):
+            name = re.search(r'filename: "([^"]+)"', prompt).group(1)
+            return json.dumps({"title": os.path.splitext(name)[0].replace('_', ' '), "year": "2024"})
+        if "Extract 5-10 key medical themes" in prompt:
+            return json.dumps(self.rng.sample(TOPICS, 8))
+        match = re.match(r"Create (\d+) medical multiple choice questions about (.+?)\.\n", prompt)
+        count, theme = int(match.group(1)), match.group(2)
+        cards = [{
+            "question": f"Which statement about {theme} is correct? ({self.calls}.{i + 1})",
+            "correct_answer": f"A) {' '.join(self.rng.choice(WORDS) for _ in range(6))}",
+            "wrong_answers": [f"{letter}) {' '.join(self.rng.choice(WORDS) for _ in range(6))}" for letter in "BCD"],
+            "explanation": " ".join(self.rng.choice(WORDS) for _ in range(20))
+        } for i in range(count)]
+        return "```json\n" + json.dumps(cards) + "\n```"
+
+    def delay(self):
+        return max(0.0, self.latency + self.rng.uniform(-self.jitter, self.jitter))
+
+
+def create_fake_provider(responder):
+    """In-process provider answering from a FakeResponder."""
+    from providers import Provider, register_provider
+
+    @register_provider("fake")
+    class FakeProvider(Provider):
+        async def generate(self, prompt):
+            await asyncio.sleep(responder.delay())
+            return responder.respond(prompt)
+
+    return FakeProvider()
+
+
+async def start_fake_server(responder, host='127.0.0.1', port=0):
+    """Serve a FakeResponder as an OpenAI-compatible HTTP endpoint.
+
+    Returns the aiohttp runner and the base URL for the "local" provider.
+    """
+    from aiohttp import web
+    from providers import ProviderError
+
+    async def chat_completions(request):
+        payload = await request.json()
+        await asyncio.sleep(responder.delay())
+        try:
+            content = responder.respond(payload['messages'][-1]['content'])
+        except ProviderError as e:
+            return web.json_response({'error': str(e)}, status=e.status)
+        return web.json_response({'choices': [{'message': {'role': 'assistant', 'content': content}}]})
+
+    app = web.Application()
+    app.router.add_post('/v1/chat/completions', chat_completions)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{bound_port}/v1"
+
+
+def create_fake_handler(cache_dir, provider, max_concurrency=8):
+    """ModelHandler whose only provider is the given stand-in."""
+    from config import settings
+    from model_handler import ModelHandler
+
+    # Private copy: no quota or back-off, whatever the environment configures
+    handler_settings = settings.copy(max_concurrency=max_concurrency, rate_limit=0, retry_delay=0)
+    return ModelHandler(None, None, cache_dir, preferred_model=provider.name,
+                        providers={provider.name: provider}, settings=handler_settings)
+
+
+# Single measurement (runs in its own process) -------------------------------
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def _cache_hit_rate(metrics):
+    hits = metrics.counter_value('cache_lookups_total', result='hit')
+    total = metrics.counter_value('cache_lookups_total')
+    return round(hits / total, 3) if total else None
+
+
+def measure(pages, workspace, args):
+    """Benchmark one PDF size. Must run in a fresh process: config reads env at import."""
+    os.environ['OUTPUT_DIR'] = os.path.join(workspace, 'Outputs')
+    os.environ['PDF_INPUT_DIR'] = os.path.join(workspace, 'pdfInput')
+    os.environ['FLASHCARD_PROFILE'] = 'offline-benchmark'
+    os.makedirs(os.environ['PDF_INPUT_DIR'], exist_ok=True)
+
+    import main
+    from metrics import metrics
+    from config import settings
+
+    pdf_path = os.path.join(os.environ['PDF_INPUT_DIR'], f"Synthetic_Textbook_{pages}.pdf")
+    write_synthetic_pdf(pdf_path, pages, seed=args.seed)
+    main.ensure_directories()
+
+    start = time.perf_counter()
+    sections = main.extract_text_from_pdf(pdf_path)
+    extract_seconds = time.perf_counter() - start
+
+    responder = FakeResponder(args.latency, args.jitter, args.rate_429, args.malformed, seed=args.seed)
+    result = {'pages': pages, 'characters': sum(len(s) for s in sections),
+              'extract_seconds': round(extract_seconds, 3),
+              'pages_per_second': round(pages / extract_seconds, 1)}
+
+    async def run_pipeline():
+        runner = None
+        if args.transport == 'http':
+            from providers import create_provider
+            runner, base_url = await start_fake_server(responder)
+            provider = create_provider('local', base_url=base_url, model='fake',
+                                       max_connections=args.concurrency)
+        else:
+            provider = create_fake_provider(responder)
+        handler = create_fake_handler(settings.cache_dir, provider, max_concurrency=args.concurrency)
+        try:
+            return await main.process_pdf(pdf_path, handler) or []
+        finally:
+            await handler.close()
+            if runner:
+                await runner.cleanup()
+
+    for run in ('cold', 'warm'):
+        metrics.reset()
+        calls_before = responder.calls
+        start = time.perf_counter()
+        cards = asyncio.run(run_pipeline())
+        seconds = time.perf_counter() - start
+        result[run] = {
+            'seconds': round(seconds, 3),
+            'cards': len(cards),
+            'cards_per_minute': round(len(cards) / seconds * 60, 1) if seconds else None,
+            'llm_calls': responder.calls - calls_before,
+            'cache_hit_rate': _cache_hit_rate(metrics)
+        }
+    result['peak_rss_mb'] = _peak_rss_mb()
+    return result
+
+
+# Suite, storage and comparison -----------------------------------------------
+
+def _git_version():
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def _params(args):
+    return {'latency': args.latency, 'jitter': args.jitter, 'rate_429': args.rate_429,
+            'malformed': args.malformed, 'concurrency': args.concurrency, 'seed': args.seed,
+            'transport': args.transport}
+
+
+def _results_path(args):
+    """The --results file, defaulting to benchmarks/results.jsonl in the configured output dir."""
+    if args.results:
+        return args.results
+    from config import settings
+    return os.path.join(settings.output_dir, 'benchmarks', 'results.jsonl')
+
+
+def load_history(results_path):
+    if not os.path.exists(results_path):
+        return []
+    with open(results_path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(record, previous, threshold):
+    """Return (lines, regressed) comparing throughput against a previous record."""
+    lines = []
+    regressed = False
+    previous_by_pages = {r['pages']: r for r in previous['results']}
+    for r in record['results']:
+        old = previous_by_pages.get(r['pages'])
+        if not old:
+            continue
+        for label, new_value, old_value in (
+            ('extract pages/s', r['pages_per_second'], old['pages_per_second']),
+            ('cold cards/min', r['cold']['cards_per_minute'], old['cold']['cards_per_minute']),
+            ('warm cards/min', r['warm']['cards_per_minute'], old['warm']['cards_per_minute']),
+        ):
+            if not new_value or not old_value:
+                continue
+            change = (new_value - old_value) / old_value
+            flag = ""
+            if change < -threshold:
+                flag = "  <-- REGRESSION"
+                regressed = True
+            lines.append(f"{r['pages']:>6} pages  {label:<16} {old_value:>10} -> {new_value:<10} ({change:+.1%}){flag}")
+    return lines, regressed
+
+
+def run_suite(args):
+    results = []
+    with tempfile.TemporaryDirectory(prefix="flashcard-bench-") as workspace:
+        for pages in args.pages:
+            print(f"Benchmarking {pages} pages...", file=sys.stderr)
+            command = [sys.executable, os.path.abspath(__file__), '_measure', str(pages),
+                       '--workspace', os.path.join(workspace, str(pages)),
+                       '--latency', str(args.latency), '--jitter', str(args.jitter),
+                       '--rate-429', str(args.rate_429), '--malformed', str(args.malformed),
+                       '--concurrency', str(args.concurrency), '--seed', str(args.seed),
+                       '--transport', args.transport]
+            completed = subprocess.run(command, capture_output=True, text=True)
+            if completed.returncode != 0:
+                print(completed.stderr, file=sys.stderr)
+                return 1
+            results.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    record = {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'version': _git_version(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': _params(args),
+        'results': results
+    }
+
+    print(f"{'pages':>6} {'extract p/s':>12} {'cold cards/min':>15} {'warm cards/min':>15} "
+          f"{'warm hit rate':>14} {'peak RSS MB':>12}")
+    for r in results:
+        print(f"{r['pages']:>6} {r['pages_per_second']:>12} {r['cold']['cards_per_minute']:>15} "
+              f"{r['warm']['cards_per_minute']:>15} {r['warm']['cache_hit_rate']:>14} {r['peak_rss_mb']:>12}")
+
+    # Compare against the latest run with the same parameters
+    results_path = _results_path(args)
+    history = [h for h in load_history(results_path) if h['params'] == record['params']]
+    regressed = False
+    if history:
+        lines, regressed = compare(record, history[-1], args.threshold)
+        print(f"\nCompared with {history[-1]['version']} ({history[-1]['timestamp']}):")
+        print("\n".join(lines) if lines else "No overlapping page counts")
+
+    if not args.no_save:
+        os.makedirs(os.path.dirname(os.path.abspath(results_path)), exist_ok=True)
+        with open(results_path, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"\nResults appended to {results_path}")
+
+    return 1 if regressed and args.fail_on_regression else 0
+
+
+def show_history(args):
+    for record in load_history(_results_path(args)):
+        sizes = ", ".join(f"{r['pages']}p: {r['cold']['cards_per_minute']} cards/min"
+                          for r in record['results'])
+        print(f"{record['timestamp']}  {record['version']:<14} {sizes}")
+    return 0
+
+
+# Work queue -----------------------------------------------------------------
+
+def _serve_in_thread(responder):
+    """Run the fake HTTP provider on a background event loop. Returns (loop, runner, base URL)."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    runner, base_url = asyncio.run_coroutine_threadsafe(start_fake_server(responder), loop).result()
+    return loop, runner, base_url
+
+
+def run_queue_benchmark(args):
+    """Time a library through enqueue + `cli.py worker --processes N` for each worker count."""
+    responder = FakeResponder(args.latency, args.jitter, args.rate_429, args.malformed, seed=args.seed)
+    loop, runner, base_url = _serve_in_thread(responder)
+    cli = os.path.join(BASE_DIR, 'cli.py')
+    print(f"{'workers':>8} {'seconds':>8} {'cards':>6} {'cards/min':>10} {'dead jobs':>10}")
+    try:
+        with tempfile.TemporaryDirectory(prefix="flashcard-queue-") as workspace:
+            for workers in args.workers:
+                run_dir = os.path.join(workspace, f"workers_{workers}")
+                env = {**os.environ, 'OUTPUT_DIR': os.path.join(run_dir, 'Outputs'),
+                       'PDF_INPUT_DIR': os.path.join(run_dir, 'pdfInput'),
+                       'FLASHCARD_PROFILE': 'offline-benchmark', 'LLM_PROVIDERS': 'local',
+                       'LOCAL_LLM_URL': base_url, 'GEMINI_API_KEY': '', 'MISTRAL_API_KEY': '',
+                       'QUEUE_POLL_INTERVAL': '0.2', 'QUEUE_RETRY_DELAY': '0'}
+                os.makedirs(env['PDF_INPUT_DIR'])
+                for i in range(args.books):
+                    write_synthetic_pdf(os.path.join(env['PDF_INPUT_DIR'], f"Synthetic_Book_{i}.pdf"),
+                                        args.pages, seed=args.seed + i)
+
+                subprocess.run([sys.executable, cli, 'enqueue'], env=env, cwd=run_dir, check=True,
+                               capture_output=True)
+                start = time.perf_counter()
+                subprocess.run([sys.executable, cli, 'worker', '--processes', str(workers), '--slots', str(args.slots),
+                                '--provider', 'local'], env=env, cwd=run_dir, capture_output=True)
+                seconds = time.perf_counter() - start
+
+                flashcards_dir = os.path.join(env['OUTPUT_DIR'], 'flashcards')
+                cards = sum(len(json.load(open(os.path.join(flashcards_dir, name))))
+                            for name in os.listdir(flashcards_dir) if name.endswith('.json'))
+                stats = json.loads(subprocess.run([sys.executable, cli, 'queue', 'stats'], env=env, cwd=run_dir,
+                                                  capture_output=True, text=True).stdout.splitlines()[-1])
+                dead = sum(counts.get('dead', 0) for counts in stats['stages'].values())
+                print(f"{workers:>8} {seconds:>8.2f} {cards:>6} {cards / seconds * 60:>10.1f} {dead:>10}")
+    finally:
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+    return 0
+
+
+# Import time ----------------------------------------------------------------
+
+# Entry-point modules and the import-time budget (ms) for each
+IMPORT_BUDGETS_MS = {'gui': 250, 'cli': 200, 'main': 200}
+# Heavy libraries that must only be imported on first use
+LAZY_MODULES = ('PyPDF2', 'aiohttp', 'google.generativeai', 'mistralai', 'tqdm')
+
+
+def measure_import(module, workspace):
+    """Return (cumulative ms, imported module names) for importing module in a fresh interpreter."""
+    completed = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f"import sys; sys.path.insert(0, {BASE_DIR!r}); import {module}"],
+        cwd=workspace, capture_output=True, text=True
+    )
+    if completed.returncode != 0:
+        raise RuntimeError(completed.stderr.strip().splitlines()[-1])
+    cumulative_ms = None
+    imported = set()
+    for line in completed.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue  # Header line
+        imported.add(name.strip())
+        if name.strip() == module and not name.startswith('  '):
+            cumulative_ms = int(cumulative) / 1000
+    return cumulative_ms, imported
+
+
+def check_import_time(args):
+    """Fail if an entry point imports too slowly, imports heavy libraries eagerly,
+    or creates files at import time."""
+    failures = []
+    print(f"{'module':<8} {'best ms':>8} {'budget':>8}")
+    for module, budget in IMPORT_BUDGETS_MS.items():
+        budget = budget * args.budget_scale
+        with tempfile.TemporaryDirectory(prefix="flashcard-import-") as workspace:
+            timings = []
+            for _ in range(args.repeat):
+                cumulative_ms, imported = measure_import(module, workspace)
+                timings.append(cumulative_ms)
+            created = os.listdir(workspace)
+        best = min(timings)
+        print(f"{module:<8} {best:>8.1f} {budget:>8.0f}")
+        if best > budget:
+            failures.append(f"{module}: {best:.1f} ms exceeds budget of {budget:.0f} ms")
+        eager = [name for name in LAZY_MODULES if name in imported]
+        if eager:
+            failures.append(f"{module}: imports {', '.join(eager)} eagerly")
+        if created:
+            failures.append(f"{module}: created {', '.join(created)} at import time")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    return 1 if failures else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="benchmark.py", description="Offline pipeline benchmark")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    provider = argparse.ArgumentParser(add_help=False)
+    provider.add_argument('--latency', type=float, default=0.05, help="Fake LLM latency in seconds")
+    provider.add_argument('--jitter', type=float, default=0.02, help="Uniform latency jitter in seconds")
+    provider.add_argument('--rate-429', type=float, default=0.0, help="Fraction of calls failing with 429")
+    provider.add_argument('--malformed', type=float, default=0.0, help="Fraction of malformed responses")
+    provider.add_argument('--concurrency', type=int, default=8, help="Maximum concurrent fake LLM calls")
+    provider.add_argument('--seed', type=int, default=0)
+    provider.add_argument('--transport', choices=['inprocess', 'http'], default='inprocess',
+                          help="Call the fake in-process, or over HTTP through the pooled 'local' provider")
+
+    run = subparsers.add_parser('run', parents=[provider], help="Run the benchmark suite")
+    run.add_argument('--pages', type=int, nargs='+', default=[50, 500, 5000])
+    run.add_argument('--results', help="JSON lines file of past results (default: <output dir>/benchmarks/results.jsonl)")
+    run.add_argument('--threshold', type=float, default=0.1, help="Relative slowdown flagged as a regression")
+    run.add_argument('--fail-on-regression', action='store_true', help="Exit with 1 when a regression is found")
+    run.add_argument('--no-save', action='store_true', help="Don't append results to the history file")
+
+    import_time = subparsers.add_parser('import-time', help="Check entry-point import time against budgets")
+    import_time.add_argument('--repeat', type=int, default=5, help="Imports per module; the fastest counts")
+    import_time.add_argument('--budget-scale', type=float, default=1.0,
+                             help="Multiply every budget, e.g. 2 on slow CI machines")
+
+    queue = subparsers.add_parser('queue', parents=[provider],
+                                  help="Measure work queue throughput with several worker processes")
+    queue.add_argument('--books', type=int, default=8, help="Synthetic books in the library")
+    queue.add_argument('--pages', type=int, default=20, help="Pages per book")
+    queue.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help="Worker process counts to compare")
+    queue.add_argument('--slots', type=int, default=2, help="Jobs each worker process runs at once")
+
+    history = subparsers.add_parser('history', help="List stored results")
+    history.add_argument('--results', help="JSON lines file of past results (default: <output dir>/benchmarks/results.jsonl)")
+
+    measure_one = subparsers.add_parser('_measure', parents=[provider])
+    measure_one.add_argument('pages', type=int)
+    measure_one.add_argument('--workspace', required=True)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.command == 'run':
+        return run_suite(args)
+    if args.command == 'history':
+        return show_history(args)
+    if args.command == 'import-time':
+        return check_import_time(args)
+    if args.command == 'queue':
+        return run_queue_benchmark(args)
+    # _measure: keep pipeline logging off stdout, which carries the JSON result
+    sys.stdout, real_stdout = sys.stderr, sys.stdout
+    result = measure(args.pages, args.workspace, args)
+    real_stdout.write(json.dumps(result) + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
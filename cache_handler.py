@@ -1,7 +1,15 @@
 import os
 import json
 import time
+import hashlib
 from datetime import datetime, timedelta
+from metrics import metrics
+
+def stable_hash(data):
+    """Hash that is stable across processes, unlike the built-in hash()."""
+    if not isinstance(data, bytes):
+        data = str(data).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()[:16]
 
 class CacheHandler:
     def __init__(self, cache_dir):
@@ -10,15 +18,24 @@ class CacheHandler:
     
     def _get_cache_key(self, data):
         """Generate a cache key from data."""
-        # Simple hash function for the data
-        return str(hash(str(data)))
+        return stable_hash(data)
     
     def _get_cache_path(self, key):
         """Get the full path for a cache key."""
         return os.path.join(self.cache_dir, f"{key}.json")
     
+    def contains(self, key):
+        """Check whether a non-expired entry exists for key."""
+        return self.get(key) is not None
+    
     def get(self, key):
         """Get data from cache if it exists and is not expired."""
+        with metrics.span('cache_get'):
+            content = self._read(key)
+        metrics.inc('cache_lookups_total', result='hit' if content is not None else 'miss')
+        return content
+    
+    def _read(self, key):
         try:
             cache_path = self._get_cache_path(key)
             if not os.path.exists(cache_path):
@@ -48,7 +65,7 @@ class CacheHandler:
                 'expiry': expiry
             }
             
-            with open(cache_path, 'w') as f:
+            with metrics.span('cache_set'), open(cache_path, 'w') as f:
                 json.dump(data, f)
                 
         except Exception as e:
@@ -63,6 +80,16 @@ class CacheHandler:
         except Exception as e:
             print(f"Error clearing cache: {str(e)}")
     
+    def stats(self):
+        """Return the number of entries and total size of the cache."""
+        entries = 0
+        size = 0
+        for file in os.listdir(self.cache_dir):
+            if file.endswith('.json'):
+                entries += 1
+                size += os.path.getsize(os.path.join(self.cache_dir, file))
+        return {'entries': entries, 'size_mb': round(size / (1024 * 1024), 2)}
+    
     def clear_expired(self):
         """Remove expired cache entries."""
         try:
@@ -0,0 +1,289 @@
+import os
+import re
+import json
+import time
+import asyncio
+from datetime import datetime
+from config import settings
+from metrics import metrics
+from output_writer import output_writer
+from scheduler import request_priority, BACKGROUND
+from main import (
+    load_themes, find_book_pdf, extract_text_async, extracted_text_path, report_progress, distribute_count,
+    generate_flashcards_for_theme, generate_additional_flashcards, generate_random_flashcards,
+    append_flashcards, save_mixed_flashcards
+)
+
+PASSAGE_CHARS = 2000  # Matches the text window used by build_cards_prompt
+FAILED_REFILL_BACKOFF = 300  # Seconds before retrying a (book, theme) whose refill failed
+MAX_CACHED_TEXTS = 4  # Book texts kept in memory for refills
+
+
+def in_refill_window(spec, hour=None):
+    """Whether the hour falls in an off-peak window like "22-7" (empty means always)."""
+    if not spec:
+        return True
+    hour = datetime.now().hour if hour is None else hour
+    for window in spec.split(','):
+        start, _, end = window.partition('-')
+        start, end = int(start), int(end or start)
+        if (start <= hour < end) if start < end else (hour >= start or hour < end):
+            return True
+    return False
+
+
+def theme_passage(theme, text, variant):
+    """A window of text about the theme, a different one for each variant."""
+    words = [w for w in re.findall(r'\w+', theme.lower()) if len(w) > 3]
+    positions = []
+    if words:
+        positions = [m.start() for m in re.finditer(re.escape(words[0]), text.lower())]
+    if positions:
+        start = max(0, positions[variant % len(positions)] - PASSAGE_CHARS // 4)
+    else:
+        windows = max(1, len(text) // PASSAGE_CHARS)
+        start = (variant % windows) * PASSAGE_CHARS
+    return text[start:start + PASSAGE_CHARS]
+
+
+class CardPool:
+    """Per-book, per-theme reserve of pre-generated cards.
+
+    take() serves cards straight from the reserve. Reserves that drop below
+    pool_low_watermark are refilled right away; the rest are topped up to
+    pool_high_watermark only while the app is idle and inside the off-peak
+    window (pool_refill_hours). Reserves are saved in settings.pool_dir.
+    """
+
+    def __init__(self, model_handler, is_idle=None):
+        self.model_handler = model_handler
+        self.is_idle = is_idle or (lambda: True)
+        self.reserves = {}   # {book: {'themes': {theme: [cards]}, 'variants': {theme: n}}}
+        self._texts = {}     # {book: (extraction cache path, full text)}, loaded on first refill
+        self._refilling = set()
+        self._failed = {}    # {(book, theme): time of last failed refill}
+        self._wake = None
+
+    # Storage ---------------------------------------------------------------
+
+    def _path(self, book):
+        return os.path.join(settings.pool_dir, f"{book}.json")
+
+    def _reserve(self, book):
+        if book not in self.reserves:
+            reserve = {'themes': {}, 'variants': {}}
+            if os.path.exists(self._path(book)):
+                try:
+                    with open(self._path(book), 'r') as f:
+                        reserve = json.load(f)
+                except Exception as e:
+                    print(f"Error reading card pool for {book}: {str(e)}")
+            self.reserves[book] = reserve
+        return self.reserves[book]
+
+    def _save(self, book):
+        """Queue writing the book's reserve. Returns an awaitable that completes once written."""
+        os.makedirs(settings.pool_dir, exist_ok=True)
+        reserve = self._reserve(book)
+        # A snapshot, as the reserve keeps changing while the writer thread serializes it
+        snapshot = {'themes': {theme: list(cards) for theme, cards in reserve['themes'].items()},
+                    'variants': dict(reserve['variants'])}
+        return output_writer.write_json(self._path(book), snapshot, indent=None)
+
+    def books(self):
+        """{book: themes} for every processed book."""
+        books = {}
+        for theme_file in sorted(os.listdir(settings.themes_dir)):
+            if theme_file.endswith('_themes.json'):
+                book = theme_file[:-len('_themes.json')]
+                themes = load_themes(book)
+                if themes:
+                    books[book] = themes
+        return books
+
+    def available(self, book, theme=None):
+        themes = self._reserve(book)['themes']
+        if theme is not None:
+            return len(themes.get(theme, []))
+        return sum(len(cards) for cards in themes.values())
+
+    def stats(self):
+        """Reserve size per book and theme."""
+        return {book: {theme: self.available(book, theme) for theme in themes}
+                for book, themes in self.books().items()}
+
+    # Serving ---------------------------------------------------------------
+
+    def take(self, book, theme, count):
+        """Remove and return up to count cards for a theme. The caller saves the reserve."""
+        cards = self._reserve(book)['themes'].get(theme, [])
+        taken, cards[:] = cards[:count], cards[count:]
+        if taken:
+            metrics.inc('card_pool_served_total', value=len(taken))
+        if self.available(book, theme) < settings.pool_low_watermark and self._wake is not None:
+            self._wake.set()
+        return taken
+
+    async def serve_theme(self, book, theme, count):
+        """Cards for one theme, generating any shortfall live."""
+        cards = self.take(book, theme, count)
+        if cards:
+            await asyncio.gather(self._save(book), append_flashcards(book, cards))
+        if len(cards) < count:
+            metrics.inc('card_pool_shortfall_total', value=count - len(cards))
+            cards += await generate_additional_flashcards(book, theme, count - len(cards),
+                                                          self.model_handler) or []
+        return cards
+
+    async def serve_book(self, book, count):
+        """Cards spread over a book's themes in proportion to their reserves."""
+        stocked = {theme: len(cards) for theme, cards in self._reserve(book)['themes'].items() if cards}
+        cards = []
+        if stocked:
+            per_theme = distribute_count(stocked, min(count, sum(stocked.values())))
+            for theme, theme_count in per_theme.items():
+                cards += self.take(book, theme, min(theme_count, count - len(cards)))
+        if cards:
+            await asyncio.gather(self._save(book), append_flashcards(book, cards))
+        if len(cards) < count:
+            metrics.inc('card_pool_shortfall_total', value=count - len(cards))
+            cards += await generate_random_flashcards(book, count - len(cards), self.model_handler) or []
+        return cards
+
+    async def serve(self, count, book=None, theme=None, progress_callback=None):
+        """Serve count cards for a theme, a book or all books (book=None)."""
+        if book is not None:
+            report_progress(progress_callback, 0, 1, "Serving from card pool")
+            if theme is not None:
+                cards = await self.serve_theme(book, theme, count)
+            else:
+                cards = await self.serve_book(book, count)
+            report_progress(progress_callback, 1, 1, "Done")
+            return cards or None
+
+        books = self.books()
+        if not books:
+            print("No theme files found")
+            return None
+        per_book = distribute_count({name: len(themes) for name, themes in books.items()}, count)
+        cards = []
+        for i, (name, book_count) in enumerate(per_book.items()):
+            report_progress(progress_callback, i, len(per_book), f"Book: {name}")
+            if book_count > 0:
+                for card in await self.serve_book(name, book_count):
+                    card['source'] = name
+                    cards.append(card)
+        report_progress(progress_callback, len(per_book), len(per_book), "Done")
+        if cards:
+            await save_mixed_flashcards(cards)
+        return cards or None
+
+    # Refilling -------------------------------------------------------------
+
+    async def _book_text(self, book):
+        """The book's full text, loaded again once the book's PDF or extraction settings change."""
+        pdf_path = await find_book_pdf(book, self.model_handler)
+        if not pdf_path:
+            return None
+        key = extracted_text_path(pdf_path)
+        if self._texts.get(book, (None,))[0] != key:
+            text = await extract_text_async(pdf_path)
+            self._texts.pop(book, None)
+            if len(self._texts) >= MAX_CACHED_TEXTS:
+                del self._texts[next(iter(self._texts))]  # Oldest first
+            self._texts[book] = (key, "\n".join(text) if text else None)
+        return self._texts[book][1]
+
+    async def refill(self, book, theme, target=None):
+        """Generate cards until the theme's reserve reaches target (default: high watermark).
+
+        Returns the cards added.
+        """
+        key = (book, theme)
+        if key in self._refilling:
+            return []
+        self._refilling.add(key)
+        added = []
+        try:
+            target = settings.pool_high_watermark if target is None else target
+            text = await self._book_text(book)
+            if not text:
+                raise Exception(f"No text available for {book}")
+
+            reserve = self._reserve(book)
+            while self.available(book, theme) < target:
+                variant = reserve['variants'].get(theme, 0)
+                reserve['variants'][theme] = variant + 1
+                batch = min(settings.pool_refill_batch, target - self.available(book, theme))
+                with metrics.span('card_pool_refill'):
+                    cards = await generate_flashcards_for_theme(
+                        theme, theme_passage(theme, text, variant), self.model_handler,
+                        count=batch, variant=variant)
+
+                # Skip questions already waiting in the reserve
+                cards_for_theme = reserve['themes'].setdefault(theme, [])
+                seen = {card['question'] for card in cards_for_theme}
+                new_cards = [card for card in cards if card['question'] not in seen]
+                if not new_cards:
+                    break
+                cards_for_theme.extend(new_cards)
+                added += new_cards
+                await self._save(book)
+            metrics.inc('card_pool_refilled_total', value=len(added))
+            if self.available(book, theme) < target:
+                # Only duplicates came back; back off instead of asking again at once
+                self._failed[key] = time.time()
+            else:
+                self._failed.pop(key, None)
+        except Exception as e:
+            print(f"Error refilling card pool for {book} / {theme}: {str(e)}")
+            self._failed[key] = time.time()
+        finally:
+            self._refilling.discard(key)
+        return added
+
+    def _next_refill(self):
+        """The emptiest reserve that needs refilling now, or None."""
+        top_up = self.is_idle() and in_refill_window(settings.pool_refill_hours)
+        candidates = []
+        for book, themes in self.books().items():
+            for theme in themes:
+                key = (book, theme)
+                if key in self._refilling or time.time() - self._failed.get(key, 0) < FAILED_REFILL_BACKOFF:
+                    continue
+                available = self.available(book, theme)
+                if available < settings.pool_low_watermark or (top_up and available < settings.pool_high_watermark):
+                    candidates.append((available, book, theme))
+        if not candidates:
+            return None
+        _, book, theme = min(candidates)
+        return book, theme
+
+    async def fill(self, progress_callback=None):
+        """Top up every reserve to the high watermark. Returns the cards added."""
+        targets = [(book, theme) for book, themes in self.books().items() for theme in themes]
+        added = []
+        for i, (book, theme) in enumerate(targets):
+            report_progress(progress_callback, i, len(targets), f"{book}: {theme}")
+            added += await self.refill(book, theme)
+        report_progress(progress_callback, len(targets), len(targets), "Done")
+        return added
+
+    async def run(self):
+        """Refill reserves in the background until cancelled.
+
+        Refills are sent as background requests, so cards a user is waiting
+        for go first.
+        """
+        self._wake = asyncio.Event()
+        with request_priority(BACKGROUND):
+            while True:
+                target = self._next_refill()
+                if target:
+                    await self.refill(*target)
+                    continue
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=settings.pool_refill_interval)
+                except asyncio.TimeoutError:
+                    pass
@@ -0,0 +1,170 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+from datetime import datetime
+from collections import deque
+from cache_handler import stable_hash
+from providers import Provider, ProviderError
+
+CASSETTE_VERSION = 1
+
+
+class CassetteMiss(Exception):
+    """The replayed cassette has no response for a prompt."""
+
+
+class CassetteRecorder:
+    """Appends every provider request and response to a JSONL cassette.
+
+    The first line is a header; each following line is one call with the
+    provider, a hash of the prompt, the response (or error) and its latency.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = 0
+        self._start = time.monotonic()
+        self._file = open(path, 'w', encoding='utf-8')
+        self._write({'cassette': CASSETTE_VERSION, 'recorded_at': datetime.now().isoformat()})
+
+    def _write(self, entry):
+        self._file.write(json.dumps(entry, ensure_ascii=False, separators=(',', ':')) + "\n")
+        self._file.flush()  # Keep everything recorded so far if the run is interrupted
+
+    def record(self, provider, prompt, seconds, response=None, error=None):
+        self.calls += 1
+        entry = {
+            'seq': self.calls,
+            'at': round(time.monotonic() - self._start, 3),
+            'provider': provider,
+            'prompt': stable_hash(prompt),
+            'chars': len(prompt),
+            'seconds': round(seconds, 3),
+        }
+        if error is None:
+            entry['response'] = response
+        else:
+            entry['error'] = str(error)
+            if isinstance(error, ProviderError):
+                entry['status'] = error.status
+        self._write(entry)
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+
+class Cassette:
+    """Recorded calls loaded for replay, in recorded order per provider and prompt."""
+
+    def __init__(self, path):
+        self.path = path
+        self.calls = {}  # {(provider, prompt hash): deque of entries}
+        self.providers = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if 'cassette' in entry:
+                    if entry['cassette'] != CASSETTE_VERSION:
+                        raise ValueError(f"{path}: unsupported cassette version {entry['cassette']}")
+                    continue
+                self.calls.setdefault((entry['provider'], entry['prompt']), deque()).append(entry)
+                if entry['provider'] not in self.providers:
+                    self.providers.append(entry['provider'])
+
+    def next_call(self, provider, prompt):
+        """The next recorded call for this provider and prompt.
+
+        Falls back to another provider's recording of the same prompt, since
+        fallback can happen at different points on replay. The last call for
+        a prompt is reused once the recorded ones run out.
+        """
+        key = stable_hash(prompt)
+        calls = self.calls.get((provider, key))
+        if not calls:
+            calls = next((calls for (_, k), calls in self.calls.items() if k == key), None)
+        if not calls:
+            raise CassetteMiss(f"No recorded response for prompt {key} in {self.path}")
+        return calls.popleft() if len(calls) > 1 else calls[0]
+
+
+class RecordingProvider(Provider):
+    """Wraps a real provider and records each call to a cassette."""
+
+    def __init__(self, provider, recorder):
+        self.provider = provider
+        self.recorder = recorder
+        self.name = provider.name
+
+    async def generate(self, prompt):
+        start = time.perf_counter()
+        try:
+            response = await self.provider.generate(prompt)
+        except Exception as e:
+            self.recorder.record(self.name, prompt, time.perf_counter() - start, error=e)
+            raise
+        self.recorder.record(self.name, prompt, time.perf_counter() - start, response=response)
+        return response
+
+    async def close(self):
+        await self.provider.close()
+
+
+class ReplayProvider(Provider):
+    """Serves a provider's recorded responses and errors, at full speed or with the recorded latencies."""
+
+    def __init__(self, name, cassette, realtime=False):
+        self.name = name
+        self.cassette = cassette
+        self.realtime = realtime
+
+    async def generate(self, prompt):
+        entry = self.cassette.next_call(self.name, prompt)
+        if self.realtime:
+            await asyncio.sleep(entry['seconds'])
+        if 'error' not in entry:
+            return entry['response']
+        if 'status' in entry:
+            error = ProviderError(self.name, entry['status'], '')
+            error.args = (entry['error'],)
+            raise error
+        raise Exception(entry['error'])
+
+
+# One recorder per path, shared by every handler in the process
+_recorders = {}
+
+
+def recording_providers(providers, path):
+    """Wrap {name: provider} so every call is recorded to the cassette at path."""
+    if path not in _recorders:
+        _recorders[path] = CassetteRecorder(path)
+        atexit.register(_recorders[path].close)
+    return {name: RecordingProvider(provider, _recorders[path]) for name, provider in providers.items()}
+
+
+def replay_providers(path, order=(), realtime=False):
+    """{name: ReplayProvider} for every provider in the cassette, in the given fallback order first."""
+    cassette = Cassette(path)
+    names = [name for name in order if name in cassette.providers]
+    names += [name for name in cassette.providers if name not in names]
+    return {name: ReplayProvider(name, cassette, realtime) for name in names}
+
+
+def merge_cassettes(parts, path):
+    """Join the cassettes recorded by worker processes into one at path, removing the parts."""
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write(json.dumps({'cassette': CASSETTE_VERSION, 'recorded_at': datetime.now().isoformat()},
+                             separators=(',', ':')) + "\n")
+        for part in parts:
+            if not os.path.exists(part):
+                continue  # The worker exited before making any call
+            with open(part, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip() and not line.startswith('{"cassette"'):
+                        out.write(line)
+            os.remove(part)
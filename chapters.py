@@ -0,0 +1,225 @@
+import os
+import re
+import json
+from config import settings
+from manifest import page_fingerprint
+
+# How chapter boundaries were found
+OUTLINE = 'outline'    # PDF bookmarks
+HEADINGS = 'headings'  # "Chapter 3 ..." or "3 Acid-Base Balance" at the top of a page
+PAGES = 'pages'        # Neither: fixed page ranges of pages_per_section
+
+# Bump when the rules change so cached extractions are redone
+TOC_VERSION = 3
+
+MIN_CHAPTERS = 3   # Outline levels are added until there are this many chapters
+HEADING_LINES = 3  # Lines at the top of a page searched for a heading
+WORD_NUMBERS = ['one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten',
+                'eleven', 'twelve', 'thirteen', 'fourteen', 'fifteen', 'sixteen', 'seventeen', 'eighteen',
+                'nineteen', 'twenty']
+# "Chapter 3: Acid-Base Balance", "CHAPTER FOUR", "Part II Cardiovascular"
+CHAPTER_HEADING = re.compile(r'^(chapter|part|unit)\s+(\d{1,3}|[ivxlc]{1,7}|' + '|'.join(WORD_NUMBERS) +
+                             r')\b[\s.:\-–—]*(.*)$', re.IGNORECASE)
+# "3 Acid-Base Balance" or "3. Acid-Base Balance"
+NUMBERED_HEADING = re.compile(r'^(\d{1,2})\.?\s+([A-Z][A-Za-z][^.!?]{2,70})$')
+
+
+def _roman(text):
+    values = {'i': 1, 'v': 5, 'x': 10, 'l': 50, 'c': 100}
+    total = 0
+    for char, following in zip(text, text[1:] + ' '):
+        value = values[char]
+        total += -value if values.get(following, 0) > value else value
+    return total
+
+
+def heading_number(word):
+    """Chapter number from "3", "iv" or "four"."""
+    word = word.lower()
+    if word.isdigit():
+        return int(word)
+    if word in WORD_NUMBERS:
+        return WORD_NUMBERS.index(word) + 1
+    return _roman(word)
+
+
+def outline_entries(reader):
+    """PDF bookmarks as [{'title', 'page' (1-based), 'level'}], in document order."""
+    entries = []
+
+    def walk(items, level):
+        for item in items:
+            if isinstance(item, list):
+                walk(item, level + 1)
+                continue
+            try:
+                page = reader.get_destination_page_number(item)
+            except Exception:
+                continue  # Bookmark to an external or missing destination
+            if page is not None and page >= 0:
+                entries.append({'title': str(item.title).strip(), 'page': page + 1, 'level': level})
+
+    try:
+        walk(reader.outline, 0)
+    except Exception as e:
+        print(f"Could not read PDF outline: {str(e)}")
+    return entries
+
+
+def heading_entries(page_texts):
+    """Chapter headings found at the top of pages, as [{'title', 'page', 'level'}].
+
+    Numbers must follow on from the previous chapter, which skips running
+    headers that repeat a chapter's heading on every page.
+    """
+    entries = []
+    last_number = 0
+    for page_number, text in enumerate(page_texts, 1):
+        lines = [line.strip() for line in (text or "").splitlines() if line.strip()][:HEADING_LINES + 1]
+        for i, line in enumerate(lines[:HEADING_LINES]):
+            match = CHAPTER_HEADING.match(line)
+            if match:
+                number = heading_number(match.group(2))
+                title = match.group(3).strip() or (lines[i + 1] if i + 1 < len(lines) else "")
+                title = f"{match.group(1).title()} {match.group(2)}" + (f": {title}" if title else "")
+            else:
+                match = NUMBERED_HEADING.match(line)
+                if not match:
+                    continue
+                number = int(match.group(1))
+                title = line
+            if number == last_number + 1:
+                entries.append({'title': title[:100], 'page': page_number, 'level': 0})
+                last_number = number
+            break
+    return entries
+
+
+def _chapter_starts(entries):
+    """[(page, title)] from the outline levels down to the first that gives MIN_CHAPTERS chapters.
+
+    A book split into parts then uses the chapters nested in them, while
+    still breaking at each part.
+    """
+    starts = {}
+    for level in sorted({entry['level'] for entry in entries}):
+        for entry in entries:
+            if entry['level'] == level:
+                starts.setdefault(entry['page'], entry['title'])
+        if len(starts) >= MIN_CHAPTERS:
+            break
+    return sorted(starts.items()) if len(starts) >= 2 else []
+
+
+def content_parts(fingerprints, max_pages):
+    """Lengths of the parts a run of pages is split into, each at most max_pages.
+
+    A part ends after a page whose fingerprint marks a boundary (about one
+    page in max_pages / 4, after at least a quarter of max_pages), so the
+    boundaries depend on page content rather than page numbers. Inserting or
+    removing a page changes only the part it falls in; the others keep their
+    pages, so their text hashes still match the book's manifest.
+    """
+    min_pages = max(1, max_pages // 4)
+    divisor = max(1, max_pages // 4)
+    lengths = []
+    length = 0
+    for fingerprint in fingerprints:
+        length += 1
+        if length >= max_pages or (length >= min_pages and int(fingerprint, 16) % divisor == 0):
+            lengths.append(length)
+            length = 0
+    if length:
+        if lengths and length < min_pages and lengths[-1] + length <= max_pages:
+            lengths[-1] += length
+        else:
+            lengths.append(length)
+    return lengths
+
+
+def chapter_ranges(starts, total_pages, min_pages=None, max_pages=None, fingerprints=None):
+    """Turn [(start page, title)] into balanced [{'title', 'start_page', 'end_page'}].
+
+    Chapters shorter than min_pages are merged into the one before (the
+    first into the one after), and chapters longer than max_pages are split
+    into parts: at content-defined boundaries when the page fingerprints
+    are given (see content_parts), else into equal parts.
+    """
+    min_pages = settings.chapter_min_pages if min_pages is None else min_pages
+    max_pages = max_pages or settings.pages_per_section
+    if not starts or starts[0][0] > 1:
+        starts = [(1, "Front matter")] + list(starts)
+    chapters = [{'title': title, 'start_page': start, 'end_page': end - 1}
+                for (start, title), (end, _) in zip(starts, starts[1:] + [(total_pages + 1, None)])]
+
+    merged = []
+    for chapter in chapters:
+        if merged and chapter['end_page'] - chapter['start_page'] + 1 < min_pages:
+            merged[-1]['end_page'] = chapter['end_page']
+        elif merged and merged[-1]['end_page'] - merged[-1]['start_page'] + 1 < min_pages:
+            merged[-1].update(title=chapter['title'], end_page=chapter['end_page'])
+        else:
+            merged.append(dict(chapter))
+
+    balanced = []
+    for chapter in merged:
+        length = chapter['end_page'] - chapter['start_page'] + 1
+        if length <= max_pages:
+            lengths = [length]
+        elif fingerprints:
+            lengths = content_parts(fingerprints[chapter['start_page'] - 1:chapter['end_page']], max_pages)
+        else:
+            parts = -(-length // max_pages)
+            lengths = [(part + 1) * length // parts - part * length // parts for part in range(parts)]
+        start = chapter['start_page']
+        for part, part_length in enumerate(lengths):
+            title = chapter['title'] if len(lengths) == 1 else f"{chapter['title']} ({part + 1}/{len(lengths)})"
+            balanced.append({'title': title, 'start_page': start, 'end_page': start + part_length - 1})
+            start += part_length
+    return balanced
+
+
+class TableOfContents:
+    """Chapters of one PDF: the raw outline or headings they came from, and the page ranges used."""
+
+    def __init__(self, source=None):
+        self.source = source
+        self.method = PAGES
+        self.total_pages = 0
+        self.entries = []   # Raw outline or heading entries
+        self.chapters = []  # [{'title', 'start_page', 'end_page', 'characters'}], only those with text
+
+    def build(self, reader, page_texts, fingerprints=None):
+        """Find chapters from the outline, falling back to headings, then page ranges.
+
+        Long chapters and the page ranges are split where the page content
+        says (see content_parts), using the page fingerprints if already
+        computed.
+        """
+        self.total_pages = len(page_texts)
+        fingerprints = fingerprints or [page_fingerprint(page) for page in reader.pages]
+        finders = ((OUTLINE, lambda: outline_entries(reader)), (HEADINGS, lambda: heading_entries(page_texts)))
+        for method, find in finders:
+            entries = find()
+            starts = _chapter_starts(entries)
+            if starts:
+                self.method, self.entries = method, entries
+                return chapter_ranges(starts, self.total_pages, fingerprints=fingerprints)
+        ranges = chapter_ranges([(1, None)], self.total_pages, min_pages=0, fingerprints=fingerprints)
+        return [{**chapter, 'title': f"Pages {chapter['start_page']}-{chapter['end_page']}"} for chapter in ranges]
+
+    def _name(self):
+        return os.path.splitext(os.path.basename(self.source))[0]
+
+    def to_dict(self):
+        return {'source': self.source and os.path.basename(self.source), 'toc_version': TOC_VERSION,
+                'method': self.method, 'total_pages': self.total_pages, 'chapters': self.chapters}
+
+    def save(self):
+        """Write the raw entries to tocs_dir and the chapter ranges to processed_tocs_dir."""
+        os.makedirs(settings.processed_tocs_dir, exist_ok=True)
+        with open(os.path.join(settings.tocs_dir, f"{self._name()}.json"), 'w') as f:
+            json.dump({'source': os.path.basename(self.source), 'method': self.method, 'entries': self.entries},
+                      f, indent=2)
+        with open(os.path.join(settings.processed_tocs_dir, f"{self._name()}.json"), 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
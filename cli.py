@@ -0,0 +1,516 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from config import settings, PROFILES
+from metrics import metrics
+from profiler import profiler
+from providers import PROVIDERS
+
+# Exit codes for cron/batch schedulers
+EXIT_OK = 0
+EXIT_FAILURE = 1        # Nothing succeeded
+EXIT_USAGE = 2          # Bad arguments (argparse uses 2 as well)
+EXIT_PARTIAL = 3        # Some items failed
+EXIT_BUDGET = 4         # Time budget exhausted before the run finished
+EXIT_CONFIG = 5         # Missing API keys or input files
+EXIT_INTERRUPTED = 130  # Ctrl-C / SIGINT
+
+
+class ProgressReporter:
+    """Print progress either as JSON lines or as plain text."""
+
+    def __init__(self, fmt, stream):
+        self.fmt = fmt
+        self.stream = stream
+        self.start_time = time.time()
+
+    def emit(self, event, **data):
+        data = {'event': event, 'elapsed': round(time.time() - self.start_time, 2), **data}
+        if self.fmt == 'json':
+            self.stream.write(json.dumps(data) + "\n")
+        else:
+            details = " ".join(f"{k}={v}" for k, v in data.items() if k not in ('event', 'elapsed'))
+            self.stream.write(f"[{data['elapsed']:>8.1f}s] {event} {details}\n")
+        self.stream.flush()
+
+    def callback(self, item):
+        """Progress callback compatible with the main.py generation functions."""
+        def report(done, total, message=""):
+            self.emit('progress', item=item, done=done, total=total, message=message)
+        return report
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="cli.py",
+        description="Headless flashcard generation for batch and server runs."
+    )
+
+    run_options = argparse.ArgumentParser(add_help=False)
+    run_options.add_argument('--profile', choices=sorted(PROFILES), default=None,
+                             help="Performance profile (default: FLASHCARD_PROFILE or 'default')")
+    run_options.add_argument('--extract-workers', type=int, default=None,
+                             help="Processes used for PDF text extraction (0 = threads; default: from profile)")
+    run_options.add_argument('--concurrency', type=int, default=None,
+                             help="Maximum concurrent LLM requests (default: from profile)")
+    run_options.add_argument('--rate-limit', type=int, default=None,
+                             help="Maximum LLM requests per minute (0 = unlimited; default: from profile)")
+    run_options.add_argument('--provider', choices=sorted(PROVIDERS), default='gemini',
+                             help="Preferred provider; the others are used as fallback")
+    run_options.add_argument('--time-budget', type=float, default=None,
+                             help="Stop after this many seconds and exit with code %d" % EXIT_BUDGET)
+    run_options.add_argument('--format', choices=['json', 'text'], default='json', dest='output_format',
+                             help="Progress output format on stdout")
+    run_options.add_argument('--record', default=None, metavar='CASSETTE',
+                             help="Record every LLM request and response to this JSONL file")
+    run_options.add_argument('--replay', default=None, metavar='CASSETTE',
+                             help="Replay LLM responses from a recording instead of calling the APIs")
+    run_options.add_argument('--replay-speed', choices=['fast', 'realtime'], default=None,
+                             help="Replay at full speed (default) or with the recorded latencies")
+    run_options.add_argument('--profile-run', action='store_true',
+                             help="Profile the run: cProfile, a wall-clock flamegraph and CPU vs await time per "
+                                  "stage, written to Outputs/profiling/")
+    run_options.add_argument('--dry-run', action='store_true',
+                             help="Estimate requests, tokens and time without calling any LLM")
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    process = subparsers.add_parser('process', parents=[run_options],
+                                    help="Extract themes and generate flashcards for PDFs")
+    process.add_argument('pdfs', nargs='*', help="PDF files (default: every PDF in the input directory)")
+    process.add_argument('--jobs', type=int, default=None,
+                         help="Number of PDFs processed concurrently (default: from profile)")
+    process.add_argument('--full', action='store_true',
+                         help="Regenerate every chapter, not just those changed since the book was last processed")
+
+    generate = subparsers.add_parser('generate', parents=[run_options],
+                                     help="Generate more flashcards for a processed book")
+    generate.add_argument('book', help="Book name as listed in the themes directory")
+    generate.add_argument('--count', type=int, default=10, help="Number of cards to generate")
+    generate.add_argument('--theme', default=None, help="Theme to target (default: weighted random)")
+    generate.add_argument('--from-pool', action='store_true',
+                          help="Serve cards from the card pool, generating only the shortfall")
+
+    all_books = subparsers.add_parser('all-books', parents=[run_options],
+                                      help="Generate a mixed set of flashcards across all books")
+    all_books.add_argument('--count', type=int, default=10, help="Number of cards to generate")
+    all_books.add_argument('--from-pool', action='store_true',
+                           help="Serve cards from the card pool, generating only the shortfall")
+
+    pool = subparsers.add_parser('pool', parents=[run_options], help="Card pool maintenance")
+    pool.add_argument('action', choices=['stats', 'fill'],
+                      help="fill tops every reserve up to the high watermark, e.g. from an off-peak cron job")
+
+    enqueue = subparsers.add_parser('enqueue', help="Add PDFs to the shared work queue for worker processes")
+    enqueue.add_argument('pdfs', nargs='*', help="PDF files (default: every PDF in the input directory)")
+    enqueue.add_argument('--queue', default=None, help="Queue database (default: Outputs/queue.db)")
+    enqueue.add_argument('--format', choices=['json', 'text'], default='json', dest='output_format')
+
+    worker = subparsers.add_parser('worker', parents=[run_options],
+                                   help="Run queued jobs; start one or more on each host sharing the queue")
+    worker.add_argument('--queue', default=None, help="Queue database (default: Outputs/queue.db)")
+    worker.add_argument('--processes', type=int, default=1, help="Worker processes to start on this host")
+    worker.add_argument('--slots', type=int, default=None,
+                        help="Jobs each process runs at once (default: the LLM concurrency)")
+    worker.add_argument('--forever', action='store_true',
+                        help="Keep polling for new jobs instead of exiting when the queue is empty")
+
+    queue_command = subparsers.add_parser('queue', help="Work queue maintenance")
+    queue_command.add_argument('action', choices=['stats', 'dead', 'retry-dead'])
+    queue_command.add_argument('--queue', default=None, help="Queue database (default: Outputs/queue.db)")
+    queue_command.add_argument('--format', choices=['json', 'text'], default='json', dest='output_format')
+
+    export = subparsers.add_parser('export', help="Export saved flashcards as CSV, TSV or an Anki deck")
+    export.add_argument('--to', choices=['csv', 'tsv', 'anki'], default='csv', dest='export_format',
+                        help="Output format (anki: tab-separated file for Anki's File > Import)")
+    export.add_argument('--output', default=None, help="Output file (default: Outputs/exports/<name>_<time>)")
+    export.add_argument('--book', action='append', dest='books', help="Only this book (repeatable)")
+    export.add_argument('--theme', action='append', dest='themes', help="Only this theme (repeatable)")
+    export.add_argument('--since', default=None, help="Only cards added after this date/time (ISO format)")
+    export.add_argument('--until', default=None, help="Only cards added up to this date/time (ISO format)")
+    export.add_argument('--incremental', action='store_true',
+                        help="Only cards not written by an earlier incremental export with the same --name")
+    export.add_argument('--name', default=None, help="Export name for incremental state (default: the format)")
+    export.add_argument('--format', choices=['json', 'text'], default='json', dest='output_format')
+
+    cache = subparsers.add_parser('cache', help="Cache maintenance")
+    cache.add_argument('action', choices=['stats', 'clear', 'clear-expired'])
+    cache.add_argument('--format', choices=['json', 'text'], default='json', dest='output_format')
+
+    return parser
+
+
+def apply_settings(args):
+    """Apply --profile and explicit CLI flags on top of the loaded settings."""
+    if args.profile:
+        settings.apply_profile(args.profile)
+    settings.update(
+        max_concurrency=args.concurrency,
+        rate_limit=args.rate_limit,
+        extract_workers=args.extract_workers,
+        batch_size=getattr(args, 'jobs', None),
+        record_cassette=args.record,
+        replay_cassette=args.replay,
+        replay_realtime=args.replay_speed == 'realtime' if args.replay_speed else None,
+        profiling=True if args.profile_run else None,
+        incremental_reprocess=False if getattr(args, 'full', False) else None
+    )
+    if settings.replay_cassette:
+        if not os.path.exists(settings.replay_cassette):
+            raise ValueError(f"Cassette not found: {settings.replay_cassette}")
+        # Chapters kept from an earlier run would never reach the cassette
+        settings.update(incremental_reprocess=False)
+
+
+def create_model_handler(args):
+    """Create a ModelHandler from the configured keys and the preferred provider."""
+    from model_handler import ModelHandler
+
+    try:
+        return ModelHandler.from_env(settings.cache_dir, preferred_model=args.provider)
+    except ValueError:
+        return None
+
+
+def profile_session(name):
+    """A profiler session for the run when --profile-run (or PROFILING) is set, else a no-op."""
+    return profiler.session(name) if settings.profiling else contextlib.nullcontext({})
+
+
+async def run_items(items, reporter, concurrency):
+    """Run (name, coroutine factory) items with bounded concurrency.
+
+    Returns the number of succeeded and failed items.
+    """
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    succeeded = 0
+    failed = 0
+
+    async def run_one(name, make_coro):
+        nonlocal succeeded, failed
+        async with semaphore:
+            reporter.emit('item_start', item=name)
+            try:
+                result = await make_coro(reporter.callback(name))
+            except Exception as e:
+                failed += 1
+                reporter.emit('item_failed', item=name, error=str(e))
+                return
+            if result is not None:
+                succeeded += 1
+                reporter.emit('item_done', item=name, cards=len(result))
+            else:
+                failed += 1
+                reporter.emit('item_failed', item=name, error="No flashcards generated")
+
+    await asyncio.gather(*(run_one(name, make_coro) for name, make_coro in items))
+    return succeeded, failed
+
+
+def build_items(args, model_handler):
+    """Turn the parsed command into a list of (name, coroutine factory) items."""
+    import main
+
+    if args.command == 'process':
+        pdfs = args.pdfs or main.get_pdf_files()
+        return [
+            (os.path.basename(path),
+             lambda callback, path=path: main.process_pdf(path, model_handler, progress_callback=callback))
+            for path in pdfs
+        ]
+    if getattr(args, 'from_pool', False):
+        from card_pool import CardPool
+
+        card_pool = CardPool(model_handler)
+        book = args.book if args.command == 'generate' else None
+        theme = args.theme if args.command == 'generate' else None
+        return [(book or 'all-books', lambda callback: card_pool.serve(
+            args.count, book=book, theme=theme, progress_callback=callback))]
+    if args.command == 'pool':
+        from card_pool import CardPool
+
+        return [('pool', lambda callback: CardPool(model_handler).fill(progress_callback=callback))]
+    if args.command == 'generate':
+        if args.theme:
+            make_coro = lambda callback: main.generate_additional_flashcards(
+                args.book, args.theme, args.count, model_handler, progress_callback=callback)
+        else:
+            make_coro = lambda callback: main.generate_random_flashcards(
+                args.book, args.count, model_handler, progress_callback=callback)
+        return [(args.book, make_coro)]
+    if args.command == 'all-books':
+        return [('all-books', lambda callback: main.generate_random_flashcards_all_books(
+            args.count, model_handler, progress_callback=callback))]
+    return []
+
+
+def run_dry_run(args, reporter):
+    """Print a plan for the command without making any LLM calls."""
+    import main
+    import planner
+
+    main.ensure_directories()
+    if args.command == 'pool':
+        reporter.emit('error', message="--dry-run is not supported for pool commands")
+        return EXIT_USAGE
+    if args.command == 'process':
+        plan = planner.plan_process(args.pdfs or main.get_pdf_files())
+    elif args.command == 'generate':
+        plan = planner.plan_generate(args.book, args.count, args.theme)
+    else:
+        plan = planner.plan_all_books(args.count)
+
+    parallel_books = settings.batch_size if args.command == 'process' else 1
+    summary = plan.summary(parallel_books=parallel_books)
+    if args.output_format == 'json':
+        reporter.emit('plan', **summary)
+    else:
+        reporter.stream.write(planner.format_plan(summary))
+    return EXIT_OK if summary['books'] else EXIT_CONFIG
+
+
+async def run_command(args, reporter):
+    """Run a generation command and return its exit code."""
+    import main
+
+    model_handler = create_model_handler(args)
+    if model_handler is None:
+        reporter.emit('error', message="No LLM provider configured: set GEMINI_API_KEY, MISTRAL_API_KEY or LOCAL_LLM_URL")
+        return EXIT_CONFIG
+
+    main.ensure_directories()
+    main.set_extraction_workers(settings.extract_workers)
+
+    items = build_items(args, model_handler)
+    if not items:
+        reporter.emit('error', message="Nothing to do: no PDF files found")
+        return EXIT_CONFIG
+
+    concurrency = settings.batch_size if args.command == 'process' else 1
+    profile_paths = {}
+    try:
+        async with profile_session(args.command) as profile_paths:
+            succeeded, failed = await asyncio.wait_for(
+                run_items(items, reporter, concurrency), timeout=args.time_budget
+            )
+    except asyncio.TimeoutError:
+        reporter.emit('budget_exhausted', time_budget=args.time_budget)
+        return EXIT_BUDGET
+    finally:
+        main.set_extraction_workers(0)
+        await model_handler.close()
+        json_path, prom_path = metrics.export(settings.metrics_dir, args.command)
+        reporter.emit('metrics', summary=json_path, prometheus=prom_path)
+        if profile_paths:
+            reporter.emit('profile', **profile_paths)
+
+    reporter.emit('summary', succeeded=succeeded, failed=failed)
+    if failed == 0:
+        return EXIT_OK
+    return EXIT_PARTIAL if succeeded else EXIT_FAILURE
+
+
+def run_pool_stats(reporter):
+    """Report the card pool reserve per book and theme."""
+    import main
+    from card_pool import CardPool
+
+    main.ensure_directories()
+    for book, themes in CardPool(None).stats().items():
+        reporter.emit('pool', book=book, cards=sum(themes.values()), themes=themes)
+    return EXIT_OK
+
+
+def run_enqueue_command(args, reporter):
+    """Queue every PDF's first stage for the workers and return the exit code."""
+    import main
+    from work_queue import WorkQueue, enqueue_pdfs
+
+    main.ensure_directories()
+    pdfs = args.pdfs or main.get_pdf_files()
+    if not pdfs:
+        reporter.emit('error', message="Nothing to do: no PDF files found")
+        return EXIT_CONFIG
+    added = enqueue_pdfs(WorkQueue(args.queue), pdfs)
+    reporter.emit('enqueue', added=added, already_queued=len(pdfs) - added)
+    return EXIT_OK
+
+
+def run_queue_command(args, reporter):
+    """Report or requeue work queue jobs and return the exit code."""
+    import main
+    from work_queue import WorkQueue, DEAD
+
+    main.ensure_directories()
+    queue = WorkQueue(args.queue)
+    if args.action == 'retry-dead':
+        reporter.emit('queue', action=args.action, requeued=queue.retry_dead())
+    elif args.action == 'dead':
+        for job in queue.jobs(DEAD):
+            reporter.emit('dead', book=job['book'], stage=job['stage'], theme=job['theme'],
+                          attempts=job['attempts'], error=job['error'])
+    else:
+        reporter.emit('queue', action=args.action, pending=queue.pending(), stages=queue.stats())
+    return EXIT_OK
+
+
+def _without_option(argv, option):
+    """argv with `option VALUE` or `option=VALUE` removed."""
+    result = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + '='):
+            result.append(arg)
+    return result
+
+
+def run_worker_processes(args, argv, reporter):
+    """Start --processes single-process workers and wait for them. Returns the exit code."""
+    import subprocess
+
+    command = [sys.executable, os.path.abspath(__file__)] + _without_option(argv, '--processes')
+    # Each worker records to its own cassette, joined into the requested one when they finish
+    cassette = settings.record_cassette
+    parts = [f"{cassette}.worker{index}" for index in range(args.processes)] if cassette else []
+    if cassette:
+        command = _without_option(command, '--record')
+    children = []
+    for index in range(args.processes):
+        env = {**os.environ, 'RECORD_CASSETTE': parts[index]} if cassette else None
+        # Workers write their own progress lines straight to our stdout
+        children.append(subprocess.Popen(command, stdout=reporter.stream, env=env))
+    reporter.emit('workers_started', processes=args.processes, pids=[child.pid for child in children])
+    try:
+        codes = [child.wait() for child in children]
+    except KeyboardInterrupt:
+        for child in children:
+            child.wait()
+        raise
+    finally:
+        if cassette:
+            from cassette import merge_cassettes
+            merge_cassettes(parts, cassette)
+    reporter.emit('workers_finished', exit_codes=codes)
+    if all(code == EXIT_OK for code in codes):
+        return EXIT_OK
+    return EXIT_PARTIAL if EXIT_OK in codes or EXIT_PARTIAL in codes else max(codes)
+
+
+async def run_worker(args, reporter):
+    """Run queued jobs in this process and return the exit code."""
+    import main
+    from work_queue import WorkQueue, Worker, worker_id
+
+    model_handler = create_model_handler(args)
+    if model_handler is None:
+        reporter.emit('error', message="No LLM provider configured: set GEMINI_API_KEY, MISTRAL_API_KEY or LOCAL_LLM_URL")
+        return EXIT_CONFIG
+
+    main.ensure_directories()
+    main.set_extraction_workers(settings.extract_workers)
+    owner = worker_id()
+    worker = Worker(WorkQueue(args.queue), model_handler, owner=owner,
+                    slots=args.slots or settings.max_concurrency,
+                    on_event=lambda event, **data: reporter.emit(event, worker=owner, **data))
+    profile_paths = {}
+    try:
+        async with profile_session(f"worker_{os.getpid()}") as profile_paths:
+            await asyncio.wait_for(worker.run(until_empty=not args.forever), timeout=args.time_budget)
+    except asyncio.TimeoutError:
+        reporter.emit('budget_exhausted', time_budget=args.time_budget)
+        return EXIT_BUDGET
+    finally:
+        main.set_extraction_workers(0)
+        await model_handler.close()
+        json_path, prom_path = metrics.export(settings.metrics_dir, f"worker_{os.getpid()}")
+        reporter.emit('metrics', worker=owner, summary=json_path, prometheus=prom_path)
+        if profile_paths:
+            reporter.emit('profile', worker=owner, **profile_paths)
+
+    reporter.emit('summary', worker=owner, completed=worker.completed, retried=worker.retried, dead=worker.dead)
+    if worker.dead:
+        return EXIT_PARTIAL if worker.completed else EXIT_FAILURE
+    return EXIT_OK
+
+
+def run_export_command(args, reporter):
+    """Stream saved flashcards to an export file and return the exit code."""
+    import main
+    from exporters import export_cards
+
+    main.ensure_directories()
+    path, count = export_cards(args.export_format, path=args.output, books=args.books, themes=args.themes,
+                               since=args.since, until=args.until, incremental=args.incremental,
+                               name=args.name)
+    reporter.emit('export', format=args.export_format, path=path, cards=count)
+    return EXIT_OK
+
+
+def run_cache_command(args, reporter):
+    """Run a cache maintenance action and return its exit code."""
+    from cache_handler import CacheHandler
+
+    cache_handler = CacheHandler(settings.cache_dir)
+    before = cache_handler.stats()
+    if args.action == 'clear':
+        cache_handler.clear()
+    elif args.action == 'clear-expired':
+        cache_handler.clear_expired()
+    after = cache_handler.stats()
+    reporter.emit('cache', action=args.action, entries=after['entries'], size_mb=after['size_mb'],
+                  removed=before['entries'] - after['entries'])
+    return EXIT_OK
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+
+    # Progress goes to stdout; chatty print() output from the pipeline goes to stderr
+    # so stdout stays machine-readable.
+    reporter = ProgressReporter(args.output_format, sys.stdout)
+    redirect = contextlib.redirect_stdout(sys.stderr) if args.output_format == 'json' else contextlib.nullcontext()
+
+    with redirect:
+        if args.command == 'cache':
+            return run_cache_command(args, reporter)
+        if args.command == 'export':
+            return run_export_command(args, reporter)
+        if args.command == 'enqueue':
+            return run_enqueue_command(args, reporter)
+        if args.command == 'queue':
+            return run_queue_command(args, reporter)
+        try:
+            apply_settings(args)
+        except ValueError as e:
+            reporter.emit('error', message=str(e))
+            return EXIT_USAGE
+        if args.command == 'pool' and args.action == 'stats':
+            return run_pool_stats(reporter)
+        if args.dry_run:
+            if args.command == 'worker':
+                reporter.emit('error', message="--dry-run is not supported for workers")
+                return EXIT_USAGE
+            return run_dry_run(args, reporter)
+        if args.command == 'worker' and args.processes > 1:
+            return run_worker_processes(args, sys.argv[1:] if argv is None else argv, reporter)
+        reporter.emit('start', command=args.command, profile=settings.profile)
+        try:
+            exit_code = asyncio.run(run_worker(args, reporter) if args.command == 'worker'
+                                    else run_command(args, reporter))
+        except KeyboardInterrupt:
+            reporter.emit('interrupted')
+            return EXIT_INTERRUPTED
+        reporter.emit('finish', exit_code=exit_code)
+        return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,100 +1,320 @@
 import os
-from dotenv import load_dotenv
+import re
+import copy
+from dataclasses import dataclass, field, fields
+from dotenv import dotenv_values
 
-# Load environment variables
-load_dotenv()
-
-# Directory Configuration
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-INPUT_DIR = os.getenv('PDF_INPUT_DIR', 'pdfInput')
-OUTPUT_DIR = os.getenv('OUTPUT_DIR', 'Outputs')
-FLASHCARDS_DIR = os.path.join(OUTPUT_DIR, 'flashcards')
-THEMES_DIR = os.path.join(OUTPUT_DIR, 'themes')
-CACHE_DIR = os.path.join(OUTPUT_DIR, 'cache')
-CSV_OUTPUT_DIR = os.path.join(OUTPUT_DIR, "csv_output")
-
-# Create all necessary directories
-for directory in [INPUT_DIR, OUTPUT_DIR, FLASHCARDS_DIR, THEMES_DIR, CACHE_DIR, CSV_OUTPUT_DIR]:
-    os.makedirs(directory, exist_ok=True)
-
-# PDF Processing Configuration
-MAX_FILE_SIZE_MB = 50  # Maximum file size to process at once
-PAGES_PER_SECTION = 100  # Number of pages to process at once
-MAX_SECTIONS = 10  # Maximum number of sections to process
-SECTION_OVERLAP = 5  # Number of pages to overlap between sections
-
-# Error Handling
-MAX_ERRORS_PER_FILE = 3  # Maximum errors before skipping file
-ERROR_COOLDOWN = 90  # Seconds to wait after error
-MAX_PROCESSING_TIME = 7200  # 2 hours maximum processing time per file
-
-# Cache Configuration
-CACHE_EXPIRY = 24 * 60 * 60  # 24 hours cache expiry
-
-# API Configuration
-GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
-GEMINI_RATE_LIMIT = int(os.getenv('GEMINI_RATE_LIMIT', '25'))  # Maximum requests per minute
-GEMINI_RETRY_DELAY = int(os.getenv('GEMINI_RETRY_DELAY', '70'))  # Seconds to wait when rate limited
-
-# Content Processing
-MAX_CHUNK_SIZE = 600  # Characters per chunk for API calls
-MIN_CHUNK_SIZE = 200  # Minimum chunk size for API calls
-BATCH_SIZE = 2  # Number of chunks to process at once
-CARDS_PER_CHUNK = 2  # Number of flashcards to generate per chunk
-
-# Theme Configuration
-MIN_THEME_SIMILARITY = 0.2  # Minimum similarity for theme matching
-MAX_THEMES = 15            # Maximum number of themes per section
-MIN_THEME_LENGTH = 5       # Minimum characters in a theme
-MAX_THEME_LENGTH = 100     # Maximum characters in a theme
-
-# Error Handling
-ERROR_COOLDOWN = 90        # Seconds to wait after error
-MAX_PROCESSING_TIME = 7200  # Increased to 2 hours for large files
-
-# Cache Configuration
-CACHE_EXPIRY = 7 * 24 * 60 * 60  # Cache entries expire after 7 days
-
-# File Structure Configuration
-EXTRACTED_CONTENT_DIR = os.path.join(OUTPUT_DIR, "extracted_content")
-TEXTS_DIR = os.path.join(EXTRACTED_CONTENT_DIR, "texts")
-TOCS_DIR = os.path.join(EXTRACTED_CONTENT_DIR, "tocs")
-PROCESSED_TOCS_DIR = os.path.join(TOCS_DIR, "processed")
-
-# Create directories if they don't exist
-for directory in [EXTRACTED_CONTENT_DIR, TEXTS_DIR, TOCS_DIR, PROCESSED_TOCS_DIR]:
-    os.makedirs(directory, exist_ok=True)
-
-# Processing Configuration
-MAX_CHUNK_SIZE = 600    # Reduced for more focused content
-MIN_CHUNK_SIZE = 200    # Reduced to allow more granular chunks
-BATCH_SIZE = 2         # Reduced to minimize API rate limit issues
-MAX_RETRIES = 5        # Keep retries at 5
-MAX_FILE_SIZE_MB = 50  # Maximum file size to process at once
-
-# Flashcard Generation Configuration
-CARDS_PER_CHUNK = 2     # Keep at 2 for quality
-MIN_THEME_SIMILARITY = 0.2  # Increased for better matching
-
-# Cache Configuration
-USE_CACHE = True
-CACHE_EXPIRY = 24 * 60 * 60  # 24 hours
-
-# Theme Analysis Configuration
-MAX_THEMES = 15        # Increased slightly for better coverage
-MIN_THEME_LENGTH = 10  # Keep minimum length
-MAX_THEME_LENGTH = 80  # Reduced maximum length for cleaner themes
-MIN_THEME_WORDS = 2    # Minimum words in a theme
-MAX_THEME_WORDS = 6    # Maximum words in a theme
-MIN_CONTENT_WORDS = 20 # Minimum words in section content
-
-# Content Validation Configuration
-MIN_SECTION_SIMILARITY = 0.5  # Minimum similarity between header and content
-MAX_PROPER_NOUN_RATIO = 0.8  # Maximum ratio of proper nouns in theme
-MIN_MEANINGFUL_WORDS = 1     # Minimum meaningful words in theme
-
-# Performance Configuration
-CHUNK_OVERLAP = 50          # Words to overlap between chunks
-SAVE_INTERVAL = 5           # Save progress every N successful chunks
-PROGRESS_UPDATE = 10        # Print progress every N chunks
-MAX_CACHE_SIZE_MB = 100     # Maximum cache size in MB 
\ No newline at end of file
+
+HOUR = 60 * 60
+DAY = 24 * HOUR
+
+
+def _env(name):
+    """Environment variable that overrides a setting, if not its upper-cased field name."""
+    return {'env': name}
+
+
+@dataclass
+class Settings:
+    """All runtime settings, validated. Modules read the shared `settings` instance."""
+    profile: str = field(default='default', metadata=_env('FLASHCARD_PROFILE'))
+
+    # Directories
+    input_dir: str = field(default='pdfInput', metadata=_env('PDF_INPUT_DIR'))
+    output_dir: str = 'Outputs'
+
+    # API keys and providers
+    gemini_api_key: str = None
+    mistral_api_key: str = None
+    local_llm_url: str = None  # Local OpenAI-compatible server, e.g. http://localhost:8000/v1
+    local_llm_model: str = 'local-model'
+    local_llm_api_key: str = None
+    llm_providers: tuple = ('gemini', 'mistral', 'local')  # Fallback order; providers without credentials are skipped
+
+    # Throughput (set together by performance profiles)
+    max_concurrency: int = 4  # Concurrent LLM requests
+    rate_limit: int = field(default=25, metadata=_env('GEMINI_RATE_LIMIT'))  # LLM requests per minute, 0 = unlimited
+    batch_size: int = 2  # Books processed at once
+    extract_workers: int = 0  # Processes used for PDF text extraction, 0 = threads
+    http_max_connections: int = 10  # Per provider
+    http_timeout: int = 120  # Seconds per request
+    http_keepalive_timeout: int = 30  # Seconds idle before closing
+
+    # Request scheduling (see scheduler.py): shares of the LLM slots when several classes are waiting
+    interactive_weight: int = 8  # GUI "Generate Cards"
+    normal_weight: int = 4  # Processing books, CLI runs
+    background_weight: int = 1  # Card pool refills
+    priority_aging_seconds: float = 30  # A waiting request moves up one class per this many seconds, 0 = never
+
+    # Record/replay of LLM traffic (cassettes), for reproducing runs offline
+    record_cassette: str = ''  # Record every provider call to this JSONL file
+    replay_cassette: str = ''  # Serve provider calls from this recording instead of the network
+    replay_realtime: bool = False  # Replay with the recorded latencies instead of at full speed
+
+    # Profiling (see profiler.py)
+    profiling: bool = False  # Write a cProfile, wall-clock flamegraph and per-stage CPU/await table for each run
+    profile_sample_interval: float = 0.005  # Seconds between wall-clock stack samples
+
+    # Error handling
+    max_retries: int = 3  # Attempts per LLM request
+    retry_delay: int = field(default=30, metadata=_env('GEMINI_RETRY_DELAY'))  # Seconds to wait before retrying
+    error_threshold: int = 3  # Consecutive errors before switching provider
+    error_cooldown: int = 60  # Seconds before switching provider again
+
+    # Cache
+    use_cache: bool = True
+    cache_expiry: int = DAY
+
+    # PDF processing
+    pages_per_section: int = 100  # Longest chapter processed as one unit; longer ones are split
+    chapter_min_pages: int = 8  # Shorter chapters are merged into the one before
+    skip_low_value_pages: bool = True  # Drop front matter, TOC, index and blank pages before prompting
+    min_page_chars: int = 150  # Pages with fewer non-space characters count as blank
+    incremental_reprocess: bool = True  # Reprocessing a book keeps the cards of chapters whose text is unchanged
+    output_coalesce_seconds: float = 0.2  # Saves of the same output file within this window are written once
+
+    # Card pool: pre-generated cards per book and theme
+    pool_refill: bool = True  # Refill reserves in the background while the GUI runs
+    pool_low_watermark: int = 3  # Refill right away below this many cards
+    pool_high_watermark: int = 10  # Top up to this many cards while idle
+    pool_refill_batch: int = 5  # Cards per refill request
+    pool_refill_hours: str = ''  # Off-peak top-up window(s), e.g. "22-7"; empty = whenever idle
+    pool_refill_interval: int = 30  # Seconds between checks for reserves to refill
+
+    # Work queue shared by worker processes and hosts (see work_queue.py)
+    queue_lease_seconds: int = 300  # A job is handed to another worker if not renewed within this
+    queue_max_attempts: int = 3  # Attempts before a job is dead-lettered
+    queue_retry_delay: int = 60  # Seconds before a failed job is retried, times the attempt number
+    queue_poll_interval: float = 5  # Seconds between checks while waiting for work
+
+    def __post_init__(self):
+        self._env_values = {}  # Set from the environment, wins over profiles
+        self._overrides = {}   # Set through update(), e.g. CLI flags
+
+    # Derived directories
+    @property
+    def flashcards_dir(self):
+        return os.path.join(self.output_dir, 'flashcards')
+
+    @property
+    def themes_dir(self):
+        return os.path.join(self.output_dir, 'themes')
+
+    @property
+    def cache_dir(self):
+        return os.path.join(self.output_dir, 'cache')
+
+    @property
+    def csv_output_dir(self):
+        return os.path.join(self.output_dir, 'csv_output')
+
+    @property
+    def metrics_dir(self):
+        return os.path.join(self.output_dir, 'metrics')
+
+    @property
+    def exports_dir(self):
+        return os.path.join(self.output_dir, 'exports')
+
+    @property
+    def profiling_dir(self):
+        return os.path.join(self.output_dir, 'profiling')
+
+    @property
+    def manifests_dir(self):
+        return os.path.join(self.output_dir, 'manifests')
+
+    @property
+    def pool_dir(self):
+        return os.path.join(self.output_dir, 'pool')
+
+    @property
+    def queue_path(self):
+        return os.path.join(self.output_dir, 'queue.db')
+
+    @property
+    def extracted_content_dir(self):
+        return os.path.join(self.output_dir, 'extracted_content')
+
+    @property
+    def texts_dir(self):
+        return os.path.join(self.extracted_content_dir, 'texts')
+
+    @property
+    def pages_dir(self):
+        return os.path.join(self.extracted_content_dir, 'pages')
+
+    @property
+    def tocs_dir(self):
+        return os.path.join(self.extracted_content_dir, 'tocs')
+
+    @property
+    def processed_tocs_dir(self):
+        return os.path.join(self.tocs_dir, 'processed')
+
+    def validate(self):
+        """Raise ValueError listing every invalid setting."""
+        errors = []
+        if self.profile not in PROFILES:
+            errors.append(f"profile must be one of {sorted(PROFILES)}, got '{self.profile}'")
+        invalid = set()  # Reported once; the checks below skip them
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if f.type not in (int, float):
+                continue
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                errors.append(f"{f.name} must be a number, got {value!r}")
+            elif f.name in AT_LEAST_ONE and value < 1:
+                errors.append(f"{f.name} must be at least 1, got {value}")
+            elif value < 0:
+                errors.append(f"{f.name} must not be negative, got {value}")
+            else:
+                continue
+            invalid.add(f.name)
+
+        if 'profile_sample_interval' not in invalid and self.profile_sample_interval < 0.001:
+            errors.append("profile_sample_interval must be at least 0.001 seconds")
+        low, high = 'pool_low_watermark', 'pool_high_watermark'
+        if not invalid & {low, high} and getattr(self, low) > getattr(self, high):
+            errors.append(f"{low} ({getattr(self, low)}) is greater than {high} ({getattr(self, high)})")
+        if self.record_cassette and self.replay_cassette:
+            errors.append("record_cassette and replay_cassette cannot both be set")
+        if self.pool_refill_hours and not re.fullmatch(r'\d{1,2}(-\d{1,2})?(,\d{1,2}(-\d{1,2})?)*',
+                                                        self.pool_refill_hours.replace(' ', '')):
+            errors.append(f"pool_refill_hours must look like \"22-7\" or \"0-6,13-14\", got '{self.pool_refill_hours}'")
+        if errors:
+            raise ValueError("Invalid configuration: " + "; ".join(errors))
+
+    def values(self):
+        """Current settings as a dict."""
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def _assign(self, values):
+        """Validate the combined values first, then apply them all."""
+        candidate = Settings(**{**self.values(), **values})
+        candidate.validate()
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def apply_profile(self, name):
+        """Switch performance profile in place. Environment and update() values still win."""
+        if name not in PROFILES:
+            raise ValueError(f"Unknown profile '{name}', expected one of {sorted(PROFILES)}")
+        defaults = {f.name: f.default for f in fields(self)}
+        self._assign({**defaults, **PROFILES[name], **self._env_values, **self._overrides, 'profile': name})
+        return self
+
+    def update(self, **values):
+        """Override settings in place, e.g. from CLI flags. None values are ignored."""
+        values = {k: _coerce(self._field(k), v) for k, v in values.items() if v is not None}
+        self._assign(values)
+        self._overrides.update(values)
+        return self
+
+    def copy(self, **values):
+        """Independent copy, unaffected by later profile switches of the original."""
+        clone = copy.copy(self)
+        clone._env_values = dict(self._env_values)
+        clone._overrides = dict(self._overrides)
+        return clone.update(**values)
+
+    @classmethod
+    def _field(cls, name):
+        for f in fields(cls):
+            if f.name == name:
+                return f
+        raise ValueError(f"Unknown setting '{name}'")
+
+
+# Numeric settings that must be at least 1
+AT_LEAST_ONE = ('max_concurrency', 'batch_size', 'max_retries', 'http_max_connections', 'http_timeout',
+                'pool_refill_batch', 'queue_lease_seconds', 'queue_max_attempts',
+                'interactive_weight', 'normal_weight', 'background_weight')
+
+
+# Performance profiles: concurrency, rate limits, batch sizes and cache policy, set together.
+PROFILES = {
+    # Built-in defaults
+    'default': {},
+    # Free API quota: few requests per minute, long back-off, reuse cached responses for a week
+    'free-tier': {
+        'max_concurrency': 2, 'rate_limit': 15, 'batch_size': 1, 'extract_workers': 0,
+        'max_retries': 5, 'retry_delay': 70, 'error_cooldown': 90,
+        'http_max_connections': 4, 'use_cache': True, 'cache_expiry': 7 * DAY,
+    },
+    # Paid quota: many parallel requests and books, short back-off
+    'high-throughput': {
+        'max_concurrency': 16, 'rate_limit': 1000, 'batch_size': 4, 'extract_workers': 4,
+        'max_retries': 3, 'retry_delay': 10, 'error_cooldown': 30,
+        'http_max_connections': 32, 'use_cache': True, 'cache_expiry': DAY,
+    },
+    # Local stand-in provider: no quota, no back-off
+    'offline-benchmark': {
+        'max_concurrency': 8, 'rate_limit': 0, 'batch_size': 2, 'extract_workers': 0,
+        'max_retries': 3, 'retry_delay': 0, 'error_cooldown': 0,
+        'http_max_connections': 8, 'use_cache': True, 'cache_expiry': DAY,
+    },
+}
+
+
+def _coerce(f, value):
+    """Convert an environment string to the setting's type."""
+    if not isinstance(value, str):
+        return tuple(value) if f.type is tuple else value
+    value = value.strip()
+    try:
+        if f.type is bool:
+            if value.lower() not in ('1', 'true', 'yes', 'on', '0', 'false', 'no', 'off'):
+                raise ValueError
+            return value.lower() in ('1', 'true', 'yes', 'on')
+        if f.type is int:
+            return int(value)
+        if f.type is float:
+            return float(value)
+    except ValueError:
+        raise ValueError(f"Invalid configuration: {f.name} must be {f.type.__name__}, got '{value}'")
+    if f.type is tuple:
+        return tuple(item.strip() for item in value.split(',') if item.strip())
+    return value
+
+
+def _env_values(env):
+    values = {}
+    for f in fields(Settings):
+        raw = env.get(f.metadata.get('env', f.name.upper()))
+        if raw is not None and raw.strip() != '':
+            values[f.name] = _coerce(f, raw)
+    return values
+
+
+def load_settings(profile=None, env=None):
+    """Build validated settings: defaults < profile < environment.
+
+    The environment falls back to a .env file. Reading the file with
+    dotenv_values leaves os.environ untouched, so loading has no side effects.
+    This is the only place .env is read; entry points do not call load_dotenv,
+    and code reads configuration from settings, never from os.environ.
+    """
+    if env is None:
+        env = {**dotenv_values(), **os.environ}
+    values = _env_values(env)
+    profile = profile or values.pop('profile', 'default')
+    values.pop('profile', None)
+
+    loaded = Settings()
+    loaded._env_values = values
+    return loaded.apply_profile(profile)
+
+
+# Loaded once; switch profiles with settings.apply_profile() rather than rebinding
+settings = load_settings()
+
+
+def ensure_directories():
+    """Create all input and output directories. Called by entry points, not at import."""
+    for directory in [settings.input_dir, settings.output_dir, settings.flashcards_dir, settings.themes_dir,
+                      settings.cache_dir, settings.csv_output_dir, settings.exports_dir, settings.pool_dir, settings.extracted_content_dir,
+                      settings.texts_dir, settings.pages_dir, settings.tocs_dir, settings.processed_tocs_dir,
+                      settings.manifests_dir]:
+        os.makedirs(directory, exist_ok=True)
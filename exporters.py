@@ -0,0 +1,241 @@
+import os
+import csv
+import json
+import html
+from datetime import datetime
+from config import settings
+from cache_handler import stable_hash
+from output_writer import output_writer
+
+EXPORT_FORMATS = {'csv': '.csv', 'tsv': '.tsv', 'anki': '.txt'}
+TABLE_COLUMNS = ['book', 'theme', 'question', 'option_a', 'option_b', 'option_c', 'option_d',
+                 'correct', 'explanation', 'created_at']
+READ_CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_array(path, chunk_size=READ_CHUNK_SIZE):
+    """Yield the items of a JSON array file one at a time, in constant memory."""
+    decoder = json.JSONDecoder()
+    with open(path, 'r', encoding='utf-8') as f:
+        buffer = ''
+        eof = False
+        started = False
+
+        def fill():
+            nonlocal buffer, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer += chunk
+
+        while True:
+            buffer = buffer.lstrip(' \t\r\n,' if started else ' \t\r\n')
+            if not buffer:
+                if eof:
+                    raise ValueError(f"{path}: unexpected end of JSON array")
+                fill()
+                continue
+            if not started:
+                if buffer[0] != '[':
+                    raise ValueError(f"{path}: not a JSON array")
+                buffer = buffer[1:]
+                started = True
+                continue
+            if buffer[0] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                fill()
+                continue
+            if end == len(buffer) and not eof:
+                fill()  # A number may continue in the next chunk
+                continue
+            buffer = buffer[end:]
+            yield item
+
+
+def sorted_options(card):
+    """Correct and wrong answers in letter order."""
+    return sorted([card['correct_answer']] + card['wrong_answers'], key=lambda x: x[0])
+
+
+def write_readable(f, cards, title=None, start=1, show_source=False):
+    """Write cards as numbered plain text, the format of the csv_output .txt files."""
+    if title:
+        f.write(f"{title}\n")
+        f.write("=" * 50 + "\n\n")
+
+    for i, q in enumerate(cards, start):
+        source = f" (from {q['source']})" if show_source and 'source' in q else ""
+        f.write(f"Question {i}{source}:\n")
+        f.write(f"{q['question']}\n\n")
+        f.write("Options:\n")
+        for ans in sorted_options(q):
+            f.write(f"{ans}\n")
+        f.write(f"\nCorrect Answer: {q['correct_answer']}\n")
+        if 'explanation' in q:
+            f.write(f"\nExplanation: {q['explanation']}\n")
+        f.write("\n" + "-"*50 + "\n\n")
+
+
+def _end_of_day(date):
+    return f"{date}T23:59:59.999999" if len(date) == 10 else date
+
+
+def iter_cards(books=None, themes=None, since=None, until=None):
+    """Yield (book, card) from each book's flashcards file, filtered as they are read.
+
+    since/until are ISO dates or timestamps compared with the card's
+    created_at; cards saved before created_at was recorded only match
+    when no since is given.
+    """
+    until = _end_of_day(until) if until else None
+    for filename in sorted(os.listdir(settings.flashcards_dir)):
+        # Mixed sets are copies of cards already saved with their books
+        if not filename.endswith('.json') or filename.startswith('mixed_cards_'):
+            continue
+        book = filename[:-len('.json')]
+        if books and book not in books:
+            continue
+        for card in iter_json_array(os.path.join(settings.flashcards_dir, filename)):
+            if themes and card.get('theme') not in themes:
+                continue
+            created_at = card.get('created_at')
+            if since and (not created_at or created_at <= since):
+                continue
+            if until and created_at and created_at > until:
+                continue
+            yield book, card
+
+
+def table_row(book, card):
+    options = sorted_options(card) + [''] * 4
+    return [book, card.get('theme', ''), card['question'], *options[:4],
+            card['correct_answer'][:1], card.get('explanation', ''), card.get('created_at', '')]
+
+
+def _anki_tag(text):
+    return "".join(c if c.isalnum() else '_' for c in text).strip('_')
+
+
+def anki_row(book, card):
+    """Front, Back, Deck and Tags columns of an Anki note."""
+    front = html.escape(card['question']) + "<br><br>" + "<br>".join(html.escape(o) for o in sorted_options(card))
+    back = "<b>" + html.escape(card['correct_answer']) + "</b>"
+    if card.get('explanation'):
+        back += "<br><br>" + html.escape(card['explanation'])
+    tags = " ".join(tag for tag in (_anki_tag(book), _anki_tag(card.get('theme', ''))) if tag)
+    return [front, back, f"Flashcards::{book}", tags]
+
+
+def write_cards(f, cards, fmt):
+    """Write (book, card) pairs as CSV, TSV or an Anki text import. Returns the number written."""
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format '{fmt}', expected one of {sorted(EXPORT_FORMATS)}")
+    writer = csv.writer(f, delimiter=',' if fmt == 'csv' else '\t')
+    if fmt == 'anki':
+        # Header lines understood by Anki's File > Import (2.1.55+)
+        f.write("#separator:tab\n#html:true\n#notetype:Basic\n#deck column:3\n#tags column:4\n")
+        render = anki_row
+    else:
+        writer.writerow(TABLE_COLUMNS)
+        render = table_row
+
+    count = 0
+    for book, card in cards:
+        writer.writerow(render(book, card))
+        count += 1
+    return count
+
+
+# Incremental export state ----------------------------------------------------
+
+def _state_path():
+    return os.path.join(settings.exports_dir, "export_state.json")
+
+
+def _exported_path(name):
+    return os.path.join(settings.exports_dir, f"{name}_exported.txt")
+
+
+def card_key(book, card):
+    """Identity of a saved card, recorded for each card an incremental export has written."""
+    return stable_hash(f"{book}|{card.get('question', '')}|{card.get('correct_answer', '')}")
+
+
+def load_export_state():
+    """{export name: {'exported_at', 'cards', 'path'}}"""
+    if not os.path.exists(_state_path()):
+        return {}
+    with open(_state_path(), 'r') as f:
+        return json.load(f)
+
+
+def _save_export_state(state):
+    tmp_path = _state_path() + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, _state_path())
+
+
+def load_exported(name):
+    """Keys of the cards already written by incremental exports under name."""
+    if not os.path.exists(_exported_path(name)):
+        return set()
+    with open(_exported_path(name), 'r') as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def default_export_path(fmt, name=None):
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    return os.path.join(settings.exports_dir, f"{name or 'flashcards'}_{timestamp}{EXPORT_FORMATS[fmt]}")
+
+
+def export_cards(fmt='csv', path=None, books=None, themes=None, since=None, until=None,
+                 incremental=False, name=None):
+    """Stream matching cards to a CSV, TSV or Anki file.
+
+    With incremental=True only cards not written by an earlier incremental
+    export under the same name (default: the format) are written. Cards
+    are tracked by key rather than by created_at, since a card can be
+    saved well after it was stamped (a book's cards are saved when the
+    book finishes). Returns the output path and the number of cards written.
+    """
+    os.makedirs(settings.exports_dir, exist_ok=True)
+    name = name or fmt
+    path = path or default_export_path(fmt, name)
+    # Cards queued for writing in this process are included
+    output_writer.flush()
+    state = load_export_state()
+    exported = load_exported(name) if incremental else set()
+    # Exports from before keys were recorded: cards up to their created_at mark count as exported
+    legacy_mark = state.get(name, {}).get('last_created_at') if incremental and not exported else None
+    new_keys = []
+
+    def unexported(cards):
+        for book, card in cards:
+            key = card_key(book, card)
+            if key in exported:
+                continue
+            exported.add(key)
+            new_keys.append(key)
+            created_at = card.get('created_at')
+            if legacy_mark and (not created_at or created_at <= legacy_mark):
+                continue
+            yield book, card
+
+    cards = iter_cards(books, themes, since, until)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', newline='', encoding='utf-8') as f:
+        count = write_cards(f, unexported(cards) if incremental else cards, fmt)
+    os.replace(tmp_path, path)
+
+    if incremental:
+        # Recorded after the export is in place: a crash in between repeats cards rather than losing them
+        with open(_exported_path(name), 'a') as f:
+            f.writelines(f"{key}\n" for key in new_keys)
+        state[name] = {'exported_at': datetime.now().isoformat(), 'cards': count, 'path': path}
+        _save_export_state(state)
+    return path, count
@@ -1,15 +1,19 @@
 import os
 import json
+import queue
 import asyncio
+import itertools
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
-from dotenv import load_dotenv
+from config import settings, PROFILES
 from model_handler import ModelHandler
-from main import (
-    process_pdf, generate_additional_flashcards,
-    generate_random_flashcards, generate_random_flashcards_all_books,
-    THEMES_DIR, CACHE_DIR
-)
+from async_worker import AsyncWorker
+from card_pool import CardPool
+from metrics import metrics
+from profiler import profiler
+from scheduler import request_priority, INTERACTIVE
+from main import process_pdf, ensure_directories
+from exporters import export_cards
 
 class FlashcardGeneratorGUI:
     def __init__(self, root):
@@ -18,15 +22,13 @@ class FlashcardGeneratorGUI:
         self.root.geometry("800x600")
         
         # Initialize model handler
-        load_dotenv()
-        gemini_key = os.getenv('GEMINI_API_KEY')
-        mistral_key = os.getenv('MISTRAL_API_KEY')
-        if not gemini_key or not mistral_key:
+        try:
+            self.model_handler = ModelHandler.from_env(settings.cache_dir)
+        except ValueError:
             messagebox.showerror("Error", "API keys not found. Please check your .env file.")
             root.destroy()
             return
-        
-        self.model_handler = ModelHandler(gemini_key, mistral_key, CACHE_DIR)
+        ensure_directories()
         
         # Create main notebook for tabs
         self.notebook = ttk.Notebook(root)
@@ -42,6 +44,17 @@ class FlashcardGeneratorGUI:
         self._setup_process_tab()
         self._setup_generate_tab()
         
+        # Per-job progress rows
+        self.jobs_frame = ttk.LabelFrame(root, text="Jobs")
+        self.jobs_frame.pack(fill='x', padx=10, pady=5)
+        self.job_rows = {}  # {job_id: {'frame', 'bar', 'status', 'fraction'}}
+        self.active_jobs = set()
+        self.job_errors = []
+        self.profile_dirs = []
+        self.job_counter = itertools.count(1)
+        self.books_running = 0
+        self._book_slots = None  # Condition on the worker loop, created on first use
+        
         # Progress bar and status
         self.status_frame = ttk.Frame(root)
         self.status_frame.pack(fill='x', padx=10, pady=5)
@@ -49,8 +62,34 @@ class FlashcardGeneratorGUI:
         self.status_label = ttk.Label(self.status_frame, text="Ready")
         self.status_label.pack(side='left')
         
-        self.progress = ttk.Progressbar(self.status_frame, mode='indeterminate')
+        self.profile_var = tk.StringVar(value=settings.profile)
+        profile_combo = ttk.Combobox(self.status_frame, textvariable=self.profile_var, values=sorted(PROFILES),
+                                     state='readonly', width=18)
+        profile_combo.pack(side='right', padx=(5, 0))
+        profile_combo.bind('<<ComboboxSelected>>', self.change_profile)
+        ttk.Label(self.status_frame, text="Profile:").pack(side='right', padx=(10, 0))
+        
+        self.profiling_var = tk.BooleanVar(value=settings.profiling)
+        ttk.Checkbutton(self.status_frame, text="Profile runs", variable=self.profiling_var,
+                        command=self.toggle_profiling).pack(side='right', padx=(10, 0))
+        
+        self.cancel_button = ttk.Button(self.status_frame, text="Cancel", command=self.cancel_jobs, state='disabled')
+        self.cancel_button.pack(side='right', padx=(10, 0))
+        
+        self.progress = ttk.Progressbar(self.status_frame, mode='determinate', maximum=100)
         self.progress.pack(side='right', fill='x', expand=True, padx=(10, 0))
+        
+        # Background event loop; the Tk thread only polls its event queue
+        self.worker = AsyncWorker()
+        self.worker.start()
+        
+        # Reserve of pre-generated cards, refilled on the worker loop while no job is running
+        self.card_pool = CardPool(self.model_handler, is_idle=lambda: not self.active_jobs)
+        self.pool_future = None
+        if settings.pool_refill:
+            self.pool_future = asyncio.run_coroutine_threadsafe(self.card_pool.run(), self.worker.loop)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(100, self._poll_events)
     
     def _setup_process_tab(self):
         # PDF List
@@ -98,15 +137,17 @@ class FlashcardGeneratorGUI:
         self.num_cards.set(10)
         self.num_cards.pack(fill='x', padx=5, pady=5)
         
-        # Generate button
+        # Generate and export buttons
         ttk.Button(self.generate_tab, text="Generate Cards", 
                   command=self.generate_cards).pack(pady=20)
+        ttk.Button(self.generate_tab, text="Export Selection...",
+                  command=self.export_cards).pack()
         
         self.update_books()
     
     def update_books(self):
         """Update the list of available books."""
-        theme_files = [f for f in os.listdir(THEMES_DIR) if f.endswith('_themes.json')]
+        theme_files = [f for f in os.listdir(settings.themes_dir) if f.endswith('_themes.json')]
         books = ["All Books"] + [f.replace('_themes.json', '') for f in theme_files]
         self.book_combo['values'] = books
         self.book_var.set("All Books")
@@ -120,7 +161,7 @@ class FlashcardGeneratorGUI:
             self.theme_var.set("Random")
             self.theme_combo.configure(state='disabled')
         else:
-            theme_file = os.path.join(THEMES_DIR, f"{book}_themes.json")
+            theme_file = os.path.join(settings.themes_dir, f"{book}_themes.json")
             if os.path.exists(theme_file):
                 with open(theme_file, 'r') as f:
                     themes = json.load(f)
@@ -143,35 +184,171 @@ class FlashcardGeneratorGUI:
         for index in reversed(selection):
             self.pdf_list.delete(index)
     
-    async def process_single_pdf(self, filepath):
-        """Process a single PDF file."""
+    def _add_job_row(self, job_id, title):
+        """Add a progress row for a new job."""
+        # Drop rows left over from a previous, finished batch
+        if not self.active_jobs:
+            for row in self.job_rows.values():
+                row['frame'].destroy()
+            self.job_rows.clear()
+            self.job_errors = []
+            self.profile_dirs = []
+        
+        frame = ttk.Frame(self.jobs_frame)
+        frame.pack(fill='x', padx=5, pady=2)
+        ttk.Label(frame, text=title, width=30, anchor='w').pack(side='left')
+        status = ttk.Label(frame, text="Queued", width=30, anchor='w')
+        status.pack(side='right')
+        bar = ttk.Progressbar(frame, mode='determinate', maximum=100)
+        bar.pack(side='right', fill='x', expand=True, padx=5)
+        self.job_rows[job_id] = {'frame': frame, 'bar': bar, 'status': status, 'fraction': 0.0}
+        self.active_jobs.add(job_id)
+    
+    def _start_job(self, job_id, title, make_coro):
+        """Run a coroutine on the background worker with its own progress row."""
+        self._add_job_row(job_id, title)
+        callback = self.worker.progress_callback(job_id)
+        coro = make_coro(callback)
+        if settings.profiling:
+            coro = self._profiled(coro)
+        self.worker.submit(job_id, coro)
+        self.cancel_button.configure(state='normal')
+        self._update_overall_progress()
+    
+    def _finish_job(self, job_id, status_text):
+        """Mark a job as finished and wrap up the batch once nothing is running."""
+        row = self.job_rows.get(job_id)
+        if row:
+            row['fraction'] = 1.0
+            row['bar']['value'] = 100
+            row['status'].configure(text=status_text)
+        self.active_jobs.discard(job_id)
+        self._update_overall_progress()
+        
+        if not self.active_jobs:
+            self.cancel_button.configure(state='disabled')
+            self.status_label.configure(text="Ready")
+            metrics.export(settings.metrics_dir, "gui")
+            self.update_books()
+            profiles = "".join(f"\nProfile written to {directory}" for directory in self.profile_dirs)
+            if self.job_errors:
+                messagebox.showerror("Error", "\n".join(self.job_errors) + profiles)
+            else:
+                messagebox.showinfo("Success", "All jobs finished." + profiles)
+    
+    def _update_overall_progress(self):
+        """Show the average progress of the current batch."""
+        if not self.job_rows:
+            self.progress['value'] = 0
+            return
+        fractions = [row['fraction'] for row in self.job_rows.values()]
+        self.progress['value'] = 100 * sum(fractions) / len(fractions)
+        if self.active_jobs:
+            self.status_label.configure(text=f"Running {len(self.active_jobs)} job(s)...")
+    
+    def _poll_events(self):
+        """Drain progress events from the background worker."""
+        try:
+            while True:
+                kind, data = self.worker.events.get_nowait()
+                job_id = data.get('job_id')
+                row = self.job_rows.get(job_id)
+                if kind == 'progress' and row and job_id in self.active_jobs:
+                    total = max(data['total'], 1)
+                    row['fraction'] = min(data['done'] / total, 1.0)
+                    row['bar']['value'] = 100 * row['fraction']
+                    row['status'].configure(text=data['message'][:40])
+                    self._update_overall_progress()
+                elif kind == 'job_done':
+                    self._finish_job(job_id, "Done")
+                elif kind == 'job_cancelled':
+                    self._finish_job(job_id, "Cancelled")
+                elif kind == 'profile':
+                    self.profile_dirs.append(data['directory'])
+                elif kind == 'job_error':
+                    self.job_errors.append(f"{job_id}: {data['error']}")
+                    self._finish_job(job_id, "Failed")
+        except queue.Empty:
+            pass
+        self.root.after(100, self._poll_events)
+    
+    def change_profile(self, event=None):
+        """Switch performance profile; running jobs pick it up on their next request."""
+        try:
+            settings.apply_profile(self.profile_var.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            self.profile_var.set(settings.profile)
+            return
+        self.status_label.configure(text=f"Profile: {settings.profile}")
+    
+    def toggle_profiling(self):
+        """Profile jobs started from now on; jobs running together share one profile."""
+        settings.update(profiling=self.profiling_var.get())
+    
+    async def _profiled(self, coro):
+        """Run a job inside a profiler session, reporting where the profile was written."""
+        paths = {}
+        try:
+            async with profiler.session("gui") as paths:
+                return await coro
+        finally:
+            if paths:
+                self.worker.emit('profile', directory=paths['directory'])
+    
+    async def _interactive(self, coro):
+        """Run a job someone is waiting on; its LLM requests go ahead of queued book and pool work."""
+        with request_priority(INTERACTIVE):
+            return await coro
+    
+    async def _book_slot(self, make_coro):
+        """Run a book job once fewer than settings.batch_size books are being processed."""
+        if self._book_slots is None:
+            self._book_slots = asyncio.Condition()
+        async with self._book_slots:
+            await self._book_slots.wait_for(lambda: self.books_running < settings.batch_size)
+            self.books_running += 1
         try:
-            await process_pdf(filepath, self.model_handler)
-            return True
-        except Exception as e:
-            messagebox.showerror("Error", f"Error processing {os.path.basename(filepath)}: {str(e)}")
-            return False
+            return await make_coro()
+        finally:
+            async with self._book_slots:
+                self.books_running -= 1
+                self._book_slots.notify_all()
+    
+    def cancel_jobs(self):
+        """Cancel all in-flight jobs."""
+        self.status_label.configure(text="Cancelling...")
+        self.worker.cancel()
+    
+    def on_close(self):
+        """Stop the background worker before closing the window."""
+        self.worker.cancel()
+        if self.pool_future:
+            self.pool_future.cancel()
+        try:
+            self.worker.submit('close', self.model_handler.close()).result(timeout=5)
+        except Exception:
+            pass
+        self.worker.stop()
+        self.root.destroy()
     
     def process_pdfs(self):
-        """Process selected PDF files."""
+        """Process selected PDF files in the background, settings.batch_size at a time."""
         selection = self.pdf_list.curselection()
         if not selection:
             messagebox.showwarning("Warning", "Please select PDFs to process")
             return
         
-        self.progress.start()
-        self.status_label.configure(text="Processing PDFs...")
-        
-        async def process_all():
-            for index in selection:
-                filepath = self.pdf_list.get(index)
-                await self.process_single_pdf(filepath)
-            self.progress.stop()
-            self.status_label.configure(text="Ready")
-            self.update_books()
-            messagebox.showinfo("Success", "PDF processing complete!")
-        
-        asyncio.run(process_all())
+        for index in selection:
+            filepath = self.pdf_list.get(index)
+            job_id = f"pdf:{filepath}"
+            if job_id in self.active_jobs:
+                continue  # Already being processed
+            self._start_job(
+                job_id, os.path.basename(filepath),
+                lambda callback, path=filepath: self._book_slot(
+                    lambda: process_pdf(path, self.model_handler, progress_callback=callback))
+            )
     
     def generate_cards(self):
         """Generate flashcards based on current settings."""
@@ -181,30 +358,44 @@ class FlashcardGeneratorGUI:
             messagebox.showerror("Error", "Please enter a valid number of cards")
             return
         
-        self.progress.start()
-        self.status_label.configure(text="Generating flashcards...")
-        
-        async def generate():
-            book = self.book_var.get()
-            theme = self.theme_var.get()
-            
-            try:
-                if book == "All Books":
-                    await generate_random_flashcards_all_books(count, self.model_handler)
-                elif theme == "Random":
-                    await generate_random_flashcards(book, count, self.model_handler)
-                else:
-                    await generate_additional_flashcards(book, theme, count, self.model_handler)
-                
-                self.progress.stop()
-                self.status_label.configure(text="Ready")
-                messagebox.showinfo("Success", "Flashcards generated successfully!")
-            except Exception as e:
-                messagebox.showerror("Error", f"Error generating flashcards: {str(e)}")
-                self.progress.stop()
-                self.status_label.configure(text="Ready")
-        
-        asyncio.run(generate())
+        book = self.book_var.get()
+        theme = self.theme_var.get()
+        
+        def make_coro(callback):
+            # Served from the card pool; only a shortfall is generated live
+            return self._interactive(self.card_pool.serve(
+                count,
+                book=None if book == "All Books" else book,
+                theme=None if theme == "Random" else theme,
+                progress_callback=callback
+            ))
+        
+        job_id = f"generate:{next(self.job_counter)}"
+        title = f"{count} cards: {book}" if theme == "Random" else f"{count} cards: {theme}"
+        self._start_job(job_id, title, make_coro)
+
+    def export_cards(self):
+        """Export saved cards for the selected book and theme to CSV, TSV or an Anki deck."""
+        path = filedialog.asksaveasfilename(
+            title="Export Flashcards",
+            defaultextension=".txt",
+            filetypes=[("Anki deck (tab-separated)", "*.txt"), ("CSV", "*.csv"), ("TSV", "*.tsv")]
+        )
+        if not path:
+            return
+        fmt = {'.csv': 'csv', '.tsv': 'tsv'}.get(os.path.splitext(path)[1].lower(), 'anki')
+        book = self.book_var.get()
+        theme = self.theme_var.get()
+        books = None if book == "All Books" else [book]
+        themes = None if theme == "Random" else [theme]
+        
+        async def run_export(callback):
+            callback(0, 1, f"Exporting {fmt}")
+            _, count = await asyncio.to_thread(export_cards, fmt, path, books, themes)
+            callback(1, 1, f"{count} cards")
+        
+        self._start_job(f"export:{next(self.job_counter)}", f"Export: {os.path.basename(path)}", run_export)
+
 
 def main():
     root = tk.Tk()
@@ -212,4 +403,4 @@ def main():
     root.mainloop()
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main() 
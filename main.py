@@ -1,108 +1,383 @@
 import os
-import PyPDF2
 import json
 import time
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from pathlib import Path
-from tqdm import tqdm
-from dotenv import load_dotenv
-from config import (
-    INPUT_DIR, OUTPUT_DIR, FLASHCARDS_DIR, THEMES_DIR, CACHE_DIR,
-    MAX_FILE_SIZE_MB, MAX_ERRORS_PER_FILE, ERROR_COOLDOWN,
-    MAX_PROCESSING_TIME, PAGES_PER_SECTION, MAX_SECTIONS
-)
+import config
+from config import settings
 from model_handler import ModelHandler
-from cache_handler import CacheHandler
+from cache_handler import CacheHandler, stable_hash
+from metrics import metrics
+from profiler import profiler
+from page_filter import classify_page, PageStats, CONTENT, FILTER_VERSION
+from chapters import TableOfContents, TOC_VERSION
+from manifest import PageCache, BookManifest, chunk_hash, saved_cards_by_chunk
+from exporters import write_readable
+from output_writer import output_writer
 
-def extract_text_from_pdf(pdf_path):
-    """Extract text from PDF file."""
+MIN_BOOK_CARDS = 25  # Smallest card budget for a book: five themes at five cards each
+
+def extract_page_text(page):
+    """Extract text from a single PDF page, timing it."""
+    with metrics.span('pdf_extract_page'):
+        text = page.extract_text()
+    metrics.inc('pdf_pages_extracted_total')
+    return text
+
+def filtered_page_text(page, page_number, page_stats=None, page_cache=None, total_pages=None):
+    """Extract a page's text, or None if the page filter marks it as low-value.
+    
+    With a page_cache, text of pages unchanged since the last extraction is reused.
+    """
+    text = page_cache.text(page, extract_page_text) if page_cache is not None else extract_page_text(page)
+    if not settings.skip_low_value_pages:
+        return text
+    label = classify_page(text, settings.min_page_chars, page_number, total_pages)
+    if page_stats is not None:
+        page_stats.add(page_number, label)
+    if label != CONTENT:
+        metrics.inc('pdf_pages_skipped_total', reason=label)
+        return None
+    return text
+
+def extract_text_from_pdf(pdf_path, page_stats=None, toc=None, page_cache=None):
+    """Extract text from PDF file, one section per chapter.
+
+    Front matter, TOC, index and blank pages are left out. Chapters come from
+    the PDF outline, headings or fixed page ranges (see chapters.py); toc
+    records them, aligned with the returned sections.
+    """
+    import PyPDF2  # Deferred so importing this module (e.g. from the GUI) stays fast
+    
     try:
         with open(pdf_path, 'rb') as file:
             reader = PyPDF2.PdfReader(file)
             total_pages = len(reader.pages)
+            if page_stats is not None:
+                page_stats.total_pages = total_pages
             
-            # If file is large, process in sections
-            if total_pages > 100:
-                sections = []
-                section_size = total_pages // 3  # Split into 3 sections
-                
-                for start in range(0, total_pages, section_size):
-                    end = min(start + section_size, total_pages)
-                    print(f"Processing pages {start+1} to {end}")
-                    
-                    section_text = ""
-                    for i in range(start, end):
-                        section_text += reader.pages[i].extract_text() + "\n"
-                    sections.append(section_text)
-                
-                return sections
-            else:
-                # Process normally for smaller files
-                text = ""
-                for page in reader.pages:
-                    text += page.extract_text() + "\n"
-                return [text]
+            page_texts = [filtered_page_text(page, i + 1, page_stats, page_cache, total_pages)
+                          for i, page in enumerate(reader.pages)]
+            toc = toc if toc is not None else TableOfContents(pdf_path)
+            sections = []
+            fingerprints = page_cache.fingerprints if page_cache is not None else None
+            for chapter in toc.build(reader, page_texts, fingerprints):
+                text = "".join(page_texts[i] + "\n" for i in range(chapter['start_page'] - 1, chapter['end_page'])
+                               if page_texts[i] is not None)
+                if text.strip():
+                    sections.append(text)
+                    toc.chapters.append({**chapter, 'characters': len(text)})
+            if len(sections) > 1:
+                print(f"{os.path.basename(pdf_path)}: {len(sections)} chapters from {toc.method}")
+            return sections
                 
     except Exception as e:
         print(f"Error extracting text from {pdf_path}: {str(e)}")
         return None
 
-async def process_pdf(filepath, model_handler):
-    """Process a single PDF file."""
+def extracted_text_path(pdf_path):
+    """Path of the cached extraction for a PDF, keyed by name, size and mtime."""
+    stat = os.stat(pdf_path)
+    page_filter = FILTER_VERSION if settings.skip_low_value_pages else 0
+    sectioning = f"{TOC_VERSION}|{settings.pages_per_section}|{settings.chapter_min_pages}"
+    key = stable_hash(f"{os.path.basename(pdf_path)}|{stat.st_size}|{stat.st_mtime}|{page_filter}|{sectioning}")
+    return os.path.join(settings.texts_dir, f"{key}.json")
+
+def _load_extraction(pdf_path):
+    text_path = extracted_text_path(pdf_path)
+    if not os.path.exists(text_path):
+        return None
+    try:
+        with open(text_path, 'r') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"Error reading extracted text cache: {str(e)}")
+        return None
+
+def load_cached_text(pdf_path):
+    """Return previously extracted text sections for a PDF, or None."""
+    extraction = _load_extraction(pdf_path)
+    return extraction['sections'] if extraction else None
+
+def load_page_stats(pdf_path):
+    """Return the page filter statistics recorded when the PDF was extracted, or None."""
+    extraction = _load_extraction(pdf_path)
+    return extraction.get('pages') if extraction else None
+
+def load_page_hashes(pdf_path):
+    """Return the page fingerprints recorded when the PDF was extracted, or None."""
+    extraction = _load_extraction(pdf_path)
+    return extraction.get('page_hashes') if extraction else None
+
+def load_chapters(pdf_path):
+    """Return the chapters recorded when the PDF was extracted, aligned with its sections, or None."""
+    extraction = _load_extraction(pdf_path)
+    return extraction.get('chapters') if extraction else None
+
+@profiler.profiled('extract_text')
+def extract_text_cached(pdf_path):
+    """Extract text from a PDF, reusing the cached extraction when the file is unchanged."""
+    text = load_cached_text(pdf_path)
+    if text is not None:
+        return text
+    
+    page_stats = PageStats()
+    toc = TableOfContents(pdf_path)
+    page_cache = PageCache(pdf_path, reuse=settings.incremental_reprocess)
+    text = extract_text_from_pdf(pdf_path, page_stats, toc, page_cache)
+    if text:
+        toc.save()
+        page_cache.save()
+        if page_cache.reused:
+            print(f"{os.path.basename(pdf_path)}: reused the text of {page_cache.reused} unchanged page(s)")
+        with open(extracted_text_path(pdf_path), 'w') as f:
+            json.dump({'source': os.path.basename(pdf_path), 'sections': text, 'pages': page_stats.to_dict(),
+                       'chapters': toc.chapters, 'toc_method': toc.method,
+                       'page_hashes': page_cache.fingerprints}, f)
+    return text
+
+# Executor used for PDF extraction; None means the default thread pool
+_extraction_executor = None
+
+def set_extraction_workers(workers):
+    """Run PDF extraction in a pool of worker processes (0 or None for threads)."""
+    global _extraction_executor
+    if _extraction_executor is not None:
+        _extraction_executor.shutdown(wait=False, cancel_futures=True)
+    _extraction_executor = ProcessPoolExecutor(max_workers=workers) if workers else None
+
+async def extract_text_async(pdf_path):
+    """Extract text from a PDF without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_extraction_executor, extract_text_cached, pdf_path)
+
+def report_progress(progress_callback, done, total, message=""):
+    """Forward a progress update to the callback, if one was given."""
+    if progress_callback:
+        progress_callback(done, total, message)
+
+@profiler.profiled('process_pdf')
+async def process_pdf(filepath, model_handler, progress_callback=None):
+    """Process a single PDF file. Returns the generated flashcards, or None."""
     filename = os.path.basename(filepath)
+    # Until chapters are known: naming, extraction, chapter analysis
+    total_steps = 3
+    report_progress(progress_callback, 0, total_steps, "Cleaning filename")
     clean_name = await model_handler.clean_filename(filename)
     print(f"\nProcessing: {clean_name}")
     
     try:
         # Extract text from PDF
-        text = extract_text_from_pdf(filepath)
-        if not text:
+        report_progress(progress_callback, 1, total_steps, "Extracting text")
+        text = await extract_text_async(filepath)
+        page_stats = load_page_stats(filepath)
+        if page_stats and page_stats['kept_pages'] < page_stats['total_pages']:
+            skipped = PageStats.describe(page_stats)
+            print(f"{clean_name}: {skipped}")
+            report_progress(progress_callback, 2, total_steps, skipped)
+        if not text or not any(section.strip() for section in text):
             print(f"No text could be extracted from {filename}")
             return
         
-        # Calculate total content size
-        total_size = sum(len(section) for section in text)
+        # Themes and cards per chapter, chapters in parallel (bounded by the handler's request slots)
+        chapters = load_chapters(filepath) or [{'title': f"Section {i + 1}"} for i in range(len(text))]
+        reused, other_cards = reusable_chapters(clean_name, filepath, text)
+        budgets = chapter_card_budgets([len(chapter_text) for chapter_text in text])
+        total_steps = 3 + len(text)
+        done = 0
         
-        # Analyze themes
-        themes = await analyze_themes(text, model_handler)
-        if not themes:
-            print(f"No themes found in {filename}")
-            return
-        
-        # Calculate cards per theme based on content size
-        # Aim for roughly 1 card per 1000 characters, minimum 5 per theme
-        total_cards = max(total_size // 1000, len(themes) * 5)
-        cards_per_theme = max(total_cards // len(themes), 5)
-        print(f"Generating approximately {cards_per_theme} cards per theme ({len(themes)} themes)")
+        async def run_chapter(i, chapter, chapter_text):
+            nonlocal done
+            try:
+                if i in reused:
+                    return reused[i]
+                chapter_themes, cards = await process_chapter(chapter['title'], chapter_text, model_handler,
+                                                              budgets[i])
+                for card in cards:
+                    card['chunk'] = chunk_hash(chapter_text)
+                return chapter_themes, cards
+            finally:
+                done += 1
+                report_progress(progress_callback, 2 + done, total_steps, f"Chapter: {chapter['title']}")
         
-        # Generate flashcards for each theme
+        report_progress(progress_callback, 2, total_steps, f"Analyzing {len(text) - len(reused)} chapter(s)")
+        results = await asyncio.gather(*(run_chapter(i, chapter, chapter_text)
+                                         for i, (chapter, chapter_text) in enumerate(zip(chapters, text))),
+                                       return_exceptions=True)
+        themes = []
         all_flashcards = []
-        for theme in themes:
-            print(f"Generating cards for theme: {theme}")
-            cards = await generate_flashcards_for_theme(theme, text, model_handler, count=cards_per_theme)
+        chapter_themes = []
+        for chapter, result in zip(chapters, results):
+            if isinstance(result, Exception):
+                print(f"Error processing chapter {chapter['title']}: {str(result)}")
+                chapter_themes.append([])
+                continue
+            found, cards = result
+            chapter_themes.append(found)
+            themes = merge_themes(themes, found)
             all_flashcards.extend(cards)
         
+        if not themes:
+            print(f"No themes found in {filename}")
+            return
         if not all_flashcards:
             print(f"No flashcards generated for {filename}")
             return
         
-        # Save outputs
-        save_outputs(clean_name, themes, all_flashcards)
+        await save_outputs(clean_name, themes, all_flashcards + other_cards)
+        await save_manifest(clean_name, filepath, chapters, text, chapter_themes)
+        report_progress(progress_callback, total_steps, total_steps, "Done")
         print(f"Successfully processed {filename}")
         print(f"Generated {len(all_flashcards)} flashcards across {len(themes)} themes")
+        return all_flashcards
         
     except Exception as e:
         print(f"Error processing {filename}: {str(e)}")
         raise
 
-async def analyze_themes(text, model_handler):
-    """Analyze themes in the text."""
-    # If text is a list, join it with newlines
-    if isinstance(text, list):
-        text = "\n".join(text)
+def unchanged_chapters(book_name, text):
+    """Chapters of a reprocessed book whose text is unchanged since its manifest was written.
+    
+    Returns ({chapter index: (themes, saved cards)}, saved cards not tied to
+    a chapter (e.g. from generate), the manifest). All are empty for a new
+    book, or when incremental reprocessing is off.
+    """
+    manifest = BookManifest.load(book_name) if settings.incremental_reprocess else None
+    if manifest is None:
+        return {}, [], None
+    cards_by_chunk, other_cards = saved_cards_by_chunk(book_name)
+    reused = {}
+    for i, section in enumerate(text):
+        chunk = chunk_hash(section)
+        if chunk in manifest.chunks and chunk in cards_by_chunk:
+            reused[i] = (manifest.chunks[chunk]['themes'], cards_by_chunk[chunk])
+    return reused, other_cards, manifest
+
+def reusable_chapters(book_name, pdf_path, text):
+    """unchanged_chapters(), reporting how much of the book changed. Returns the chapters and other cards."""
+    reused, other_cards, manifest = unchanged_chapters(book_name, text)
+    if manifest is None:
+        return reused, other_cards
+    changed_pages = manifest.changed_pages(load_page_hashes(pdf_path) or [])
+    print(f"{book_name}: {changed_pages} new or changed page(s), "
+          f"{len(reused)} of {len(text)} chapter(s) unchanged")
+    metrics.inc('chapters_reused_total', value=len(reused))
+    return reused, other_cards
+
+async def save_manifest(book_name, pdf_path, chapters, text, chapter_themes):
+    """Record the book's page fingerprints and the themes of each chapter for the next reprocessing."""
+    manifest = BookManifest(book_name)
+    manifest.source = os.path.basename(pdf_path)
+    manifest.pages = load_page_hashes(pdf_path) or []
+    for chapter, section, themes in zip(chapters, text, chapter_themes):
+        if themes:
+            manifest.chunks[chunk_hash(section)] = {'title': chapter['title'], 'start_page': chapter.get('start_page'),
+                                                    'end_page': chapter.get('end_page'), 'themes': themes}
+    os.makedirs(settings.manifests_dir, exist_ok=True)
+    await output_writer.write_json(manifest.path, manifest.to_dict())
+
+async def process_chapter(title, text, model_handler, card_budget):
+    """Themes for one chapter, then its card_budget cards spread over the themes in parallel.
+    
+    Returns (themes, cards).
+    """
+    themes = await analyze_themes(text, model_handler)
+    if not themes:
+        print(f"No themes found in chapter {title}")
+        return [], []
+    cards_per_theme = calculate_cards_per_theme(themes, card_budget)
+    print(f"{title}: {len(themes)} themes, {card_budget} cards")
+    results = await asyncio.gather(*(generate_flashcards_for_theme(theme, text, model_handler, count=count)
+                                     for theme, count in cards_per_theme.items()))
+    cards = []
+    for theme_cards in results:
+        for card in theme_cards:
+            card['chapter'] = title
+        cards.extend(theme_cards)
+    return themes, cards
+
+def merge_themes(themes, new_themes):
+    """Themes followed by any of new_themes not already listed (ignoring case)."""
+    seen = {theme.lower() for theme in themes}
+    merged = list(themes)
+    for theme in new_themes:
+        if theme.lower() not in seen:
+            seen.add(theme.lower())
+            merged.append(theme)
+    return merged
+
+def book_card_budget(total_size):
+    """Cards for a whole book: roughly 1 per 1000 characters, at least MIN_BOOK_CARDS."""
+    return max(total_size // 1000, MIN_BOOK_CARDS)
+
+def chapter_card_budgets(sizes):
+    """The book's card budget split across its chapters in proportion to their length, at least 1 each."""
+    if not sizes:
+        return []
+    allocation = distribute_count({i: max(size, 1) for i, size in enumerate(sizes)}, book_card_budget(sum(sizes)))
+    return [allocation[i] for i in range(len(sizes))]
+
+def calculate_cards_per_theme(themes, budget):
+    """{theme: cards} for one chapter: its card budget split evenly over its themes.
+    
+    Themes are served in the order found; with fewer cards than themes the
+    later ones get none, so cost follows the book's length rather than its
+    number of chapters.
+    """
+    themes = themes[:budget]
+    return distribute_count({theme: 1 for theme in themes}, budget) if themes else {}
+
+def calculate_theme_weights(themes, full_text):
+    """Weight each theme by how often its significant words occur in the text."""
+    lowered = full_text.lower()
+    theme_weights = {}
+    for theme in themes:
+        # Count occurrences of theme words in text (case insensitive)
+        theme_words = theme.lower().split()
+        weight = 1  # Base weight
+        for word in theme_words:
+            if len(word) > 3:  # Only count significant words
+                weight += lowered.count(word)
+        theme_weights[theme] = max(weight, 1)  # Ensure minimum weight of 1
+    return theme_weights
+
+def theme_section(theme, sections):
+    """The section (chapter) where the theme's words occur most often."""
+    if len(sections) == 1:
+        return sections[0]
+    return max(sections, key=lambda section: calculate_theme_weights([theme], section)[theme])
+
+def distribute_count(weights, count):
+    """Split count across the keys of weights proportionally, at least 1 each."""
+    total_weight = sum(weights.values())
+    allocation = {key: max(int((weight / total_weight) * count), 1)
+                  for key, weight in weights.items()}
     
-    prompt = """You are analyzing a medical textbook. Extract 5-10 key medical themes or topics.
+    # Adjust to match requested count exactly
+    while sum(allocation.values()) != count:
+        before = sum(allocation.values())
+        if before < count:
+            # Add to keys with highest weights until we reach count
+            for key, _ in sorted(weights.items(), key=lambda x: x[1], reverse=True):
+                if sum(allocation.values()) >= count:
+                    break
+                allocation[key] += 1
+        else:
+            # Remove from keys with lowest weights until we reach count
+            for key, _ in sorted(weights.items(), key=lambda x: x[1]):
+                if sum(allocation.values()) <= count:
+                    break
+                if allocation[key] > 1:
+                    allocation[key] -= 1
+        if sum(allocation.values()) == before:
+            break  # Fewer items requested than keys; every key already has 1
+    return allocation
+
+def build_themes_prompt(text):
+    """Build the theme analysis prompt for a block of text."""
+    return """You are analyzing a medical textbook. Extract 5-10 key medical themes or topics.
     Return ONLY a JSON array of strings, no explanation or formatting.
     Each theme should be 2-5 words and describe a medical topic.
     
@@ -114,12 +389,25 @@ async def analyze_themes(text, model_handler):
     
     Text to analyze:
     """ + text[:2000]  # Using more text for better context
+
+def themes_cache_key(text):
+    """Cache key for the theme analysis of a block of text."""
+    return f"themes_{stable_hash(text[:2000])}"
+
+async def analyze_themes(text, model_handler):
+    """Analyze themes in the text."""
+    # If text is a list, join it with newlines
+    if isinstance(text, list):
+        text = "\n".join(text)
     
-    # Create a stable hash for the text
-    text_hash = str(hash(text[:2000].encode('utf-8')))
-    cache_key = f"themes_{text_hash}"
-    response = await model_handler.generate_response(prompt, cache_key=cache_key)
-    
+    prompt = build_themes_prompt(text)
+    with metrics.span('theme_analysis'):
+        response = await model_handler.generate_response(prompt, cache_key=themes_cache_key(text))
+    with metrics.span('parse_response', kind='themes'):
+        return parse_themes_response(response)
+
+def parse_themes_response(response):
+    """Parse a theme analysis response into a list of medical themes, or None."""
     try:
         # Clean up the response
         cleaned_response = response.strip()
@@ -161,13 +449,9 @@ async def analyze_themes(text, model_handler):
         print(f"Raw response: {response}")
         return None
 
-async def generate_flashcards_for_theme(theme, text, model_handler, count=2):
-    """Generate flashcards for a specific theme."""
-    # If text is a list, join it with newlines
-    if isinstance(text, list):
-        text = "\n".join(text)
-        
-    prompt = f"""Create {count} medical multiple choice questions about {theme}.
+def build_cards_prompt(theme, text, count):
+    """Build the flashcard generation prompt for a theme."""
+    return f"""Create {count} medical multiple choice questions about {theme}.
     Return ONLY a JSON array where each question object has:
     - "question": the question text
     - "correct_answer": the correct answer (prefixed with A)
@@ -190,13 +474,37 @@ async def generate_flashcards_for_theme(theme, text, model_handler, count=2):
     
     Text to use:
     {text[:2000]}"""
+
+def cards_cache_key(theme, text, count, variant=None):
+    """Cache key for a flashcard generation request."""
+    key = f"cards_{stable_hash(theme)}_{stable_hash(text[:2000])}_{count}"
+    return f"{key}_v{variant}" if variant is not None else key
+
+async def generate_flashcards_for_theme(theme, text, model_handler, count=2, variant=None):
+    """Generate flashcards for a specific theme. A new variant asks for fresh cards instead of cached ones."""
+    # If text is a list, join it with newlines
+    if isinstance(text, list):
+        text = "\n".join(text)
     
-    # Create a stable hash for the theme and text
-    text_hash = str(hash(text[:2000].encode('utf-8')))
-    theme_hash = str(hash(theme.encode('utf-8')))
-    cache_key = f"cards_{theme_hash}_{text_hash}_{count}"
-    response = await model_handler.generate_response(prompt, cache_key=cache_key)
+    prompt = build_cards_prompt(theme, text, count)
+    cache_key = cards_cache_key(theme, text, count, variant)
+    with metrics.span('card_generation'):
+        response = await model_handler.generate_response(prompt, cache_key=cache_key)
     
+    with metrics.span('parse_response', kind='cards'):
+        cards = parse_cards_response(response, theme)
+    for card in cards:
+        card['theme'] = theme
+    return cards
+
+def stamp_cards(cards):
+    """Record when cards were added to the store, for date-filtered and incremental exports."""
+    created_at = datetime.now().isoformat()
+    for card in cards:
+        card.setdefault('created_at', created_at)  # Cards kept from an earlier run keep their date
+
+def parse_cards_response(response, theme):
+    """Parse a card generation response into a list of valid flashcards."""
     try:
         # Clean up the response
         cleaned_response = response.strip()
@@ -246,47 +554,31 @@ async def generate_flashcards_for_theme(theme, text, model_handler, count=2):
         print(f"Raw response: {response}")
         return []
 
-def save_flashcards(book_id, flashcards):
-    """Save flashcards to both JSON and readable format."""
+async def save_flashcards(book_id, flashcards):
+    """Save flashcards to both JSON and readable format, off the event loop."""
     if not flashcards:
         return None, None
     
-    # Save as JSON
-    json_path = os.path.join(FLASHCARDS_DIR, f"{book_id}.json")
-    with open(json_path, 'w') as f:
-        json.dump(flashcards, f, indent=2)
-    
-    # Save in readable format
-    txt_path = os.path.join(OUTPUT_DIR, "csv_output", f"{book_id}.txt")
-    with open(txt_path, 'w') as f:
-        f.write(f"Flashcards for: {book_id}\n")
-        f.write("=" * 50 + "\n\n")
-        
-        for i, q in enumerate(flashcards, 1):
-            f.write(f"Question {i}:\n")
-            f.write(f"{q['question']}\n\n")
-            f.write("Options:\n")
-            # Combine all answers and sort by letter
-            all_answers = [q['correct_answer']] + q['wrong_answers']
-            all_answers.sort(key=lambda x: x[0])  # Sort by the letter prefix
-            for ans in all_answers:
-                f.write(f"{ans}\n")
-            f.write(f"\nCorrect Answer: {q['correct_answer']}\n")
-            if 'explanation' in q:
-                f.write(f"\nExplanation: {q['explanation']}\n")
-            f.write("\n" + "-"*50 + "\n\n")
-    
+    json_path = os.path.join(settings.flashcards_dir, f"{book_id}.json")
+    txt_path = os.path.join(settings.csv_output_dir, f"{book_id}.txt")
+    await asyncio.gather(
+        output_writer.write_json(json_path, flashcards),
+        output_writer.write_text(txt_path, lambda f: write_readable(f, flashcards, title=f"Flashcards for: {book_id}"))
+    )
     return json_path, txt_path
 
-def save_outputs(clean_name, themes, flashcards):
+async def save_outputs(clean_name, themes, flashcards):
     """Save themes and flashcards to files."""
-    # Save themes
-    theme_path = os.path.join(THEMES_DIR, f"{clean_name}_themes.json")
-    with open(theme_path, 'w') as f:
-        json.dump(themes, f, indent=2)
-    
-    # Save flashcards
-    json_path, txt_path = save_flashcards(clean_name, flashcards)
+    with metrics.span('save_outputs'):
+        await _save_outputs(clean_name, themes, flashcards)
+
+async def _save_outputs(clean_name, themes, flashcards):
+    stamp_cards(flashcards)
+    theme_path = os.path.join(settings.themes_dir, f"{clean_name}_themes.json")
+    _, (json_path, txt_path) = await asyncio.gather(
+        output_writer.write_json(theme_path, themes),
+        save_flashcards(clean_name, flashcards)
+    )
     
     print(f"\nSaved outputs for {clean_name}:")
     print(f"- Themes: {theme_path}")
@@ -295,29 +587,69 @@ def save_outputs(clean_name, themes, flashcards):
 
 def ensure_directories():
     """Create necessary directories if they don't exist."""
-    os.makedirs(INPUT_DIR, exist_ok=True)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    os.makedirs(FLASHCARDS_DIR, exist_ok=True)
-    os.makedirs(THEMES_DIR, exist_ok=True)
-    os.makedirs(CACHE_DIR, exist_ok=True)
-    os.makedirs(os.path.join(OUTPUT_DIR, "csv_output"), exist_ok=True)
+    config.ensure_directories()
 
 def get_pdf_files():
     """Get list of PDF files from input directory."""
-    return [os.path.join(INPUT_DIR, f) for f in os.listdir(INPUT_DIR) if f.endswith('.pdf')]
+    return [os.path.join(settings.input_dir, f) for f in os.listdir(settings.input_dir) if f.endswith('.pdf')]
+
+async def find_book_pdf(book_name, model_handler):
+    """Path of the PDF whose cleaned name is book_name, or None."""
+    for path in get_pdf_files():
+        clean_name = await model_handler.clean_filename(os.path.basename(path))
+        if clean_name == book_name:
+            return path
+    return None
+
+def load_themes(book_name):
+    """Themes saved for a book, or None if it has not been processed."""
+    theme_path = os.path.join(settings.themes_dir, f"{book_name}_themes.json")
+    if not os.path.exists(theme_path):
+        return None
+    with open(theme_path, 'r') as f:
+        return json.load(f)
+
+async def append_flashcards(book_name, new_cards):
+    """Add cards to a book's saved flashcards."""
+    flashcards_path = os.path.join(settings.flashcards_dir, f"{book_name}.json")
+    # A save still being written wins over the file on disk, so quick successive appends keep every card
+    existing_cards = output_writer.pending_json(flashcards_path)
+    if existing_cards is None:
+        existing_cards = []
+        if os.path.exists(flashcards_path):
+            with open(flashcards_path, 'r') as f:
+                existing_cards = json.load(f)
+    stamp_cards(new_cards)
+    cards = existing_cards + new_cards
+    txt_path = os.path.join(settings.csv_output_dir, f"{book_name}.txt")
+    if not existing_cards or not os.path.exists(txt_path):
+        with metrics.span('save_outputs'):
+            return await save_flashcards(book_name, cards)
+    
+    with metrics.span('save_outputs'):
+        # The readable file only needs the new cards appended
+        await asyncio.gather(
+            output_writer.write_json(flashcards_path, cards),
+            output_writer.append_text(txt_path, lambda f: write_readable(f, new_cards, start=len(existing_cards) + 1))
+        )
+    return flashcards_path, txt_path
+
+async def save_mixed_flashcards(cards):
+    """Save a set of cards from several books. Returns the JSON and text paths."""
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    mixed_cards_file = os.path.join(settings.flashcards_dir, f"mixed_cards_{timestamp}.json")
+    txt_path = os.path.join(settings.csv_output_dir, f"mixed_cards_{timestamp}.txt")
+    title = f"Mixed Flashcards Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    await asyncio.gather(
+        output_writer.write_json(mixed_cards_file, cards),
+        output_writer.write_text(txt_path, lambda f: write_readable(f, cards, title=title, show_source=True))
+    )
+    return mixed_cards_file, txt_path
 
 async def main():
     """Main function to process PDFs and generate flashcards."""
-    load_dotenv()
-    
-    # Initialize the model handler
-    gemini_key = os.getenv('GEMINI_API_KEY')
-    mistral_key = os.getenv('MISTRAL_API_KEY')
-    if not gemini_key:
-        raise ValueError("GEMINI_API_KEY not found in environment")
-    if not mistral_key:
-        raise ValueError("MISTRAL_API_KEY not found in environment")
-    model_handler = ModelHandler(gemini_key, mistral_key, CACHE_DIR)
+    # Initialize the model handler with every provider that has credentials
+    model_handler = ModelHandler.from_env(settings.cache_dir)
     
     # Create necessary directories
     ensure_directories()
@@ -337,11 +669,17 @@ async def main():
         except Exception as e:
             print(f"Error processing {pdf_path}: {str(e)}")
             continue
+    
+    await model_handler.close()
+    json_path, prom_path = metrics.export(settings.metrics_dir, "main")
+    print(f"\nMetrics written to {json_path} and {prom_path}")
 
-async def generate_additional_flashcards(book_name: str, theme: str, count: int, model_handler: ModelHandler):
+@profiler.profiled('generate_additional')
+async def generate_additional_flashcards(book_name: str, theme: str, count: int, model_handler: ModelHandler,
+                                         progress_callback=None):
     """Generate additional flashcards for a specific theme."""
     # Load existing themes
-    theme_path = os.path.join(THEMES_DIR, f"{book_name}_themes.json")
+    theme_path = os.path.join(settings.themes_dir, f"{book_name}_themes.json")
     if not os.path.exists(theme_path):
         print(f"No themes found for {book_name}")
         return None
@@ -354,51 +692,39 @@ async def generate_additional_flashcards(book_name: str, theme: str, count: int,
         return None
     
     # Find the original PDF file
-    pdf_files = get_pdf_files()
-    pdf_path = None
-    for path in pdf_files:
-        clean_name = await model_handler.clean_filename(os.path.basename(path))
-        if clean_name == book_name:
-            pdf_path = path
-            break
-    
+    pdf_path = await find_book_pdf(book_name, model_handler)
     if not pdf_path:
         print(f"Original PDF not found for {book_name}")
         return None
     
     # Extract text from PDF
-    text = extract_text_from_pdf(pdf_path)
+    report_progress(progress_callback, 0, 2, "Extracting text")
+    text = await extract_text_async(pdf_path)
     if not text:
         print(f"Could not extract text from {pdf_path}")
         return None
     
     # Generate new flashcards
     print(f"Generating {count} new flashcards for theme: {theme}")
-    new_cards = await generate_flashcards_for_theme(theme, text, model_handler, count)
+    report_progress(progress_callback, 1, 2, f"Theme: {theme}")
+    new_cards = await generate_flashcards_for_theme(theme, theme_section(theme, text), model_handler, count)
+    report_progress(progress_callback, 2, 2, "Done")
     
     if not new_cards:
         print("No new flashcards generated")
         return None
     
-    # Load and update existing flashcards
-    flashcards_path = os.path.join(FLASHCARDS_DIR, f"{book_name}.json")
-    existing_cards = []
-    if os.path.exists(flashcards_path):
-        with open(flashcards_path, 'r') as f:
-            existing_cards = json.load(f)
-    
-    # Add new cards
-    existing_cards.extend(new_cards)
-    
-    # Save updated flashcards
-    save_outputs(book_name, themes, existing_cards)
+    # Add to the book's existing flashcards
+    await append_flashcards(book_name, new_cards)
     print(f"Added {len(new_cards)} new flashcards for theme: {theme}")
     return new_cards
 
-async def generate_random_flashcards(book_name: str, count: int, model_handler: ModelHandler):
+@profiler.profiled('generate_random')
+async def generate_random_flashcards(book_name: str, count: int, model_handler: ModelHandler,
+                                     progress_callback=None):
     """Generate random flashcards across themes, weighted by content size."""
     # Load existing themes
-    theme_path = os.path.join(THEMES_DIR, f"{book_name}_themes.json")
+    theme_path = os.path.join(settings.themes_dir, f"{book_name}_themes.json")
     if not os.path.exists(theme_path):
         print(f"No themes found for {book_name}")
         return None
@@ -411,20 +737,14 @@ async def generate_random_flashcards(book_name: str, count: int, model_handler:
         return None
     
     # Find the original PDF file
-    pdf_files = get_pdf_files()
-    pdf_path = None
-    for path in pdf_files:
-        clean_name = await model_handler.clean_filename(os.path.basename(path))
-        if clean_name == book_name:
-            pdf_path = path
-            break
-    
+    pdf_path = await find_book_pdf(book_name, model_handler)
     if not pdf_path:
         print(f"Original PDF not found for {book_name}")
         return None
     
     # Extract text from PDF
-    text = extract_text_from_pdf(pdf_path)
+    report_progress(progress_callback, 0, 1, "Extracting text")
+    text = await extract_text_async(pdf_path)
     if not text:
         print(f"Could not extract text from {pdf_path}")
         return None
@@ -432,75 +752,41 @@ async def generate_random_flashcards(book_name: str, count: int, model_handler:
     # Join text sections
     full_text = "\n".join(text)
     
-    # Calculate theme weights based on frequency in text
-    theme_weights = {}
-    for theme in themes:
-        # Count occurrences of theme words in text (case insensitive)
-        theme_words = theme.lower().split()
-        weight = 1  # Base weight
-        for word in theme_words:
-            if len(word) > 3:  # Only count significant words
-                weight += full_text.lower().count(word)
-        theme_weights[theme] = max(weight, 1)  # Ensure minimum weight of 1
-    
-    # Calculate cards per theme based on weights
-    total_weight = sum(theme_weights.values())
-    cards_per_theme = {theme: max(int((weight / total_weight) * count), 1)
-                      for theme, weight in theme_weights.items()}
-    
-    # Adjust to match requested count exactly
-    while sum(cards_per_theme.values()) != count:
-        if sum(cards_per_theme.values()) < count:
-            # Add cards to themes with highest weights until we reach count
-            sorted_themes = sorted(theme_weights.items(), key=lambda x: x[1], reverse=True)
-            for theme, _ in sorted_themes:
-                if sum(cards_per_theme.values()) >= count:
-                    break
-                cards_per_theme[theme] += 1
-        else:
-            # Remove cards from themes with lowest weights until we reach count
-            sorted_themes = sorted(theme_weights.items(), key=lambda x: x[1])
-            for theme, _ in sorted_themes:
-                if sum(cards_per_theme.values()) <= count:
-                    break
-                if cards_per_theme[theme] > 1:
-                    cards_per_theme[theme] -= 1
+    # Calculate cards per theme based on frequency in text
+    theme_weights = calculate_theme_weights(themes, full_text)
+    cards_per_theme = distribute_count(theme_weights, count)
     
     # Generate flashcards for each theme
     print(f"\nGenerating {count} random flashcards for {book_name}:")
     all_new_cards = []
-    for theme, theme_count in cards_per_theme.items():
+    total_steps = len(cards_per_theme) + 1
+    for i, (theme, theme_count) in enumerate(cards_per_theme.items(), 1):
+        report_progress(progress_callback, i, total_steps, f"Theme: {theme}")
         if theme_count > 0:
             print(f"Generating {theme_count} cards for theme: {theme}")
-            cards = await generate_flashcards_for_theme(theme, text, model_handler, count=theme_count)
+            cards = await generate_flashcards_for_theme(theme, theme_section(theme, text), model_handler,
+                                                        count=theme_count)
             if cards:
                 all_new_cards.extend(cards)
+    report_progress(progress_callback, total_steps, total_steps, "Done")
     
     if not all_new_cards:
         print("No new flashcards generated")
         return None
     
-    # Load and update existing flashcards
-    flashcards_path = os.path.join(FLASHCARDS_DIR, f"{book_name}.json")
-    existing_cards = []
-    if os.path.exists(flashcards_path):
-        with open(flashcards_path, 'r') as f:
-            existing_cards = json.load(f)
-    
-    # Add new cards
-    existing_cards.extend(all_new_cards)
-    
-    # Save updated flashcards
-    save_outputs(book_name, themes, existing_cards)
+    # Add to the book's existing flashcards
+    await append_flashcards(book_name, all_new_cards)
     print(f"\nAdded {len(all_new_cards)} new flashcards across {len(cards_per_theme)} themes")
     for theme, theme_count in cards_per_theme.items():
         print(f"- {theme}: {theme_count} cards")
     return all_new_cards
 
-async def generate_random_flashcards_all_books(count: int, model_handler: ModelHandler):
+@profiler.profiled('generate_all_books')
+async def generate_random_flashcards_all_books(count: int, model_handler: ModelHandler,
+                                               progress_callback=None):
     """Generate random flashcards across all books and themes."""
     # Get all theme files
-    theme_files = [f for f in os.listdir(THEMES_DIR) if f.endswith('_themes.json')]
+    theme_files = [f for f in os.listdir(settings.themes_dir) if f.endswith('_themes.json')]
     if not theme_files:
         print("No theme files found")
         return None
@@ -509,7 +795,7 @@ async def generate_random_flashcards_all_books(count: int, model_handler: ModelH
     all_themes = {}  # {book_name: [themes]}
     for theme_file in theme_files:
         book_name = theme_file.replace('_themes.json', '')
-        with open(os.path.join(THEMES_DIR, theme_file), 'r') as f:
+        with open(os.path.join(settings.themes_dir, theme_file), 'r') as f:
             themes = json.load(f)
             if themes:
                 all_themes[book_name] = themes
@@ -518,33 +804,14 @@ async def generate_random_flashcards_all_books(count: int, model_handler: ModelH
         print("No themes found in any books")
         return None
     
-    # Calculate total themes and cards per book
-    total_themes = sum(len(themes) for themes in all_themes.values())
-    cards_per_book = {book: max(int((len(themes) / total_themes) * count), 1)
-                     for book, themes in all_themes.items()}
-    
-    # Adjust to match requested count exactly
-    while sum(cards_per_book.values()) != count:
-        if sum(cards_per_book.values()) < count:
-            # Add cards to books with most themes
-            sorted_books = sorted(all_themes.items(), key=lambda x: len(x[1]), reverse=True)
-            for book, _ in sorted_books:
-                if sum(cards_per_book.values()) >= count:
-                    break
-                cards_per_book[book] += 1
-        else:
-            # Remove cards from books with fewest themes
-            sorted_books = sorted(all_themes.items(), key=lambda x: len(x[1]))
-            for book, _ in sorted_books:
-                if sum(cards_per_book.values()) <= count:
-                    break
-                if cards_per_book[book] > 1:
-                    cards_per_book[book] -= 1
+    # Calculate cards per book based on number of themes
+    cards_per_book = distribute_count({book: len(themes) for book, themes in all_themes.items()}, count)
     
     # Generate flashcards for each book
     print(f"\nGenerating {count} random flashcards across all books:")
     all_new_cards = []
-    for book_name, book_count in cards_per_book.items():
+    for i, (book_name, book_count) in enumerate(cards_per_book.items()):
+        report_progress(progress_callback, i, len(cards_per_book), f"Book: {book_name}")
         if book_count > 0:
             print(f"\nGenerating {book_count} cards from {book_name}")
             cards = await generate_random_flashcards(book_name, book_count, model_handler)
@@ -554,35 +821,14 @@ async def generate_random_flashcards_all_books(count: int, model_handler: ModelH
                     card['source'] = book_name
                 all_new_cards.extend(cards)
     
+    report_progress(progress_callback, len(cards_per_book), len(cards_per_book), "Done")
+    
     if not all_new_cards:
         print("No flashcards generated")
         return None
     
     # Save to a special mixed cards file
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    mixed_cards_file = os.path.join(FLASHCARDS_DIR, f"mixed_cards_{timestamp}.json")
-    with open(mixed_cards_file, 'w') as f:
-        json.dump(all_new_cards, f, indent=2)
-    
-    # Save readable format
-    txt_path = os.path.join(OUTPUT_DIR, "csv_output", f"mixed_cards_{timestamp}.txt")
-    with open(txt_path, 'w') as f:
-        f.write(f"Mixed Flashcards Generated on {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write("=" * 50 + "\n\n")
-        
-        for i, q in enumerate(all_new_cards, 1):
-            f.write(f"Question {i} (from {q['source']}):\n")
-            f.write(f"{q['question']}\n\n")
-            f.write("Options:\n")
-            # Combine all answers and sort by letter
-            all_answers = [q['correct_answer']] + q['wrong_answers']
-            all_answers.sort(key=lambda x: x[0])  # Sort by the letter prefix
-            for ans in all_answers:
-                f.write(f"{ans}\n")
-            f.write(f"\nCorrect Answer: {q['correct_answer']}\n")
-            if 'explanation' in q:
-                f.write(f"\nExplanation: {q['explanation']}\n")
-            f.write("\n" + "-"*50 + "\n\n")
+    mixed_cards_file, txt_path = await save_mixed_flashcards(all_new_cards)
     
     print(f"\nGenerated {len(all_new_cards)} flashcards across {len(cards_per_book)} books:")
     for book, book_count in cards_per_book.items():
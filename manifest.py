@@ -0,0 +1,176 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from config import settings
+from cache_handler import stable_hash
+from metrics import metrics
+
+MANIFEST_VERSION = 1
+PAGE_CACHE_VERSION = 2  # 2: fingerprints include the page's resources
+
+
+def page_fingerprint(page):
+    """Hash of what a PDF page draws: its content stream and the resources it uses.
+
+    Much cheaper than extracting the text, so unchanged pages of a replaced
+    PDF can be recognised before extracting anything. The resources (form
+    XObjects, images, fonts) are included because pages often share a
+    content stream like `/Fm0 Do` and differ only in what it refers to.
+    """
+    digest = hashlib.sha256()
+    contents = page.get_contents()
+    digest.update(contents.get_data() if contents is not None else b'')
+    _hash_object(page.get('/Resources'), digest, set())
+    return digest.hexdigest()[:16]
+
+
+def _hash_object(obj, digest, seen):
+    """Feed a PDF object into digest, following references and including stream data."""
+    # Deferred so importing this module (e.g. from the GUI) stays fast
+    from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+
+    if isinstance(obj, IndirectObject):
+        key = (obj.idnum, obj.generation)
+        if key in seen:  # Shared or self-referencing objects are hashed once
+            digest.update(b'@')
+            return
+        seen.add(key)
+        obj = obj.get_object()
+    if isinstance(obj, DictionaryObject):
+        digest.update(b'<<')
+        for name in sorted(obj):
+            digest.update(name.encode('utf-8'))
+            _hash_object(obj.raw_get(name), digest, seen)
+        digest.update(b'>>')
+        if isinstance(obj, StreamObject):
+            digest.update(obj._data or b'')  # Still encoded: images are hashed without being decoded
+    elif isinstance(obj, ArrayObject):
+        digest.update(b'[')
+        for item in obj:
+            _hash_object(item, digest, seen)
+        digest.update(b']')
+    elif obj is not None:
+        digest.update(repr(obj).encode('utf-8'))
+
+
+def chunk_hash(text):
+    """Hash of a chapter's text, the unit sent to the LLM and the key cards are kept under."""
+    return stable_hash(text)
+
+
+class PageCache:
+    """Extracted text of each page of one PDF, keyed by page fingerprint.
+
+    When the PDF is replaced, only new or changed pages are extracted again.
+    Pages are matched by content, so inserting or removing a page does not
+    invalidate the pages after it. With reuse off every page is extracted,
+    but the fingerprints and texts are still recorded for the next run.
+    """
+
+    def __init__(self, pdf_path, reuse=True):
+        name = os.path.splitext(os.path.basename(pdf_path))[0]
+        self.path = os.path.join(settings.pages_dir, f"{name}.json")
+        self.previous = {}
+        if reuse and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    saved = json.load(f)
+                if saved.get('version') == PAGE_CACHE_VERSION:
+                    self.previous = saved['texts']
+            except Exception as e:
+                print(f"Error reading page cache: {str(e)}")
+        self.fingerprints = []  # In page order
+        self.texts = {}
+        self.reused = 0
+
+    def text(self, page, extract):
+        """The page's text, from the cache if its content is unchanged, else extract(page)."""
+        fingerprint = page_fingerprint(page)
+        self.fingerprints.append(fingerprint)
+        if fingerprint in self.previous:
+            self.reused += 1
+            metrics.inc('pdf_pages_reused_total')
+            text = self.previous[fingerprint]
+        else:
+            text = extract(page)
+        self.texts[fingerprint] = text
+        return text
+
+    def save(self):
+        """Keep only the current pages' texts."""
+        os.makedirs(settings.pages_dir, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': PAGE_CACHE_VERSION, 'pages': self.fingerprints, 'texts': self.texts}, f)
+        os.replace(tmp_path, self.path)
+
+
+class BookManifest:
+    """Page fingerprints and chapter hashes of a processed book.
+
+    Each chapter (chunk) entry records the themes found in it; the book's
+    cards carry the hash of the chunk they were generated from. When the
+    book is reprocessed, chapters whose text hash is listed keep their
+    themes and cards and are not sent to the LLM again. Where chapters are
+    split by length or the book has no chapters, the split points follow
+    page content (chapters.content_parts), so an inserted page changes the
+    hash of only the chunk it falls in.
+    """
+
+    def __init__(self, book):
+        self.book = book
+        self.source = None
+        self.pages = []   # Page fingerprints, in order
+        self.chunks = {}  # {chunk hash: {'title', 'start_page', 'end_page', 'themes'}}
+        self.updated_at = None
+
+    @property
+    def path(self):
+        return os.path.join(settings.manifests_dir, f"{self.book}.json")
+
+    @classmethod
+    def load(cls, book):
+        """The book's manifest, or None if it was never processed with one."""
+        manifest = cls(book)
+        if not os.path.exists(manifest.path):
+            return None
+        try:
+            with open(manifest.path, 'r') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"Error reading manifest for {book}: {str(e)}")
+            return None
+        if data.get('manifest') != MANIFEST_VERSION:
+            return None
+        manifest.source = data.get('source')
+        manifest.pages = data.get('pages', [])
+        manifest.chunks = data.get('chunks', {})
+        manifest.updated_at = data.get('updated_at')
+        return manifest
+
+    def to_dict(self):
+        """The manifest as saved, stamped with the current time."""
+        self.updated_at = datetime.now().isoformat()
+        return {'manifest': MANIFEST_VERSION, 'book': self.book, 'source': self.source,
+                'updated_at': self.updated_at, 'pages': self.pages, 'chunks': self.chunks}
+
+    def changed_pages(self, pages):
+        """How many of pages (fingerprints) were not in the book when the manifest was written."""
+        known = set(self.pages)
+        return sum(1 for page in pages if page not in known)
+
+
+def saved_cards_by_chunk(book):
+    """The book's saved cards as ({chunk hash: [cards]}, [cards not tied to a chunk])."""
+    path = os.path.join(settings.flashcards_dir, f"{book}.json")
+    by_chunk = {}
+    other = []
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            for card in json.load(f):
+                if card.get('chunk'):
+                    by_chunk.setdefault(card['chunk'], []).append(card)
+                else:
+                    other.append(card)
+    return by_chunk, other
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from profiler import profiler
+
+METRIC_PREFIX = "flashcards"
+
+# Latency buckets in seconds, from a single PDF page up to a slow LLM retry
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """Cumulative latency histogram with fixed buckets."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def quantile(self, q):
+        """Approximate a quantile as the upper bound of the bucket containing it."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            seen += bucket_count
+            if seen >= target:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95)
+        }
+
+
+class Metrics:
+    """Process-wide counters, gauges and latency histograms.
+
+    Recording is a dict update under a lock, cheap enough to leave on
+    permanently. Thread-safe, so PDF extraction in worker threads can record
+    spans too. Extraction in worker processes is not collected.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}    # {(name, labels): value}
+        self.gauges = {}      # {(name, labels): current value}
+        self.histograms = {}  # {(name, labels): Histogram}
+        self.started_at = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        """Increment a counter."""
+        key = self._key(name, labels)
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Set a gauge to its current value."""
+        key = self._key(name, labels)
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, name, seconds, **labels):
+        """Record a latency observation."""
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def span(self, name, **labels):
+        """Time a block of code (sync or async) into the histogram <name>_seconds.
+
+        Spans are also profiler stages, so a profiled run splits their time
+        into CPU and awaiting.
+        """
+        start = time.perf_counter()
+        try:
+            if profiler.active:
+                with profiler.stage(name, **labels):
+                    yield
+            else:
+                yield
+        finally:
+            self.observe(f"{name}_seconds", time.perf_counter() - start, **labels)
+
+    def counter_value(self, name, **labels):
+        """Sum of a counter across label sets matching the given labels."""
+        wanted = {k: str(v) for k, v in labels.items()}
+        with self._lock:
+            return sum(value for (counter_name, counter_labels), value in self.counters.items()
+                       if counter_name == name and wanted.items() <= dict(counter_labels).items())
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+            self.started_at = time.time()
+
+    def summary(self):
+        """JSON-serializable snapshot of every metric."""
+        with self._lock:
+            return {
+                'started_at': datetime.fromtimestamp(self.started_at).isoformat(),
+                'duration_seconds': round(time.time() - self.started_at, 3),
+                'counters': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.counters.items())
+                ],
+                'gauges': [
+                    {'name': name, 'labels': dict(labels), 'value': value}
+                    for (name, labels), value in sorted(self.gauges.items())
+                ],
+                'histograms': [
+                    {'name': name, 'labels': dict(labels), **histogram.summary()}
+                    for (name, labels), histogram in sorted(self.histograms.items())
+                ]
+            }
+
+    def prometheus_text(self):
+        """Render all metrics in the Prometheus text exposition format."""
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+            return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+        lines = []
+        with self._lock:
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = f"{METRIC_PREFIX}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                lines.append(f"{metric}{label_text(labels)} {value}")
+
+            for (name, labels), value in sorted(self.gauges.items()):
+                metric = f"{METRIC_PREFIX}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} gauge")
+                    typed.add(metric)
+                lines.append(f"{metric}{label_text(labels)} {value}")
+
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = f"{METRIC_PREFIX}_{name}"
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} histogram")
+                    typed.add(metric)
+                cumulative = 0
+                for bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{metric}_bucket{label_text(labels, [('le', bound)])} {cumulative}")
+                lines.append(f"{metric}_bucket{label_text(labels, [('le', '+Inf')])} {histogram.count}")
+                lines.append(f"{metric}_sum{label_text(labels)} {histogram.sum}")
+                lines.append(f"{metric}_count{label_text(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, metrics_dir, run_name="run"):
+        """Write <run>.json and <run>.prom, plus latest.prom for textfile collectors.
+
+        Returns the paths of the JSON summary and the Prometheus file.
+        """
+        os.makedirs(metrics_dir, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        base = os.path.join(metrics_dir, f"{run_name}_{timestamp}")
+
+        json_path = f"{base}.json"
+        with open(json_path, 'w') as f:
+            json.dump({'run': run_name, **self.summary()}, f, indent=2)
+
+        prom_path = f"{base}.prom"
+        text = self.prometheus_text()
+        with open(prom_path, 'w') as f:
+            f.write(text)
+        # Write-then-rename so a scraper never reads a partial file
+        latest_tmp = os.path.join(metrics_dir, "latest.prom.tmp")
+        with open(latest_tmp, 'w') as f:
+            f.write(text)
+        os.replace(latest_tmp, os.path.join(metrics_dir, "latest.prom"))
+        return json_path, prom_path
+
+
+# Shared registry used by every module
+metrics = Metrics()
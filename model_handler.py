@@ -1,104 +1,212 @@
 import json
 import os
 import time
-from mistralai.client import MistralClient
-from mistralai.models.chat_completion import ChatMessage
-import google.generativeai as genai
-from cache_handler import CacheHandler
+import asyncio
+from cache_handler import CacheHandler, stable_hash
+import config
+from metrics import metrics
+from profiler import profiler
+from scheduler import RequestScheduler, Request, current_priority
+from providers import create_provider
+from cassette import recording_providers, replay_providers
 
 class ModelHandler:
     GEMINI_MODEL = 'gemini-2.0-flash-exp'
     MISTRAL_MODEL = 'mistral-small-latest'
     
-    def __init__(self, gemini_api_key: str, mistral_api_key: str, cache_dir: str):
-        self.gemini_model = genai.GenerativeModel(self.GEMINI_MODEL)
-        self.mistral_client = MistralClient(api_key=mistral_api_key)
+    def __init__(self, gemini_api_key: str, mistral_api_key: str, cache_dir: str,
+                 preferred_model: str = "gemini", providers: dict = None, settings=None):
+        # Retries, limits and cache policy are read on every request, so profile
+        # switches on the shared settings apply to a running handler
+        self.settings = settings if settings is not None else config.settings
+        if self.settings.replay_cassette:
+            # Recorded responses stand in for every provider; no keys or network needed
+            self.providers = replay_providers(self.settings.replay_cassette, order=self.settings.llm_providers,
+                                              realtime=self.settings.replay_realtime)
+        else:
+            self.providers = providers if providers is not None else self._init_providers(gemini_api_key, mistral_api_key)
+            if self.settings.record_cassette:
+                self.providers = recording_providers(self.providers, self.settings.record_cassette)
+        if not self.providers:
+            raise ValueError("No LLM provider configured: set GEMINI_API_KEY, MISTRAL_API_KEY or LOCAL_LLM_URL")
+        if preferred_model not in self.providers:
+            preferred_model = next(iter(self.providers))
         self.cache_handler = CacheHandler(cache_dir)
-        genai.configure(api_key=gemini_api_key)
-        self.current_model = "gemini"
+        self.current_model = preferred_model
         self.consecutive_errors = 0
-        self.error_threshold = 3
         self.cooldown_start = 0
-        self.cooldown_period = 60  # 1 minute cooldown
+        
+        # Concurrency, rate limiting and priority across all coroutines sharing this handler
+        self._scheduler = RequestScheduler(self.settings, self._request_spacing)
+        
+        # {request key: (task, Request)} for requests on their way to a provider;
+        # identical concurrent requests await the same task instead of calling again
+        self._inflight = {}
+    
+    @classmethod
+    def from_env(cls, cache_dir, **options):
+        """Create a handler using every provider that has credentials configured."""
+        settings = options.get('settings') or config.settings
+        return cls(settings.gemini_api_key, settings.mistral_api_key, cache_dir, **options)
+    
+    def _init_providers(self, gemini_api_key, mistral_api_key):
+        """Create providers in llm_providers order, skipping those without credentials."""
+        settings = self.settings
+        pool = {'max_connections': settings.http_max_connections, 'timeout': settings.http_timeout,
+                'keepalive_timeout': settings.http_keepalive_timeout}
+        available = {
+            'gemini': lambda: create_provider('gemini', api_key=gemini_api_key, model=self.GEMINI_MODEL, **pool)
+                      if gemini_api_key else None,
+            'mistral': lambda: create_provider('mistral', api_key=mistral_api_key, model=self.MISTRAL_MODEL, **pool)
+                       if mistral_api_key else None,
+            'local': lambda: create_provider('local', base_url=settings.local_llm_url,
+                                             model=settings.local_llm_model,
+                                             api_key=settings.local_llm_api_key, **pool)
+                     if settings.local_llm_url else None,
+        }
+        providers = {}
+        for name in settings.llm_providers:
+            provider = available[name]() if name in available else None
+            if provider is not None:
+                providers[name] = provider
+        return providers
+    
+    def _next_model(self, model):
+        """The provider after model in fallback order, wrapping around."""
+        names = list(self.providers)
+        return names[(names.index(model) + 1) % len(names)]
+    
+    async def _call_model(self, model, prompt):
+        """Send a prompt to one provider and return the response text."""
+        return await self.providers[model].generate(prompt)
+    
+    async def close(self):
+        """Close pooled provider connections."""
+        for provider in self.providers.values():
+            await provider.close()
+    
+    def _replaying_fast(self):
+        """Full-speed replay spends no quota, so rate limits and retry delays are skipped."""
+        return bool(self.settings.replay_cassette) and not self.settings.replay_realtime
+    
+    def _request_spacing(self):
+        """Seconds between request starts that keep us under rate_limit requests per minute."""
+        rate_limit = self.settings.rate_limit
+        if not rate_limit or self._replaying_fast():
+            return 0
+        return 60 / rate_limit
     
     def _should_switch_model(self):
         """Determine if we should switch models based on errors and cooldown."""
-        if self.consecutive_errors >= self.error_threshold:
-            if time.time() - self.cooldown_start >= self.cooldown_period:
+        if self.consecutive_errors >= self.settings.error_threshold:
+            if time.time() - self.cooldown_start >= self.settings.error_cooldown:
                 self.consecutive_errors = 0
                 return True
         return False
     
-    def _format_prompt(self, prompt):
-        """Format prompt based on current model."""
-        if self.current_model == "gemini":
-            return prompt
-        else:  # Mistral needs a system prompt
-            return prompt  # System prompt is handled in the API call
-    
     async def generate_response(self, prompt, cache_key=None):
-        """Generate response using current model with fallback."""
-        if cache_key:
+        """Generate response using current model with fallback.
+        
+        Concurrent calls with the same cache key (or, without one, the same
+        prompt) share one provider request. The request is scheduled at the
+        caller's priority (see scheduler.request_priority), raised if a more
+        urgent caller joins it.
+        """
+        # Recording and replaying bypass the cache so every request goes through the cassette
+        use_cache = (cache_key and self.settings.use_cache
+                     and not self.settings.record_cassette and not self.settings.replay_cassette)
+        if use_cache:
             cached = self.cache_handler.get(cache_key)
             if cached:
                 return cached
         
-        max_retries = 3
+        key = cache_key or f"prompt_{stable_hash(prompt)}"
+        task, request = self._inflight.get(key, (None, None))
+        if task is not None and task.get_loop() is asyncio.get_running_loop():
+            metrics.inc('llm_requests_coalesced_total')
+            self._scheduler.promote(request, current_priority())
+        else:
+            request = Request()
+            task = asyncio.ensure_future(self._generate(prompt, cache_key if use_cache else None, request))
+            self._inflight[key] = (task, request)
+            task.add_done_callback(lambda done: self._request_done(key, done))
+        # Shielded so one caller being cancelled does not cancel the others
+        return await asyncio.shield(task)
+    
+    def _request_done(self, key, task):
+        if self._inflight.get(key, (None,))[0] is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()  # Retrieved here too, in case every caller was cancelled
+    
+    async def _generate(self, prompt, cache_key, request):
+        """Send the prompt, retrying and falling back between providers. Caches the result under cache_key."""
+        max_retries = self.settings.max_retries
         retry_count = 0
+        rate_limited = 0  # Providers rate limited since the last retry
         while retry_count < max_retries:
             try:
                 if self._should_switch_model():
-                    self.current_model = "gemini" if self.current_model == "mistral" else "mistral"
+                    self.current_model = self._next_model(self.current_model)
                     print(f"Switching to {self.current_model} model")
                 
-                formatted_prompt = self._format_prompt(prompt)
-                
-                if self.current_model == "gemini":
-                    try:
-                        response = self.gemini_model.generate_content(formatted_prompt)
-                        result = response.text
-                    except Exception as e:
-                        if "429" in str(e):  # Quota exceeded
-                            print(f"Gemini quota exceeded, switching to Mistral...")
-                            self.current_model = "mistral"
-                            continue
-                        raise
-                else:  # Mistral
+                async with self._scheduler.slot(request):
+                    provider = self.current_model
+                    call_start = time.perf_counter()
                     try:
-                        messages = [
-                            ChatMessage(role="system", content="You are a medical education expert specialized in creating clear, accurate multiple choice questions."),
-                            ChatMessage(role="user", content=prompt)
-                        ]
-                        response = self.mistral_client.chat(
-                            model=self.MISTRAL_MODEL,
-                            messages=messages
-                        )
-                        result = response.choices[0].message.content
+                        with profiler.stage('llm_request', provider=provider):
+                            result = await self._call_model(provider, prompt)
                     except Exception as e:
-                        if "429" in str(e):  # Quota exceeded
-                            print(f"Mistral quota exceeded, switching to Gemini...")
-                            self.current_model = "gemini"
-                            continue
+                        if getattr(e, 'rate_limited', False) or "429" in str(e):  # Quota exceeded
+                            metrics.inc('llm_requests_total', provider=provider, outcome='rate_limited')
+                            self.current_model = self._next_model(provider)
+                            rate_limited += 1
+                            if rate_limited < len(self.providers):
+                                print(f"{provider.title()} quota exceeded, switching to {self.current_model.title()}...")
+                                continue
+                            # Every provider is rate limited: counts as a retry, after retry_delay
+                            raise Exception(f"Quota exceeded on every provider ({str(e)})") from e
                         raise
+                    
+                    metrics.observe('llm_request_seconds', time.perf_counter() - call_start, provider=provider)
+                    metrics.inc('llm_requests_total', provider=provider, outcome='success')
                 
                 self.consecutive_errors = 0  # Reset error count on success
                 if cache_key:
-                    self.cache_handler.set(cache_key, result)
+                    self.cache_handler.set(cache_key, result, expiry=self.settings.cache_expiry)
                 return result
                 
             except Exception as e:
                 print(f"Error with {self.current_model}: {str(e)}")
+                if rate_limited < len(self.providers):
+                    metrics.inc('llm_requests_total', provider=self.current_model, outcome='error')
+                rate_limited = 0
                 self.consecutive_errors += 1
                 retry_count += 1
                 if retry_count < max_retries:
-                    print(f"Waiting 30s before retry {retry_count + 1}...")
-                    time.sleep(30)
+                    metrics.inc('llm_retries_total', provider=self.current_model)
+                    retry_delay = 0 if self._replaying_fast() else self.settings.retry_delay
+                    print(f"Waiting {retry_delay}s before retry {retry_count + 1}...")
+                    await asyncio.sleep(retry_delay)
                 continue
         
-        raise Exception(f"Failed to generate response after {max_retries} retries with both models")
+        raise Exception(f"Failed to generate response after {max_retries} retries with all providers")
 
     async def clean_filename(self, filename: str) -> str:
-        prompt = f"""Given this filename: "{filename}", extract just the book title and year.
+        prompt = self.build_filename_prompt(filename)
+        
+        try:
+            response = await self.generate_response(prompt, cache_key=self.filename_cache_key(filename))
+            return self.parse_filename_response(response)
+        except Exception as e:
+            print(f"Error cleaning filename with AI: {str(e)}")
+            print(f"Raw response: {response if 'response' in locals() else 'No response'}")
+            return self.fallback_filename(filename)
+
+    @staticmethod
+    def build_filename_prompt(filename):
+        """Prompt asking the model for a book's title and year."""
+        return f"""Given this filename: "{filename}", extract just the book title and year.
         Return ONLY a JSON object with 'title' and 'year' fields.
         Rules:
         1. Keep possessive names in official titles (e.g., "Guyton's", "Ganong's", "Vander's")
@@ -107,24 +215,31 @@ class ModelHandler:
         
         Example: For "Basic Physics and Measurement in Anaesthesia-Butterworth-Heinemann (1995).pdf"
         Return: {{"title": "Basic Physics and Measurement in Anaesthesia", "year": "1995"}}"""
+
+    @staticmethod
+    def filename_cache_key(filename):
+        """Cache key for the clean_filename request of a PDF filename."""
+        return f"filename_{stable_hash(filename)}"
+
+    @staticmethod
+    def fallback_filename(filename):
+        """Book name derived from the filename alone, used when the model fails."""
+        return os.path.splitext(filename)[0].split('--')[0].strip().replace(' ', '_')
+
+    @staticmethod
+    def parse_filename_response(response):
+        """Turn a clean_filename response into a Title_Year book name."""
+        # Clean up markdown formatting
+        if '```' in response:
+            parts = response.split('```')
+            if len(parts) >= 3:
+                response = parts[1]
+                if response.startswith('json'):
+                    response = response[4:]
+            else:
+                response = parts[-1]
+        response = response.strip()
         
-        try:
-            response = await self.generate_response(prompt, cache_key=f"filename_{hash(filename)}")
-            # Clean up markdown formatting
-            if '```' in response:
-                parts = response.split('```')
-                if len(parts) >= 3:
-                    response = parts[1]
-                    if response.startswith('json'):
-                        response = response[4:]
-                else:
-                    response = parts[-1]
-            response = response.strip()
-            
-            data = json.loads(response)
-            title = data['title'].replace(' ', '_')
-            return f"{title}_{data['year']}" if data.get('year') else title
-        except Exception as e:
-            print(f"Error cleaning filename with AI: {str(e)}")
-            print(f"Raw response: {response if 'response' in locals() else 'No response'}")
-            return os.path.splitext(filename)[0].split('--')[0].strip().replace(' ', '_') 
\ No newline at end of file
+        data = json.loads(response)
+        title = data['title'].replace(' ', '_')
+        return f"{title}_{data['year']}" if data.get('year') else title
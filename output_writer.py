@@ -0,0 +1,140 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import threading
+from concurrent.futures import Future
+from config import settings
+from metrics import metrics
+
+
+class _PendingWrite:
+    """Renders waiting to be written to one path, and the future their callers wait on."""
+
+    def __init__(self, due):
+        self.due = due
+        self.renders = []   # Callables writing to an open file, in order
+        self.append = True  # False once any caller replaces the whole file
+        self.value = None   # Latest JSON value, for read-your-writes before the file is written
+        self.future = Future()
+
+
+class OutputWriter:
+    """Writes output files on a background thread, atomically, coalescing rapid saves of the same file.
+
+    Writes are queued from the event loop without blocking it. A file is
+    written to a temporary file and renamed over the old one, so an
+    interrupted save leaves the previous version intact. Saves of the same
+    path within settings.output_coalesce_seconds are written once, with
+    the latest content. Appends are written in order in the same pass.
+    Time spent serializing and writing is recorded as output_write_seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._pending = {}  # {path: _PendingWrite}, in order of arrival
+        self._writing = {}  # {path: _PendingWrite} being written now
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="output-writer", daemon=True)
+            self._thread.start()
+            atexit.register(self.flush)
+
+    def _queue(self, path, render, append=False, value=None):
+        with self._lock:
+            self._start()
+            pending = self._pending.get(path)
+            if pending is None:
+                pending = self._pending[path] = _PendingWrite(time.monotonic() + settings.output_coalesce_seconds)
+                self._lock.notify()
+            else:
+                metrics.inc('output_writes_coalesced_total')
+            if not append:
+                # Replaces everything queued before it
+                pending.renders = []
+                pending.append = False
+                pending.value = value
+            pending.renders.append(render)
+            future = pending.future
+        # Shielded so a cancelled caller does not cancel a write other callers share
+        return asyncio.shield(asyncio.wrap_future(future))
+
+    def write_json(self, path, data, indent=2):
+        """Queue replacing path with data as JSON. Returns an awaitable that completes once written."""
+        return self._queue(path, lambda f: json.dump(data, f, indent=indent), value=data)
+
+    def write_text(self, path, render):
+        """Queue replacing path with what render(f) writes."""
+        return self._queue(path, render)
+
+    def append_text(self, path, render):
+        """Queue appending what render(f) writes to path."""
+        return self._queue(path, render, append=True)
+
+    def pending_json(self, path):
+        """The JSON value queued or being written for path, or None if the file is up to date."""
+        with self._lock:
+            for writes in (self._pending, self._writing):
+                if path in writes and writes[path].value is not None:
+                    return writes[path].value
+            return None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._lock.wait()
+                path, pending = next(iter(self._pending.items()))
+                delay = pending.due - time.monotonic()
+                if delay > 0:
+                    self._lock.wait(delay)
+                    continue
+                del self._pending[path]
+                self._writing[path] = pending
+            self._write(path, pending)
+            with self._lock:
+                del self._writing[path]
+
+    def _write(self, path, pending):
+        kind = 'append' if pending.append else 'replace'
+        try:
+            with metrics.span('output_write', kind=kind):
+                if pending.append:
+                    with open(path, 'a', encoding='utf-8') as f:
+                        start = f.tell()
+                        for render in pending.renders:
+                            render(f)
+                        size = f.tell() - start
+                else:
+                    tmp_path = f"{path}.tmp"
+                    with open(tmp_path, 'w', encoding='utf-8') as f:
+                        for render in pending.renders:
+                            render(f)
+                        size = f.tell()
+                    os.replace(tmp_path, path)
+            metrics.inc('output_writes_total', kind=kind)
+            metrics.inc('output_bytes_total', value=size)
+            pending.future.set_result(path)
+        except Exception as e:
+            print(f"Error writing {path}: {str(e)}")
+            pending.future.set_exception(e)
+
+    def flush(self):
+        """Write everything queued now, without waiting for the coalescing window. Blocks until done."""
+        with self._lock:
+            futures = [pending.future for pending in self._pending.values()]
+            for pending in self._pending.values():
+                pending.due = 0
+            self._lock.notify()
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                pass  # Already reported by the writer thread
+
+
+# Shared writer used by every module
+output_writer = OutputWriter()
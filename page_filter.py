@@ -0,0 +1,144 @@
+import re
+
+# Page labels; everything except CONTENT is skipped before prompting
+CONTENT = 'content'
+BLANK = 'blank'
+FRONT_MATTER = 'front_matter'
+TOC = 'toc'
+INDEX = 'index'
+
+# Bump when the rules change so cached extractions are redone
+FILTER_VERSION = 2
+
+# Phrases found on copyright, licence and publisher pages
+BOILERPLATE_KEYWORDS = (
+    'all rights reserved', 'copyright', '©', 'isbn', 'library of congress', 'cataloging-in-publication',
+    'british library', 'printed in', 'published by', 'no part of this', 'without permission', 'permissions',
+    'ebook', 'e-book', 'license', 'licence', 'trademark', 'first edition', 'reprinted', 'disclaimer',
+    'publisher'
+)
+# Web addresses, counted as one keyword however many forms appear ("https://www.")
+URL = re.compile(r'https?://|www\.', re.IGNORECASE)
+MIN_BOILERPLATE_HITS = 3       # Distinct keywords for a page to count as front matter
+MAX_BOILERPLATE_CHARS = 4000   # Longer pages are treated as real content regardless
+# Away from the ends of the book, a page is front matter only if this share of its lines is
+# boilerplate, so a content page ending in a reference link and a copyright credit is kept
+MIN_BOILERPLATE_LINE_SHARE = 0.3
+EDGE_PAGES = 20                # Pages from either end of the book where front and back matter is expected
+
+MIN_STRUCTURED_LINES = 6       # Lines needed before TOC/index patterns are considered
+MIN_STRUCTURED_RATIO = 0.4     # Share of lines matching the TOC or index pattern
+
+# "1.2 Gas Exchange ........ 45" or "Chapter 3  Acid-Base Balance   102"
+TOC_LINE = re.compile(r'^(?:chapter\s+)?[\w(].{2,}?(\s*\.{2,}\s*|\s+)(\d{1,4})$', re.IGNORECASE)
+# "Haemoglobin, 45, 112-118" or "Oxygen cascade, 23f, 24t"
+INDEX_LINE = re.compile(r'^[^\d].{1,80}?,\s*\d{1,4}[a-z]?(?:\s*[-–]\s*\d{1,4})?'
+                        r'(?:\s*,\s*\d{1,4}[a-z]?(?:\s*[-–]\s*\d{1,4})?)*$', re.IGNORECASE)
+CONTENTS_HEADING = re.compile(r'^\s*(table of )?contents\s*$', re.IGNORECASE | re.MULTILINE)
+INDEX_HEADING = re.compile(r'^\s*index\s*$', re.IGNORECASE | re.MULTILINE)
+
+
+def _lines(text):
+    return [line.strip() for line in text.splitlines() if line.strip()]
+
+
+def _is_toc(lines, text):
+    """Most lines end in increasing page numbers, under a Contents heading or after dot leaders.
+
+    Without either, a table of numbers looks the same, so the page is kept.
+    """
+    matches = [match for match in map(TOC_LINE.match, lines) if match]
+    if len(matches) < MIN_STRUCTURED_LINES:
+        return False
+    numbers = [int(match.group(2)) for match in matches]
+    increasing = sum(1 for a, b in zip(numbers, numbers[1:]) if b >= a)
+    if increasing < 0.7 * (len(numbers) - 1):
+        return False
+    if CONTENTS_HEADING.search(text):
+        return len(matches) / len(lines) >= MIN_STRUCTURED_RATIO / 2
+    leaders = sum(1 for match in matches if '..' in match.group(1))
+    return leaders >= MIN_STRUCTURED_LINES and leaders / len(lines) >= MIN_STRUCTURED_RATIO
+
+
+def _is_index(lines, text):
+    """Most lines are short terms followed by comma-separated page references."""
+    matches = sum(1 for line in lines if len(line) <= 90 and INDEX_LINE.match(line))
+    if matches < MIN_STRUCTURED_LINES:
+        return False
+    threshold = MIN_STRUCTURED_RATIO / 2 if INDEX_HEADING.search(text) else MIN_STRUCTURED_RATIO
+    return matches / len(lines) >= threshold
+
+
+def _is_boilerplate(text):
+    lowered = text.lower()
+    return bool(URL.search(text)) or any(keyword in lowered for keyword in BOILERPLATE_KEYWORDS)
+
+
+def boilerplate_score(text):
+    """Number of distinct boilerplate keywords on the page; any web addresses count as one."""
+    lowered = text.lower()
+    return sum(1 for keyword in BOILERPLATE_KEYWORDS if keyword in lowered) + bool(URL.search(text))
+
+
+def _near_edge(page_number, total_pages):
+    if page_number is None or not total_pages:
+        return False
+    return page_number <= EDGE_PAGES or page_number > total_pages - EDGE_PAGES
+
+
+def classify_page(text, min_chars=150, page_number=None, total_pages=None):
+    """Label a page as content, blank, front matter, table of contents or index.
+
+    page_number and total_pages (1-based), when given, let pages near either
+    end of the book count as front matter on keywords alone.
+    """
+    text = text or ""
+    density = len(text) - text.count(' ') - text.count('\n')
+    if density < min_chars:
+        return BLANK
+
+    lines = _lines(text)
+    if len(text) <= MAX_BOILERPLATE_CHARS and boilerplate_score(text) >= MIN_BOILERPLATE_HITS:
+        share = sum(1 for line in lines if _is_boilerplate(line)) / len(lines)
+        if _near_edge(page_number, total_pages) or share >= MIN_BOILERPLATE_LINE_SHARE:
+            return FRONT_MATTER
+
+    if _is_toc(lines, text):
+        return TOC
+    if _is_index(lines, text):
+        return INDEX
+    return CONTENT
+
+
+class PageStats:
+    """Per-book record of which pages were kept and why the others were skipped."""
+
+    def __init__(self, total_pages=0):
+        self.total_pages = total_pages
+        self.skipped = {}  # {page_number: label}, 1-based
+
+    def add(self, page_number, label):
+        if label != CONTENT:
+            self.skipped[page_number] = label
+
+    def counts(self):
+        counts = {}
+        for label in self.skipped.values():
+            counts[label] = counts.get(label, 0) + 1
+        return counts
+
+    def to_dict(self):
+        return {
+            'filter_version': FILTER_VERSION,
+            'total_pages': self.total_pages,
+            'kept_pages': self.total_pages - len(self.skipped),
+            'skipped': self.counts(),
+            'skipped_pages': {str(page): label for page, label in sorted(self.skipped.items())}
+        }
+
+    @staticmethod
+    def describe(stats):
+        """One-line summary of a to_dict() result."""
+        counts = ", ".join(f"{label}: {count}" for label, count in sorted(stats['skipped'].items()))
+        skipped = stats['total_pages'] - stats['kept_pages']
+        return f"Skipped {skipped}/{stats['total_pages']} low-value pages" + (f" ({counts})" if counts else "")
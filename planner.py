@@ -0,0 +1,300 @@
+import os
+import json
+import time
+from config import settings
+from cache_handler import CacheHandler
+from model_handler import ModelHandler
+from main import (
+    load_cached_text, load_page_stats, extract_text_cached, get_pdf_files, theme_section, unchanged_chapters,
+    build_themes_prompt, themes_cache_key, parse_themes_response,
+    build_cards_prompt, cards_cache_key,
+    chapter_card_budgets, calculate_cards_per_theme, calculate_theme_weights, distribute_count
+)
+
+# Estimation constants
+CHARS_PER_TOKEN = 4          # Rough average for English text
+DEFAULT_THEME_COUNT = 8      # analyze_themes asks for 5-10 themes
+FILENAME_OUTPUT_TOKENS = 30  # {"title": ..., "year": ...}
+THEMES_OUTPUT_TOKENS = 80    # JSON array of 5-10 short themes
+TOKENS_PER_CARD = 150        # Question, four options and an explanation
+DEFAULT_LATENCY = 5.0        # Seconds per uncached LLM request
+CRITICAL_PATH_REQUESTS = 3   # process_pdf: filename, then chapter themes, then their cards
+
+
+class RunPlan:
+    """Collects the LLM requests a run would make, without making any of them."""
+
+    def __init__(self, command, cache_handler):
+        self.command = command
+        self.cache_handler = cache_handler
+        self.books = []
+        self.requests = []  # [{'kind', 'cached', 'input_tokens', 'output_tokens'}]
+        self.extraction_seconds = 0.0
+        self._responses = {}  # {cache_key: cached response or None}
+
+    def add_request(self, kind, prompt, output_tokens, cache_key=None):
+        """Record a request; returns the cached response if there is one."""
+        response = None
+        cached = False
+        if cache_key in self._responses:
+            # A repeated key is served from the cache after the first call in the run
+            response = self._responses[cache_key]
+            cached = True
+        elif cache_key:
+            response = self.cache_handler.get(cache_key)
+            cached = response is not None
+            self._responses[cache_key] = response
+        self.requests.append({
+            'kind': kind,
+            'cached': cached,
+            'input_tokens': len(prompt) // CHARS_PER_TOKEN,
+            'output_tokens': output_tokens
+        })
+        return response
+
+    def resolve_book_name(self, pdf_path):
+        """Book name for a PDF, from the cached clean_filename response when available."""
+        filename = os.path.basename(pdf_path)
+        response = self.add_request('filename', ModelHandler.build_filename_prompt(filename), FILENAME_OUTPUT_TOKENS,
+                                    ModelHandler.filename_cache_key(filename))
+        if response:
+            try:
+                return ModelHandler.parse_filename_response(response)
+            except Exception:
+                pass
+        return ModelHandler.fallback_filename(filename)
+
+    def load_text(self, pdf_path):
+        """Read cached text for a PDF, extracting (and caching) it if needed."""
+        text = load_cached_text(pdf_path)
+        if text is not None:
+            return text, True
+        start = time.time()
+        text = extract_text_cached(pdf_path)
+        self.extraction_seconds += time.time() - start
+        return text, False
+
+    def summary(self, rate_limit=None, concurrency=None, parallel_books=1, latency=DEFAULT_LATENCY):
+        """Aggregate the plan into request, token and wall-clock estimates (limits default to settings)."""
+        rate_limit = settings.rate_limit if rate_limit is None else rate_limit
+        concurrency = settings.max_concurrency if concurrency is None else concurrency
+        total = len(self.requests)
+        api_requests = sum(1 for r in self.requests if not r['cached'])
+        input_tokens = sum(r['input_tokens'] for r in self.requests if not r['cached'])
+        output_tokens = sum(r['output_tokens'] for r in self.requests if not r['cached'])
+
+        rate_bound = api_requests * 60 / rate_limit if rate_limit else 0
+        if self.command == 'process':
+            # Chapters and their themes run in parallel, so a book's critical path
+            # is its filename, themes and cards requests one after another.
+            parallelism = max(1, concurrency)
+            longest_book = CRITICAL_PATH_REQUESTS * latency if api_requests else 0
+        else:
+            # Generation requests within one book run one after another, so the
+            # effective parallelism is bounded by the number of books at once.
+            parallelism = max(1, min(concurrency, parallel_books))
+            longest_book = max((book.get('api_requests', 0) for book in self.books), default=0) * latency
+        latency_bound = api_requests * latency / parallelism
+        estimated_seconds = max(rate_bound, latency_bound, longest_book)
+
+        by_kind = {}
+        for r in self.requests:
+            kind = by_kind.setdefault(r['kind'], {'requests': 0, 'cached': 0})
+            kind['requests'] += 1
+            kind['cached'] += int(r['cached'])
+
+        return {
+            'command': self.command,
+            'books': self.books,
+            'requests': total,
+            'api_requests': api_requests,
+            'cached_requests': total - api_requests,
+            'cache_hit_fraction': round((total - api_requests) / total, 3) if total else 0.0,
+            'requests_by_kind': by_kind,
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens,
+            'estimated_seconds': round(estimated_seconds, 1),
+            'extraction_seconds': round(self.extraction_seconds, 1),
+            'assumptions': {
+                'rate_limit_per_minute': rate_limit,
+                'concurrency': concurrency,
+                'parallel_books': parallel_books,
+                'latency_seconds': latency,
+                'chars_per_token': CHARS_PER_TOKEN
+            }
+        }
+
+
+def _book_request_count(plan, start):
+    """Number of uncached requests recorded since index start."""
+    return sum(1 for r in plan.requests[start:] if not r['cached'])
+
+
+def _plan_cards(plan, cards_per_theme, text):
+    """Record one card generation request per theme."""
+    for theme, count in cards_per_theme.items():
+        if count > 0:
+            plan.add_request('cards', build_cards_prompt(theme, text, count),
+                             count * TOKENS_PER_CARD, cards_cache_key(theme, text, count))
+
+
+def plan_process(pdf_paths, cache_handler=None):
+    """Plan process_pdf for each PDF: filename, themes and per-theme card requests."""
+    plan = RunPlan('process', cache_handler or CacheHandler(settings.cache_dir))
+    for pdf_path in pdf_paths:
+        start = len(plan.requests)
+        book_name = plan.resolve_book_name(pdf_path)
+        text, text_cached = plan.load_text(pdf_path)
+        book = {'book': book_name, 'pdf': pdf_path, 'text_cached': text_cached,
+                'page_stats': load_page_stats(pdf_path)}
+        plan.books.append(book)
+        if not text:
+            book['error'] = "No text could be extracted"
+            continue
+
+        # One themes request per changed chapter, then one cards request per chapter theme
+        reused, _, _ = unchanged_chapters(book_name, text)
+        themes_known = True
+        themes_total = 0
+        cards_total = 0
+        budgets = chapter_card_budgets([len(section) for section in text])
+        for i, section in enumerate(text):
+            if i in reused:
+                themes, cards = reused[i]
+                themes_total += len(themes)
+                cards_total += len(cards)
+                continue
+            response = plan.add_request('themes', build_themes_prompt(section), THEMES_OUTPUT_TOKENS,
+                                        themes_cache_key(section))
+            themes = parse_themes_response(response) if response else None
+            if themes:
+                cards_per_theme = calculate_cards_per_theme(themes, budgets[i])
+                _plan_cards(plan, cards_per_theme, section)
+            else:
+                # Themes are unknown until analyzed, so their card requests can't be cached
+                themes_known = False
+                themes = [f"Theme {i + 1}" for i in range(DEFAULT_THEME_COUNT)]
+                cards_per_theme = calculate_cards_per_theme(themes, budgets[i])
+                for theme, count in cards_per_theme.items():
+                    plan.add_request('cards', build_cards_prompt(theme, section, count), count * TOKENS_PER_CARD)
+            themes_total += len(themes)
+            cards_total += sum(cards_per_theme.values())
+
+        book.update({
+            'characters': sum(len(s) for s in text),
+            'chapters': len(text),
+            'unchanged_chapters': len(reused),
+            'themes_known': themes_known,
+            'themes': themes_total,
+            'cards_per_theme': round(cards_total / themes_total, 1) if themes_total else 0,
+            'cards': cards_total,
+            'api_requests': _book_request_count(plan, start)
+        })
+    return plan
+
+
+def _load_themes(book_name):
+    theme_path = os.path.join(settings.themes_dir, f"{book_name}_themes.json")
+    if not os.path.exists(theme_path):
+        return None
+    with open(theme_path, 'r') as f:
+        return json.load(f)
+
+
+def _plan_book_generation(plan, book_name, count, theme=None):
+    """Mirror generate_random_flashcards / generate_additional_flashcards for one book."""
+    start = len(plan.requests)
+    book = {'book': book_name, 'cards': count}
+    plan.books.append(book)
+
+    themes = _load_themes(book_name)
+    if not themes or (theme and theme not in themes):
+        book['error'] = "Theme not found" if themes else "No themes found"
+        return
+
+    # The pipeline cleans every PDF filename until it finds the matching book
+    pdf_path = None
+    for path in get_pdf_files():
+        if plan.resolve_book_name(path) == book_name:
+            pdf_path = path
+            break
+    if not pdf_path:
+        book['error'] = "Original PDF not found"
+        return
+
+    text, text_cached = plan.load_text(pdf_path)
+    book.update({'pdf': pdf_path, 'text_cached': text_cached})
+    if not text:
+        book['error'] = "No text could be extracted"
+        return
+
+    full_text = "\n".join(text)
+    if theme:
+        cards_per_theme = {theme: count}
+    else:
+        cards_per_theme = distribute_count(calculate_theme_weights(themes, full_text), count)
+    for theme_name, theme_count in cards_per_theme.items():
+        _plan_cards(plan, {theme_name: theme_count}, theme_section(theme_name, text))
+    book.update({
+        'characters': len(full_text),
+        'themes': len(cards_per_theme),
+        'cards_per_theme': cards_per_theme,
+        'api_requests': _book_request_count(plan, start)
+    })
+
+
+def plan_generate(book_name, count, theme=None, cache_handler=None):
+    """Plan generating count more cards for one book."""
+    plan = RunPlan('generate', cache_handler or CacheHandler(settings.cache_dir))
+    _plan_book_generation(plan, book_name, count, theme)
+    return plan
+
+
+def plan_all_books(count, cache_handler=None):
+    """Plan a mixed all-books generation of count cards."""
+    plan = RunPlan('all-books', cache_handler or CacheHandler(settings.cache_dir))
+    all_themes = {}
+    for theme_file in os.listdir(settings.themes_dir):
+        if theme_file.endswith('_themes.json'):
+            book_name = theme_file.replace('_themes.json', '')
+            themes = _load_themes(book_name)
+            if themes:
+                all_themes[book_name] = themes
+    if not all_themes:
+        return plan
+
+    cards_per_book = distribute_count({book: len(themes) for book, themes in all_themes.items()}, count)
+    for book_name, book_count in cards_per_book.items():
+        if book_count > 0:
+            _plan_book_generation(plan, book_name, book_count)
+    return plan
+
+
+def format_plan(summary):
+    """Human-readable rendering of a plan summary."""
+    minutes = summary['estimated_seconds'] / 60
+    lines = [
+        f"Dry run: {summary['command']} ({len(summary['books'])} book(s))",
+        "=" * 50
+    ]
+    for book in summary['books']:
+        if 'error' in book:
+            lines.append(f"- {book['book']}: skipped ({book['error']})")
+        else:
+            pages = book.get('page_stats')
+            skipped = f", {pages['total_pages'] - pages['kept_pages']} low-value pages skipped" if pages else ""
+            chapters = f"{book['chapters']} chapters, " if book.get('chapters', 1) > 1 else ""
+            if book.get('unchanged_chapters'):
+                chapters += f"{book['unchanged_chapters']} unchanged, "
+            lines.append(f"- {book['book']}: {chapters}{book.get('themes', 0)} themes, "
+                         f"{book.get('api_requests', 0)} API requests{skipped}")
+    lines += [
+        "",
+        f"Requests:          {summary['requests']} ({summary['cached_requests']} cached, "
+        f"{summary['api_requests']} to the API)",
+        f"Cache hit fraction: {summary['cache_hit_fraction']:.0%}",
+        f"Tokens (API only):  ~{summary['input_tokens']} in / ~{summary['output_tokens']} out",
+        f"Estimated time:     ~{minutes:.1f} min at {summary['assumptions']['rate_limit_per_minute']} req/min",
+        f"Text extraction:    {summary['extraction_seconds']}s during planning (now cached)",
+    ]
+    return "\n".join(lines) + "\n"
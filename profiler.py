@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import inspect
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from datetime import datetime
+from config import settings
+
+TOP_FUNCTIONS = 30  # cProfile entries listed in summary.json
+
+# Innermost stage of the running task or thread, a _Frame
+_stage = contextvars.ContextVar('profiler_stage', default=None)
+
+
+class _Frame:
+    """One entered stage: CPU time charged to it and its enclosing stages."""
+
+    __slots__ = ('name', 'parent', 'cpu', 'self_cpu')
+
+    def __init__(self, name, parent):
+        self.name = name
+        self.parent = parent
+        self.cpu = 0.0
+        self.self_cpu = 0.0
+
+    def charge(self, seconds):
+        self.self_cpu += seconds
+        frame = self
+        while frame is not None:
+            frame.cpu += seconds
+            frame = frame.parent
+
+    def path(self):
+        names = []
+        frame = self
+        while frame is not None:
+            names.append(frame.name)
+            frame = frame.parent
+        return names[::-1]
+
+
+class StageStats:
+    """Totals for one stage name across every time it was entered."""
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = 0.0      # Inclusive; concurrent entries each count, so this can exceed the run time
+        self.cpu = 0.0       # CPU time in this stage and the stages inside it
+        self.self_cpu = 0.0  # CPU time in this stage only
+
+    def to_dict(self):
+        return {
+            'calls': self.calls,
+            'wall_seconds': round(self.wall, 6),
+            'cpu_seconds': round(self.cpu, 6),
+            'self_cpu_seconds': round(self.self_cpu, 6),
+            # Time the stage was entered but not running: awaiting the API, a lock, another thread
+            'await_seconds': round(max(self.wall - self.cpu, 0.0), 6)
+        }
+
+
+class Profiler:
+    """On-demand profiling of runs: cProfile, wall-clock stack samples and CPU vs await time per stage.
+
+    Stages are named blocks (every metrics span, plus the functions wrapped
+    with profiled()). While a session runs, the CPU time of each event loop
+    step and of each stage in a worker thread is charged to the stage it
+    ran in; the rest of a stage's wall time was spent awaiting. Outside a
+    session stage() only checks a flag, and asyncio is left unpatched.
+
+    cProfile sees the thread that started the session (the event loop);
+    the sampler sees every thread. Extraction in worker processes is not
+    profiled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._sessions = 0
+        self._session_id = 0
+        self.active = False
+
+    # Stages -------------------------------------------------------------------
+
+    def _switch(self, frame):
+        """Charge this thread's CPU time since the last switch to its stage, then make frame current."""
+        now = time.thread_time()
+        local = self._local
+        # A frame left over from an earlier session is dropped, not charged
+        current = getattr(local, 'frame', None) if getattr(local, 'session', None) == self._session_id else None
+        if current is not None:
+            current.charge(now - local.mark)
+        local.frame = frame
+        local.mark = now
+        local.session = self._session_id
+        self._thread_stages[threading.get_ident()] = frame
+        return current
+
+    @contextmanager
+    def stage(self, name, **labels):
+        """Attribute a block of code (sync or async) to a stage while profiling."""
+        if not self.active:
+            yield
+            return
+        if labels:
+            name = f"{name}[{','.join(f'{k}={v}' for k, v in sorted(labels.items()))}]"
+        frame = _Frame(name, _stage.get())
+        token = _stage.set(frame)
+        self._switch(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - start
+            _stage.reset(token)
+            if self.active:
+                self._switch(frame.parent)
+                with self._lock:
+                    stats = self._stages.get(name)
+                    if stats is None:
+                        stats = self._stages[name] = StageStats()
+                    stats.calls += 1
+                    stats.wall += wall
+                    stats.cpu += frame.cpu
+                    stats.self_cpu += frame.self_cpu
+
+    def profiled(self, name):
+        """Decorator running a function (sync or async) as a stage."""
+        def decorate(func):
+            if inspect.iscoroutinefunction(func):
+                @functools.wraps(func)
+                async def wrapper(*args, **kwargs):
+                    with self.stage(name):
+                        return await func(*args, **kwargs)
+            else:
+                @functools.wraps(func)
+                def wrapper(*args, **kwargs):
+                    with self.stage(name):
+                        return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    # Event loop hook ----------------------------------------------------------
+
+    def _install_loop_hook(self):
+        """Wrap asyncio's Handle._run so each callback's CPU time goes to the stage of its task."""
+        from asyncio import events
+
+        original = self._original_run = events.Handle._run
+        switch = self._switch
+
+        def _run(handle):
+            previous = switch(handle._context.get(_stage))
+            try:
+                original(handle)
+            finally:
+                switch(previous)
+
+        events.Handle._run = _run
+
+    def _remove_loop_hook(self):
+        from asyncio import events
+
+        events.Handle._run = self._original_run
+
+    # Wall-clock sampler -------------------------------------------------------
+
+    def _sample_loop(self, interval):
+        own = threading.get_ident()
+        while not self._stop_sampling.wait(interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                calls = []
+                while frame is not None:
+                    code = frame.f_code
+                    calls.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stage = self._thread_stages.get(ident)
+                stages = [f"stage:{name}" for name in stage.path()] if stage else []
+                stack = ";".join([names.get(ident, str(ident))] + stages + calls[::-1]).replace('\n', ' ')
+                key = (stage.name if stage else None, stack)
+                self._samples[key] = self._samples.get(key, 0) + 1
+
+    # Sessions -----------------------------------------------------------------
+
+    def start(self, name="run"):
+        """Start profiling in the calling thread, or join the session already running."""
+        import cProfile
+
+        with self._lock:
+            self._sessions += 1
+            if self._sessions > 1:
+                return
+            self.name = name
+            self._session_id += 1
+            self._stages = {}         # {stage name: StageStats}
+            self._samples = {}        # {(innermost stage, collapsed stack): count}
+            self._thread_stages = {}  # {thread id: current _Frame}, read by the sampler
+            self._started_at = datetime.now()
+            self._start = time.perf_counter()
+            self._start_cpu = time.process_time()
+            self.active = True
+        self._install_loop_hook()
+        self._cprofile = cProfile.Profile()
+        self._cprofile.enable()
+        self._stop_sampling = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, args=(settings.profile_sample_interval,),
+                                         name="profile-sampler", daemon=True)
+        self._sampler.start()
+
+    def stop(self):
+        """Leave the session; the last to leave writes it out. Returns its paths, or None."""
+        with self._lock:
+            self._sessions -= 1
+            if self._sessions > 0:
+                return None
+            self.active = False
+        self._cprofile.disable()
+        self._stop_sampling.set()
+        self._sampler.join()
+        self._remove_loop_hook()
+        return self.write()
+
+    @asynccontextmanager
+    async def session(self, name="run"):
+        """Profile the enclosed block; yields a dict that holds the output paths once written."""
+        paths = {}
+        self.start(name)
+        try:
+            yield paths
+        finally:
+            paths.update(self.stop() or {})
+
+    # Output -------------------------------------------------------------------
+
+    def _top_functions(self):
+        import pstats
+
+        stats = pstats.Stats(self._cprofile)
+        rows = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            rows.append({'function': f"{function} ({os.path.basename(filename)}:{line})", 'calls': calls,
+                         'own_seconds': round(own, 6), 'cumulative_seconds': round(cumulative, 6)})
+        rows.sort(key=lambda row: row['cumulative_seconds'], reverse=True)
+        return rows[:TOP_FUNCTIONS]
+
+    def write(self, profiling_dir=None):
+        """Write the session to <profiling_dir>/<name>_<time>/.
+
+        profile.prof is cProfile output (pstats, snakeviz). wall.folded holds
+        the wall-clock samples as collapsed stacks for flamegraph.pl,
+        speedscope or inferno, rooted at thread and stage; stages/ has one
+        file per innermost stage. summary.json has the per-stage table.
+        """
+        directory = os.path.join(profiling_dir or settings.profiling_dir,
+                                 f"{self.name}_{self._started_at.strftime('%Y%m%d_%H%M%S')}")
+        os.makedirs(os.path.join(directory, 'stages'), exist_ok=True)
+
+        prof_path = os.path.join(directory, 'profile.prof')
+        self._cprofile.dump_stats(prof_path)
+
+        by_stage = {}
+        for (stage, stack), count in self._samples.items():
+            by_stage.setdefault(stage, []).append(f"{stack} {count}\n")
+        folded_path = os.path.join(directory, 'wall.folded')
+        with open(folded_path, 'w', encoding='utf-8') as f:
+            f.writelines(sorted(line for lines in by_stage.values() for line in lines))
+        for stage, lines in by_stage.items():
+            if stage is not None:
+                filename = "".join(c if c.isalnum() or c in '-_.' else '_' for c in stage)
+                with open(os.path.join(directory, 'stages', f"{filename}.folded"), 'w', encoding='utf-8') as f:
+                    f.writelines(sorted(lines))
+
+        summary_path = os.path.join(directory, 'summary.json')
+        with open(summary_path, 'w') as f:
+            json.dump({
+                'run': self.name,
+                'started_at': self._started_at.isoformat(),
+                'wall_seconds': round(time.perf_counter() - self._start, 3),
+                'cpu_seconds': round(time.process_time() - self._start_cpu, 3),
+                'samples': sum(self._samples.values()),
+                'sample_interval': settings.profile_sample_interval,
+                'stages': {name: stats.to_dict()
+                           for name, stats in sorted(self._stages.items(), key=lambda item: -item[1].wall)},
+                'top_functions': self._top_functions()
+            }, f, indent=2)
+        return {'directory': directory, 'summary': summary_path, 'cprofile': prof_path, 'flamegraph': folded_path}
+
+
+# Shared profiler used by every module
+profiler = Profiler()
@@ -0,0 +1,147 @@
+import asyncio
+from config import settings
+
+SYSTEM_PROMPT = "You are a medical education expert specialized in creating clear, accurate multiple choice questions."
+
+# Registry of provider classes by name
+PROVIDERS = {}
+
+
+def register_provider(name):
+    """Class decorator adding a provider to the registry."""
+    def decorator(cls):
+        cls.name = name
+        PROVIDERS[name] = cls
+        return cls
+    return decorator
+
+
+def create_provider(name, **options):
+    """Instantiate a registered provider by name."""
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown provider '{name}', expected one of {sorted(PROVIDERS)}")
+    return PROVIDERS[name](**options)
+
+
+class ProviderError(Exception):
+    """HTTP error returned by a provider. 429 means the quota is exhausted."""
+
+    def __init__(self, provider, status, message):
+        self.provider = provider
+        self.status = status
+        super().__init__(f"{provider} returned HTTP {status}: {message}")
+
+    @property
+    def rate_limited(self):
+        return self.status == 429
+
+
+class Provider:
+    """Base class for LLM providers: send one prompt, get the response text."""
+    name = None
+
+    async def generate(self, prompt):
+        raise NotImplementedError
+
+    async def close(self):
+        """Release pooled connections."""
+
+
+class HTTPProvider(Provider):
+    """Provider talking to an HTTP API through one pooled keep-alive session."""
+
+    def __init__(self, base_url, headers=None, max_connections=None, timeout=None, keepalive_timeout=None):
+        self.base_url = base_url.rstrip('/')
+        self.headers = headers or {}
+        self.max_connections = max_connections or settings.http_max_connections
+        self.timeout = timeout or settings.http_timeout
+        self.keepalive_timeout = keepalive_timeout or settings.http_keepalive_timeout
+        self._session = None
+        self._session_loop = None
+
+    def _get_session(self):
+        """Return the pooled session, creating it on first use in this event loop."""
+        import aiohttp  # Deferred: aiohttp takes a noticeable share of startup time
+
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            # Sessions are bound to the loop they were created in
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=self.keepalive_timeout
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                headers=self.headers,
+                timeout=aiohttp.ClientTimeout(total=self.timeout)
+            )
+            self._session_loop = loop
+        return self._session
+
+    async def _post_json(self, path, payload):
+        session = self._get_session()
+        async with session.post(f"{self.base_url}{path}", json=payload) as response:
+            if response.status >= 400:
+                text = await response.text()
+                raise ProviderError(self.name, response.status, text[:300])
+            return await response.json(content_type=None)
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            if self._session_loop is asyncio.get_running_loop():
+                await self._session.close()
+        self._session = None
+        self._session_loop = None
+
+
+@register_provider("gemini")
+class GeminiProvider(HTTPProvider):
+    """Google Gemini through the generateContent REST API."""
+    DEFAULT_MODEL = 'gemini-2.0-flash-exp'
+    BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+
+    def __init__(self, api_key, model=DEFAULT_MODEL, base_url=BASE_URL, **options):
+        super().__init__(base_url, headers={'x-goog-api-key': api_key}, **options)
+        self.model = model
+
+    async def generate(self, prompt):
+        data = await self._post_json(
+            f"/models/{self.model}:generateContent",
+            {"contents": [{"role": "user", "parts": [{"text": prompt}]}]}
+        )
+        try:
+            parts = data['candidates'][0]['content']['parts']
+        except (KeyError, IndexError):
+            raise Exception(f"Gemini returned no content: {str(data)[:300]}")
+        return "".join(part.get('text', '') for part in parts)
+
+
+@register_provider("local")
+class OpenAICompatibleProvider(HTTPProvider):
+    """Any server exposing an OpenAI-compatible /chat/completions endpoint."""
+    DEFAULT_MODEL = 'local-model'
+
+    def __init__(self, base_url, model=DEFAULT_MODEL, api_key=None, **options):
+        headers = {'Authorization': f"Bearer {api_key}"} if api_key else {}
+        super().__init__(base_url, headers=headers, **options)
+        self.model = model
+
+    async def generate(self, prompt):
+        data = await self._post_json("/chat/completions", {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ]
+        })
+        return data['choices'][0]['message']['content']
+
+
+@register_provider("mistral")
+class MistralProvider(OpenAICompatibleProvider):
+    """Mistral's chat completions API, which follows the OpenAI format."""
+    DEFAULT_MODEL = 'mistral-small-latest'
+    BASE_URL = "https://api.mistral.ai/v1"
+
+    def __init__(self, api_key, model=DEFAULT_MODEL, base_url=BASE_URL, **options):
+        super().__init__(base_url, model=model, api_key=api_key, **options)
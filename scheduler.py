@@ -0,0 +1,163 @@
+import time
+import asyncio
+import contextvars
+from contextlib import contextmanager, asynccontextmanager
+from metrics import metrics
+from profiler import profiler
+
+# Request classes, most urgent first
+INTERACTIVE = 'interactive'  # Someone is waiting on the result (GUI "Generate Cards")
+NORMAL = 'normal'            # Jobs the user started: processing books, CLI runs
+BACKGROUND = 'background'    # Work nobody is waiting on: card pool refills
+PRIORITIES = (INTERACTIVE, NORMAL, BACKGROUND)
+
+# Class of the LLM requests made by the running task
+_priority = contextvars.ContextVar('llm_priority', default=NORMAL)
+
+
+@contextmanager
+def request_priority(priority):
+    """Send the LLM requests made in the enclosed block, and in tasks started from it, as priority."""
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of {list(PRIORITIES)}, got '{priority}'")
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority():
+    return _priority.get()
+
+
+class Request:
+    """One LLM request waiting for, or holding, a slot. Its class can be raised while it waits."""
+
+    __slots__ = ('priority',)
+
+    def __init__(self, priority=None):
+        self.priority = priority or current_priority()
+
+
+class _Waiter:
+    __slots__ = ('request', 'enqueued', 'future')
+
+    def __init__(self, request, future):
+        self.request = request
+        self.enqueued = time.monotonic()
+        self.future = future
+
+
+class RequestScheduler:
+    """Hands out LLM request slots by priority, within the concurrency and rate limits.
+
+    A request waits until fewer than settings.max_concurrency are running
+    and the rate limit allows the next one to start; the scheduler then
+    picks which waiting request goes, so an interactive request jumps the
+    queue of background work instead of waiting behind it. Requests
+    already sent are never interrupted.
+
+    When several classes are waiting, slots are shared in proportion to
+    the <class>_weight settings (stride scheduling), so background work
+    keeps moving while the GUI is busy. On top of that a request moves up
+    one class for every settings.priority_aging_seconds it has waited.
+
+    Per class, llm_queue_depth is the number of requests waiting and
+    llm_queue_wait_seconds how long each waited for its slot.
+    """
+
+    def __init__(self, settings, spacing):
+        self.settings = settings
+        self._spacing = spacing  # Seconds between request starts, from the rate limit
+        self._waiting = []       # _Waiter, in arrival order
+        self._running = 0
+        self._next_request_time = 0
+        self._passes = {priority: 0.0 for priority in PRIORITIES}
+        self._virtual_time = 0.0
+        self._timer = None
+
+    def _weight(self, priority):
+        return getattr(self.settings, f"{priority}_weight")
+
+    def _effective_rank(self, waiter, now):
+        """The waiter's class rank, raised one class per priority_aging_seconds waited."""
+        rank = PRIORITIES.index(waiter.request.priority)
+        aging = self.settings.priority_aging_seconds
+        if aging:
+            rank -= int((now - waiter.enqueued) // aging)
+        return max(rank, 0)
+
+    def _pick(self, now):
+        """The waiter to start next: the oldest in the class with the lowest pass."""
+        oldest = {}
+        for waiter in self._waiting:
+            oldest.setdefault(self._effective_rank(waiter, now), waiter)
+        # A class that was idle starts at the current virtual time, so it cannot claim the slots it skipped
+        rank = min(oldest, key=lambda r: (max(self._passes[PRIORITIES[r]], self._virtual_time), r))
+        priority = PRIORITIES[rank]
+        self._virtual_time = max(self._passes[priority], self._virtual_time)
+        self._passes[priority] = self._virtual_time + 1 / self._weight(priority)
+        waiter = oldest[rank]
+        if rank != PRIORITIES.index(waiter.request.priority):
+            metrics.inc('llm_requests_aged_total', priority=waiter.request.priority)
+        return waiter
+
+    def _dispatch(self):
+        """Start waiting requests while slots are free and the rate limit allows."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        # Cancelled waiters are removed here, before their task gets to run again
+        self._waiting = [waiter for waiter in self._waiting if not waiter.future.done()]
+        while self._waiting and self._running < self.settings.max_concurrency:
+            now = time.monotonic()
+            delay = self._next_request_time - now
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                break
+            waiter = self._pick(now)
+            self._waiting.remove(waiter)
+            self._next_request_time = max(now, self._next_request_time) + self._spacing()
+            self._running += 1
+            metrics.observe('llm_queue_wait_seconds', now - waiter.enqueued, priority=waiter.request.priority)
+            waiter.future.set_result(None)
+        self._update_depth()
+
+    def _update_depth(self):
+        depth = dict.fromkeys(PRIORITIES, 0)
+        for waiter in self._waiting:
+            depth[waiter.request.priority] += 1
+        for priority, count in depth.items():
+            metrics.set('llm_queue_depth', count, priority=priority)
+        metrics.set('llm_requests_running', self._running)
+
+    def promote(self, request, priority):
+        """Raise a request's class, e.g. when a more urgent caller joins it."""
+        if PRIORITIES.index(priority) < PRIORITIES.index(request.priority):
+            request.priority = priority
+            self._update_depth()
+
+    def _release(self):
+        self._running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, request):
+        """Wait for a slot for request, holding it for the enclosed block."""
+        waiter = _Waiter(request, asyncio.get_running_loop().create_future())
+        self._waiting.append(waiter)
+        with profiler.stage('llm_queue_wait', priority=request.priority):
+            self._dispatch()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.done() and not waiter.future.cancelled():
+                    self._release()  # Granted, but cancelled before it could start
+                else:
+                    self._dispatch()
+                raise
+        try:
+            yield
+        finally:
+            self._release()
@@ -0,0 +1,423 @@
+import os
+import json
+import time
+import socket
+import sqlite3
+import asyncio
+import contextlib
+from config import settings
+from metrics import metrics
+from main import (
+    extract_text_async, load_chapters, analyze_themes, merge_themes, chapter_card_budgets, calculate_cards_per_theme,
+    generate_flashcards_for_theme, save_outputs, reusable_chapters, save_manifest
+)
+from manifest import chunk_hash, saved_cards_by_chunk
+
+# Job states
+QUEUED = 'queued'
+LEASED = 'leased'
+DONE = 'done'
+DEAD = 'dead'  # Out of attempts; kept for inspection and retry_dead()
+
+# Stages of a book: one themes job, then a cards job per chapter theme, then a save job once every cards job finished
+THEMES = 'themes'
+CARDS = 'cards'
+SAVE = 'save'
+STAGE_PRIORITY = {SAVE: 0, CARDS: 1, THEMES: 2}  # Finish books already started before starting new ones
+
+MAX_CACHED_TEXTS = 4  # Book texts a worker keeps in memory for its cards jobs
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    book TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    theme TEXT NOT NULL DEFAULT '',
+    payload TEXT,
+    after_stage TEXT,
+    priority INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    max_attempts INTEGER NOT NULL,
+    available_at REAL NOT NULL,
+    lease_owner TEXT,
+    lease_expires REAL,
+    result TEXT,
+    error TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    UNIQUE (book, stage, theme)
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, priority, available_at);
+"""
+
+
+def worker_id():
+    """Lease owner name for this process: host and pid."""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _job(row):
+    job = dict(row)
+    job['payload'] = json.loads(job['payload']) if job['payload'] else None
+    job['result'] = json.loads(job['result']) if job['result'] else None
+    return job
+
+
+class WorkQueue:
+    """Durable queue of (book, stage, theme) jobs in a SQLite file shared by worker processes and hosts.
+
+    A worker leases a job for queue_lease_seconds and renews the lease with
+    heartbeat(); a job whose lease runs out goes back to the queue for
+    another worker. Failed jobs are retried after a growing delay and
+    dead-lettered after max_attempts. A job with after_stage only becomes
+    available once every job of that stage for the same book has finished.
+
+    Every call uses its own short connection, so one queue object can be
+    used from several threads. Hosts need a shared file system with working
+    file locks.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or settings.queue_path
+        with contextlib.closing(self._connect()) as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """Connection holding the database write lock until the block ends."""
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            yield conn
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _insert(self, conn, book, stage, theme='', payload=None, after_stage=None, priority=None,
+                max_attempts=None):
+        now = time.time()
+        # A finished (done or dead) job with the same key is run again; a queued or leased one is left alone
+        cursor = conn.execute(
+            "INSERT INTO jobs (book, stage, theme, payload, after_stage, priority, max_attempts,"
+            " available_at, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+            " ON CONFLICT (book, stage, theme) DO UPDATE SET payload = excluded.payload,"
+            " after_stage = excluded.after_stage, priority = excluded.priority, status = 'queued', attempts = 0,"
+            " max_attempts = excluded.max_attempts, available_at = excluded.available_at, lease_owner = NULL,"
+            " lease_expires = NULL, result = NULL, error = NULL, created_at = excluded.created_at,"
+            " updated_at = excluded.updated_at WHERE jobs.status IN ('done', 'dead')",
+            (book, stage, theme or '', json.dumps(payload), after_stage,
+             STAGE_PRIORITY.get(stage, 0) if priority is None else priority,
+             max_attempts or settings.queue_max_attempts, now, now, now)
+        )
+        return cursor.rowcount == 1
+
+    def enqueue(self, book, stage, theme='', **options):
+        """Add a job unless the same (book, stage, theme) is queued or leased. Returns True if added.
+
+        A finished job with the same key is queued again.
+        """
+        with self._transaction() as conn:
+            return self._insert(conn, book, stage, theme, **options)
+
+    def enqueue_book(self, book, payload):
+        """Queue a book's first stage, clearing the jobs of its previous run.
+
+        Returns False, changing nothing, while the book still has jobs queued
+        or leased.
+        """
+        with self._transaction() as conn:
+            if conn.execute("SELECT 1 FROM jobs WHERE book = ? AND status IN ('queued', 'leased') LIMIT 1",
+                            (book,)).fetchone():
+                return False
+            # Done cards jobs of the previous run would otherwise be saved with the new run's cards
+            conn.execute("DELETE FROM jobs WHERE book = ?", (book,))
+            return self._insert(conn, book, THEMES, payload=payload)
+
+    def _expire_leases(self, conn, now):
+        """Requeue jobs whose worker stopped renewing the lease, or dead-letter them when out of attempts."""
+        conn.execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'queued' END,"
+            " error = 'Lease expired (' || lease_owner || ')', lease_owner = NULL, lease_expires = NULL,"
+            " updated_at = ? WHERE status = 'leased' AND lease_expires < ?",
+            (now, now)
+        )
+
+    def lease(self, owner, lease_seconds=None):
+        """Lease the next available job to owner. Returns the job as a dict, or None."""
+        lease_seconds = lease_seconds or settings.queue_lease_seconds
+        now = time.time()
+        with self._transaction() as conn:
+            self._expire_leases(conn, now)
+            row = conn.execute(
+                "SELECT * FROM jobs AS j WHERE status = 'queued' AND available_at <= ?"
+                " AND (after_stage IS NULL OR NOT EXISTS (SELECT 1 FROM jobs AS d WHERE d.book = j.book"
+                " AND d.stage = j.after_stage AND d.status IN ('queued', 'leased')))"
+                " ORDER BY priority, available_at, id LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'leased', lease_owner = ?, lease_expires = ?, attempts = attempts + 1,"
+                " updated_at = ? WHERE id = ?",
+                (owner, now + lease_seconds, now, row['id'])
+            )
+        job = _job(row)
+        job.update(status=LEASED, lease_owner=owner, attempts=job['attempts'] + 1)
+        return job
+
+    def heartbeat(self, job, lease_seconds=None):
+        """Extend a lease. Returns False if it was lost, e.g. after expiring."""
+        lease_seconds = lease_seconds or settings.queue_lease_seconds
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET lease_expires = ?, updated_at = ? WHERE id = ? AND status = 'leased'"
+                " AND lease_owner = ?",
+                (now + lease_seconds, now, job['id'], job['lease_owner'])
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job, result=None, children=()):
+        """Mark a leased job done and add its follow-up jobs in the same transaction.
+
+        Returns False, adding nothing, if the lease was lost in the meantime.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_owner = NULL,"
+                " lease_expires = NULL, updated_at = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (json.dumps(result), now, job['id'], job['lease_owner'])
+            )
+            if cursor.rowcount != 1:
+                return False
+            for child in children:
+                self._insert(conn, **child)
+            return True
+
+    def fail(self, job, error, retry_delay=None):
+        """Requeue a failed job after a delay growing with its attempts, or dead-letter it.
+
+        Returns the job's new status, or None if the lease was lost.
+        """
+        retry_delay = settings.queue_retry_delay if retry_delay is None else retry_delay
+        now = time.time()
+        status = DEAD if job['attempts'] >= job['max_attempts'] else QUEUED
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, available_at = ?, lease_owner = NULL,"
+                " lease_expires = NULL, updated_at = ? WHERE id = ? AND status = 'leased' AND lease_owner = ?",
+                (status, str(error)[:1000], now + retry_delay * job['attempts'], now, job['id'], job['lease_owner'])
+            )
+            return status if cursor.rowcount == 1 else None
+
+    def retry_dead(self, stage=None):
+        """Give dead-lettered jobs a fresh set of attempts. Returns how many were requeued."""
+        now = time.time()
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = 0, available_at = ?, updated_at = ?"
+                " WHERE status = 'dead' AND (? IS NULL OR stage = ?)",
+                (now, now, stage, stage)
+            )
+            return cursor.rowcount
+
+    def pending(self):
+        """Number of jobs not yet finished (queued or leased)."""
+        with contextlib.closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'leased')").fetchone()[0]
+
+    def results(self, book, stage):
+        """Results of a book's finished jobs in one stage, in the order they were queued."""
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT result FROM jobs WHERE book = ? AND stage = ? AND status = 'done' ORDER BY id",
+                (book, stage)
+            ).fetchall()
+        return [json.loads(row['result']) if row['result'] else None for row in rows]
+
+    def jobs(self, status=None):
+        """Jobs as dicts, optionally only those with the given status."""
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT * FROM jobs WHERE ? IS NULL OR status = ? ORDER BY id", (status, status)
+            ).fetchall()
+        return [_job(row) for row in rows]
+
+    def stats(self):
+        """{stage: {status: count}}"""
+        with contextlib.closing(self._connect()) as conn:
+            rows = conn.execute("SELECT stage, status, COUNT(*) AS n FROM jobs GROUP BY stage, status").fetchall()
+        stats = {}
+        for row in rows:
+            stats.setdefault(row['stage'], {})[row['status']] = row['n']
+        return stats
+
+
+def enqueue_pdfs(queue, pdf_paths):
+    """Queue the first stage of each PDF not already being worked on. Returns the number queued.
+
+    A PDF processed before is queued again, so a replaced PDF is reprocessed
+    (incrementally, see manifest.py). Jobs are keyed by the PDF's file name
+    at every stage; the cleaned book name is found by the themes job and
+    passed on in the payloads. Paths are stored as given, so relative paths
+    work for every host that runs its workers from the same project directory.
+    """
+    return sum(queue.enqueue_book(os.path.basename(path), {'pdf': path}) for path in pdf_paths)
+
+
+class Worker:
+    """Leases jobs from a WorkQueue and runs them, up to `slots` at a time."""
+
+    def __init__(self, queue, model_handler, owner=None, slots=1, on_event=None):
+        self.queue = queue
+        self.model_handler = model_handler
+        self.owner = owner or worker_id()
+        self.slots = slots
+        self.on_event = on_event or (lambda event, **data: None)
+        self.completed = 0
+        self.retried = 0
+        self.dead = 0
+        self._texts = {}  # {pdf path: extracted text}, shared by the cards jobs of a book
+
+    async def run(self, until_empty=True):
+        """Work until the queue has nothing left to do, or until cancelled when until_empty is False."""
+        await asyncio.gather(*(self._slot(until_empty) for _ in range(self.slots)))
+
+    async def _slot(self, until_empty):
+        while True:
+            job = await asyncio.to_thread(self.queue.lease, self.owner)
+            if job is not None:
+                await self._run_job(job)
+                continue
+            # Jobs leased elsewhere may still add follow-up jobs, so only stop once nothing is pending
+            if until_empty and not await asyncio.to_thread(self.queue.pending):
+                return
+            await asyncio.sleep(settings.queue_poll_interval)
+
+    async def _run_job(self, job):
+        name = "/".join(part for part in (job['book'], job['stage'], job['theme']) if part)
+        self.on_event('job_start', job=name, attempt=job['attempts'])
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            with metrics.span('queue_job', stage=job['stage']):
+                result, children = await self._dispatch(job)
+        except Exception as e:
+            status = await asyncio.to_thread(self.queue.fail, job, e)
+            if status == DEAD:
+                self.dead += 1
+            else:
+                self.retried += 1
+            metrics.inc('queue_jobs_total', stage=job['stage'], outcome=status or 'lease_lost')
+            self.on_event('job_failed', job=name, error=str(e), status=status or 'lease_lost')
+            return
+        finally:
+            heartbeat.cancel()
+
+        if await asyncio.to_thread(self.queue.complete, job, result, children):
+            self.completed += 1
+            metrics.inc('queue_jobs_total', stage=job['stage'], outcome=DONE)
+            self.on_event('job_done', job=name, follow_up=len(children))
+        else:
+            # Another worker took over after the lease expired; its result wins
+            metrics.inc('queue_jobs_total', stage=job['stage'], outcome='lease_lost')
+            self.on_event('job_failed', job=name, error="Lease lost", status='lease_lost')
+
+    async def _heartbeat(self, job):
+        while True:
+            await asyncio.sleep(settings.queue_lease_seconds / 3)
+            if not await asyncio.to_thread(self.queue.heartbeat, job):
+                return
+
+    async def _text(self, pdf_path):
+        if pdf_path not in self._texts:
+            text = await extract_text_async(pdf_path)
+            if len(self._texts) >= MAX_CACHED_TEXTS:
+                del self._texts[next(iter(self._texts))]  # Oldest first
+            self._texts[pdf_path] = text
+        return self._texts[pdf_path]
+
+    async def _dispatch(self, job):
+        """Run one job. Returns its result and the jobs that follow it."""
+        if job['stage'] == THEMES:
+            return await self._run_themes(job)
+        if job['stage'] == CARDS:
+            payload = job['payload']
+            text = (await self._text(payload['pdf']))[payload['chapter']]
+            cards = await generate_flashcards_for_theme(payload['theme'], text, self.model_handler,
+                                                        count=payload['count'])
+            for card in cards:
+                card['chapter'] = payload['title']
+                card['chunk'] = payload['chunk']
+            return cards, []
+        if job['stage'] == SAVE:
+            return await self._run_save(job)
+        raise ValueError(f"Unknown stage '{job['stage']}'")
+
+    async def _run_themes(self, job):
+        """Name the book, extract its chapters and find each chapter's themes, then queue their cards jobs."""
+        pdf_path = job['payload']['pdf']
+        book = await self.model_handler.clean_filename(os.path.basename(pdf_path))
+        text = await self._text(pdf_path)
+        if not text or not any(section.strip() for section in text):
+            raise Exception(f"No text could be extracted from {pdf_path}")
+        chapters = load_chapters(pdf_path) or [{'title': f"Section {i + 1}"} for i in range(len(text))]
+        # Unchanged chapters of a reprocessed book keep their themes and cards
+        reused, other_cards = reusable_chapters(book, pdf_path, text)
+
+        async def themes_for(i, section):
+            return reused[i][0] if i in reused else await analyze_themes(section, self.model_handler)
+
+        chapter_themes = await asyncio.gather(*(themes_for(i, section) for i, section in enumerate(text)))
+        if not any(chapter_themes):
+            raise Exception(f"No themes found in {pdf_path}")
+
+        themes = []
+        children = []
+        budgets = chapter_card_budgets([len(section) for section in text])
+        key = job['book']  # The PDF's file name, shared by every job of the book
+        for i, (chapter, section, found) in enumerate(zip(chapters, text, chapter_themes)):
+            if not found:
+                continue
+            themes = merge_themes(themes, found)
+            if i in reused:
+                continue
+            # The theme column keeps jobs unique when chapters share a theme
+            children += [{'book': key, 'stage': CARDS, 'theme': f"{i + 1}: {theme}",
+                          'payload': {'pdf': pdf_path, 'chapter': i, 'title': chapter['title'], 'theme': theme,
+                                      'count': count, 'chunk': chunk_hash(section)}}
+                         for theme, count in calculate_cards_per_theme(found, budgets[i]).items()]
+        children.append({'book': key, 'stage': SAVE, 'after_stage': CARDS,
+                         'payload': {'pdf': pdf_path, 'book': book, 'themes': themes, 'chapter_themes': chapter_themes,
+                                     'kept': sorted(reused), 'keep_other': bool(other_cards)}})
+        return {'book': book, 'themes': themes, 'chapters': len(text), 'unchanged': len(reused)}, children
+
+    async def _run_save(self, job):
+        """Save a book's new cards with those kept from unchanged chapters, and its manifest."""
+        payload = job['payload']
+        book = payload.get('book', job['book'])  # Jobs queued before the cleaned name was in the payload
+        cards = [card for result in await asyncio.to_thread(self.queue.results, job['book'], CARDS)
+                 for card in result or []]
+        text = await self._text(payload['pdf'])
+        if payload['kept'] or payload['keep_other']:
+            cards_by_chunk, other_cards = saved_cards_by_chunk(book)
+            cards = [card for i in payload['kept'] for card in cards_by_chunk.get(chunk_hash(text[i]), [])] + cards
+            if payload['keep_other']:
+                cards += other_cards
+        if not cards:
+            raise Exception(f"No flashcards generated for {book}")
+        await save_outputs(book, payload['themes'], cards)
+        chapters = load_chapters(payload['pdf']) or [{'title': f"Section {i + 1}"} for i in range(len(text))]
+        await save_manifest(book, payload['pdf'], chapters, text, payload['chapter_themes'])
+        return {'cards': len(cards)}, []